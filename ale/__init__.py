@@ -1,5 +1,16 @@
+from ale.lqastore import PickleHistoryStore, SQLiteHistoryStore, JournalHistoryStore
 from ale.lqa import LQA
+from ale.analytics import LQAArrays
+from ale.channelselect import GreedySelector, ThompsonSelector
 from ale.packet import Packet
+from ale.fec import FEC
+from ale.addresstable import AddressTable
+from ale.compression import Compressor
+from ale.transport import Transport
+from ale.packetstream import PacketStream
+from ale.scheduler import Clock, VirtualClock, Scheduler, VirtualScheduler
 from ale.scanlist import default_scanlists
 from ale.ale import ALE
 from ale.statemachine import ALEStateMachine
+from ale.asyncale import AsyncALE
+from ale.simulator import SimulatedMedium, SimulatedRadio, SimulatedModem, Simulator
@@ -0,0 +1,62 @@
+# Short address table module
+#
+# Full addresses are replaced by a short address (prefix character and 16-bit hash as 4 hex characters) in
+# ale packets where the receiving station is able to resolve it. Full addresses are learned from received
+# packets (soundings carry the full origin address) and from outgoing calls. Hash collisions are tracked
+# and colliding addresses are always sent in full. A station only sends its own address short to a station
+# that has sent it in short form, which shows the other station resolves it without a collision.
+
+import zlib
+
+
+class AddressTable:
+
+    SHORT_PREFIX = b'$'
+
+    def __init__(self):
+        # short address -> full address
+        self.addresses = {}
+        self.collisions = set()
+
+    @staticmethod
+    def short_address(address):
+        return AddressTable.SHORT_PREFIX + b'%04x' % (zlib.crc32(address) & 0xffff)
+
+    @staticmethod
+    def is_short(address):
+        return len(address) == 5 and address.startswith(AddressTable.SHORT_PREFIX)
+
+    def learn(self, address):
+        if AddressTable.is_short(address):
+            return None
+
+        short = AddressTable.short_address(address)
+        known_address = self.addresses.get(short)
+
+        if known_address == None:
+            self.addresses[short] = address
+        elif known_address != address:
+            self.collisions.add(short)
+
+    def compress(self, address):
+        short = AddressTable.short_address(address)
+
+        # only compress if shorter, known, and not colliding with another known address
+        if (
+            len(short) < len(address) and
+            self.addresses.get(short) == address and
+            short not in self.collisions
+        ):
+            return short
+
+        return address
+
+    # returns the full address, or None if the short address is unknown or ambiguous
+    def resolve(self, address):
+        if not AddressTable.is_short(address):
+            return address
+
+        if address in self.collisions:
+            return None
+
+        return self.addresses.get(address)
@@ -13,10 +13,19 @@ import time
 import random
 import json
 
-#import qdx
-import fskmodem
 import ale
 
+# radio and modem hardware packages are only required when a modem is not given (see ale.Simulator)
+try:
+    import qdx
+except ImportError:
+    qdx = None
+
+try:
+    import fskmodem
+except ImportError:
+    fskmodem = None
+
 
 #TODO
 # - recognize activity on channel (lqa?), look for next best channel to place call
@@ -55,24 +64,52 @@ class ALE:
     CMD_END     = b'CE'
     COMMANDS = [CMD_SOUND, CMD_ACK, CMD_CALL, CMD_END]
 
+    # capabilities advertised to other stations in ale command packets
+    CAP_BINARY      = b'B' # binary packet format
+    CAP_COMPRESSION = b'Z' # connected state data compression
+    CAP_TRANSPORT   = b'T' # connected state fragmentation and retransmission
+
     SCAN_WINDOW = 3 # seconds
 
-    def __init__(self, config_path=None, text_mode=False):
+    # with run_jobs False no jobs thread is started, the owner calls _run_jobs (see ale.AsyncALE) or run_until
+    # scheduler defaults to a real time ale.Scheduler, all time keeping uses its clock (see ale.VirtualScheduler)
+    # modem and radio default to fskmodem and the QDX, alternate backends implement the same interface (see ale.Simulator)
+    # config_dir defaults to ~/.ale and holds the scanlists, log and LQA history
+    # rng is the random.Random used for sounding intervals, sounding ack delays and channel selection, seeded by
+    # ale.Simulator so that simulations are reproducible
+    def __init__(self, config_path=None, text_mode=False, run_jobs=True, scheduler=None, modem=None, radio=None, config_dir=None, rng=None):
         self._text_mode = text_mode
+        self.scheduler = scheduler if scheduler != None else ale.Scheduler()
+        self.clock = self.scheduler.clock
+        self.random = rng if rng != None else random.Random()
 
         self.radio_serial_port = None
         self.modem_alsa_device = 'QDX'
         self.modem_baudrate = 300
         self.modem_sync_byte = 0x23
         self.modem_confidence = 1.5
+        self.binary_packets = False
+        self.fec_packets = False
+        self.short_addresses = False
+        self.aggregate_window = 0.1 # seconds
+        self.compression = False
+        self.use_transport = False
+        self.lqa_backend = 'pickle'
+        self.channel_selection = 'greedy'
+        self.lqa_exchange = True
+        # scanlist -> {'max_packet_count': int, 'min_confidence': float}, missing values use the LQA defaults
+        self.ack_thresholds = {}
 
         self.scanlists = ale.default_scanlists
+        self.scanlist = None
+        self.channel = None
         self.address = None
         self.addresses = []
         self.enable_whitelist = False
         self.whitelist_addresses = []
         self.enable_blacklist = False
         self.blacklist_addresses = []
+        self.peer_capabilities = {}
 
         self.callback = {
             'rx' : None,
@@ -84,13 +121,18 @@ class ALE:
         self.log_queue = []
         self.last_log_timestamp = 0
 
-        self.config_dir = os.path.expanduser('~/.ale')
+        # ale packets waiting to be aggregated into a single transmission
+        self.ale_queue = []
+        self.ale_queue_timestamp = 0
+        self.ale_queue_lock = threading.Lock()
+
+        self.config_dir = config_dir if config_dir != None else os.path.expanduser('~/.ale')
         self.config_path = os.path.join(self.config_dir, 'config')
         self.scanlist_path = os.path.join(self.config_dir, 'scanlists')
         self.log_path = os.path.join(self.config_dir, 'log')
 
         # use given alternate config file path if it exsits
-        if os.path.exists(config_path):
+        if config_path != None and os.path.exists(config_path):
             self.config_path = config_path
 
         # ensure config directory exists
@@ -120,7 +162,7 @@ class ALE:
             raise ValueError('ALE address cannot be empty. Update config file or pass address to ale.ALE() object on creation.')
 
         if not isinstance(self.address, bytes):
-            self.address = address.encode('utf-8')
+            self.address = self.address.encode('utf-8')
 
         if self.address not in self.addresses:
             self.addresses.append(self.address)
@@ -135,42 +177,68 @@ class ALE:
             self.radio = None
             self.modem = None
             self.log('Text-only mode')
+        elif modem != None:
+            self.radio = radio
+            self.modem = modem
+            self.log('Modem started')
+            self.modem.set_rx_callback(self._receive)
         else:
-            self.radio = qdx.QDX(port=radio_serial_port)
+            if qdx == None or fskmodem == None:
+                raise ImportError('ALE requires the qdx and fskmodem packages unless text_mode is set or a modem is given')
+
+            self.radio = qdx.QDX(port=self.radio_serial_port)
             self.log('Radio started')
 
-            #TODO move modem config to config file
-            alsa_device = fskmodem.get_alsa_device(alsa_device_string)
+            alsa_device = fskmodem.get_alsa_device(self.modem_alsa_device)
             self.modem = fskmodem.Modem(
                 alsa_dev_in = alsa_device, 
-                baudrate = baudrate,
-                sync_byte = sync_byte,
-                confidence = confidence
+                baudrate = self.modem_baudrate,
+                sync_byte = self.modem_sync_byte,
+                confidence = self.modem_confidence
             )
             self.log('Modem started')
             self.modem.set_rx_callback(self._receive)
 
+        # fec packets are always decoded, but only encoded if enabled
+        self.fec = ale.FEC()
+
+        # short addresses are always resolved, but only sent if enabled
+        self.address_table = ale.AddressTable()
+        for address in self.addresses:
+            self.address_table.learn(address)
+        # stations that sent us our short address, and so can resolve our short origin address
+        self.short_address_peers = set()
+
+        self.compressor = ale.Compressor()
+        self.packet_stream = ale.PacketStream(self.fec)
+        self.transport = ale.Transport(self)
+
         self.online = True
-        self.set_scanlist(self.get_scanlists()[0])
+        # use the first scanlist if not set by the config file
+        if self.scanlist == None:
+            self.set_scanlist(list(self.get_scanlists())[0])
+
         self.set_channel(list(self.channels.keys())[0])
         self.lqa = ale.LQA(self)
         self.state_machine = ale.ALEStateMachine(self)
         self.log(str(self) + ' online')
 
-        thread = threading.Thread(target=self._jobs)
-        thread.setDaemon(True)
-        thread.start()
+        if run_jobs:
+            thread = threading.Thread(target=self._jobs)
+            thread.setDaemon(True)
+            thread.start()
 
     def __repr__(self):
         return '<ALE {}>'.format(self.address.decode('utf-8'))
 
     def stop(self):
-        if not self._text_mode:
+        if self.modem != None:
             self.modem.stop()
             self.log('Modem stopped')
 
         if self.online:
             self.online = False
+            self.scheduler.wake()
             self.log(str(self) + ' offline')
         
         self.lqa.save_history()
@@ -190,7 +258,7 @@ class ALE:
 
             self.address = config['address']
             if 'group_addresses' in config.keys():
-                self.addresses = config['addresses']
+                self.addresses = config['group_addresses']
             if 'whitelist' in config.keys():
                 self.enable_whitelist = True
                 self.whitelist_addresses = config['whitelist']
@@ -200,7 +268,7 @@ class ALE:
             if 'scanlist' in config.keys():
                 self.set_scanlist(config['scanlist'])
             if 'radio' in config.keys():
-                if 'serial_port' in config['radio'].keys() 
+                if 'serial_port' in config['radio'].keys():
                     self.radio_serial_port = config['radio']['serial_port']
             if 'modem' in config.keys():
                 if 'alsa_device' in config['modem']:
@@ -211,6 +279,28 @@ class ALE:
                     self.modem_sync_byte = config['modem']['sync_byte']
                 if 'confidence' in config['modem']:
                     self.modem_confidence = config['modem']['confidence']
+            if 'packet' in config.keys():
+                if 'binary' in config['packet']:
+                    self.binary_packets = config['packet']['binary']
+                if 'fec' in config['packet']:
+                    self.fec_packets = config['packet']['fec']
+                if 'short_addresses' in config['packet']:
+                    self.short_addresses = config['packet']['short_addresses']
+                if 'aggregate_window' in config['packet']:
+                    self.aggregate_window = config['packet']['aggregate_window']
+                if 'compression' in config['packet']:
+                    self.compression = config['packet']['compression']
+                if 'transport' in config['packet']:
+                    self.use_transport = config['packet']['transport']
+            if 'lqa' in config.keys():
+                if 'backend' in config['lqa']:
+                    self.lqa_backend = config['lqa']['backend']
+                if 'exchange' in config['lqa']:
+                    self.lqa_exchange = config['lqa']['exchange']
+                if 'channel_selection' in config['lqa']:
+                    self.channel_selection = config['lqa']['channel_selection']
+                if 'ack_thresholds' in config['lqa']:
+                    self.ack_thresholds = config['lqa']['ack_thresholds']
  
             self.log('Loaded configuration from ' + self.config_path)
         except:
@@ -220,9 +310,9 @@ class ALE:
     def save_config(self):
         config = {
             'address': self.address,
-            'group_addresses': self.addressses,
-            'whitelist': self.whitelist_adddresses,
-            'blacklist': self.whitelist_addresses,
+            'group_addresses': self.addresses,
+            'whitelist': self.whitelist_addresses,
+            'blacklist': self.blacklist_addresses,
             'scanlist': self.scanlist,
             'radio': {
                 'serial_port': self.radio_serial_port
@@ -232,6 +322,20 @@ class ALE:
                 'baudrate': self.modem_baudrate,
                 'sync_byte': self.modem_sync_byte,
                 'confidence': self.modem_confidence
+                },
+            'packet': {
+                'binary': self.binary_packets,
+                'fec': self.fec_packets,
+                'short_addresses': self.short_addresses,
+                'aggregate_window': self.aggregate_window,
+                'compression': self.compression,
+                'transport': self.use_transport
+                },
+            'lqa': {
+                'backend': self.lqa_backend,
+                'channel_selection': self.channel_selection,
+                'exchange': self.lqa_exchange,
+                'ack_thresholds': self.ack_thresholds
                 }
         }
 
@@ -304,27 +408,32 @@ class ALE:
         if channel not in self.channels:
             return None
 
-        if not self._text_mode:
+        if self.radio != None:
             try:
-                self.radio.set_vfo_a(self.channels[self.channel]['freq'])
+                self.radio.set_vfo_a(self.channels[channel]['freq'])
     
                 #TODO change qdx to accept 'USB' and 'LSB' as sideband settings 
-                if self.channels[self.channel]['mode'] == 'USB':
+                if self.channels[channel]['mode'] == 'USB':
                     self.radio.set_sideband(0)
-                if self.channels[self.channel]['mode'] == 'LSB':
+                if self.channels[channel]['mode'] == 'LSB':
                     self.radio.set_sideband(1)
             except:
                 #TODO handle
                 # if error communicating with radio, go offline
-                self.online == False
+                self.online = False
                 self.log('Going offline, failed to communicate with radio')
 
         if self.online:
+            # frames queued in the modem for the previous channel are not sent on the new channel
+            if self.modem != None and channel != self.channel:
+                self.modem._tx_buffer.clear()
+
             self.channel = channel
 
     def add_address(self, address):
         if address not in self.addresses:
             self.addresses.append(address)
+            self.address_table.learn(address)
             self.log('Added self address ' + address.decode('utf-8'))
 
     def remove_address(self, address):
@@ -369,7 +478,7 @@ class ALE:
             self.log('Removed blacklist address ' + address.decode('utf-8'))
 
     def set_rx_callback(self, func):
-        self.callback['receive'] = func
+        self.callback['rx'] = func
 
     def set_incoming_call_callback(self, func):
         self.callback['call'] = func
@@ -378,7 +487,7 @@ class ALE:
         self.callback['connected'] = func
 
     def log(self, message):
-        log_message = time.strftime('%x %X') + '  ' + message + '\n'
+        log_message = time.strftime('%x %X', time.localtime(self.clock.time())) + '  ' + message + '\n'
         self.log_queue.append(log_message)
 
     def _process_log_queue(self):
@@ -387,12 +496,107 @@ class ALE:
                 fd.write(message)
 
         self.log_queue.clear()
-        self.last_log_timestamp = time.time()
+        self.last_log_timestamp = self.clock.time()
+
+    def capabilities(self):
+        capabilities = b''
+
+        if self.binary_packets:
+            capabilities += ALE.CAP_BINARY
+        if self.compression:
+            capabilities += ALE.CAP_COMPRESSION
+        if self.use_transport:
+            capabilities += ALE.CAP_TRANSPORT
+
+        return capabilities
+
+    def supports(self, address, capability):
+        if address not in self.peer_capabilities:
+            return False
+
+        return capability in self.peer_capabilities[address]
+
+    # compression is used if both stations advertised support during the call handshake
+    def compression_negotiated(self):
+        state = self.state_machine.state
+        return self.compression and state == ALE.STATE_CONNECTED and self.supports(state.call_address, ALE.CAP_COMPRESSION)
+
+    # the transport is used if both stations advertised support during the call handshake
+    def transport_negotiated(self):
+        state = self.state_machine.state
+        return self.use_transport and state == ALE.STATE_CONNECTED and self.supports(state.call_address, ALE.CAP_TRANSPORT)
+
+    def _learn_capabilities(self, packet):
+        options = ale.Packet.unpack_options(packet.data)
+
+        if ale.Packet.OPTION_CAPABILITIES in options:
+            capabilities = options[ale.Packet.OPTION_CAPABILITIES]
+        # call handshake packets always carry the option, unless sent by a station without capabilities
+        elif packet.command == ALE.CMD_CALL or packet.command == ALE.CMD_ACK:
+            capabilities = b''
+        elif packet.binary:
+            capabilities = self.peer_capabilities.get(packet.origin, b'')
+        else:
+            return None
+
+        # a station sending binary packets supports them even if the capabilities option was not received
+        if packet.binary and ALE.CAP_BINARY not in capabilities:
+            capabilities += ALE.CAP_BINARY
+
+        self.peer_capabilities[packet.origin] = capabilities
 
     def call(self, address):
+        if not isinstance(address, bytes):
+            address = address.encode('utf-8')
+
+        self.address_table.learn(address)
+
         self.state_machine.call(address)
+        self.scheduler.wake()
+
+    # end the current call, or call attempt
+    def end(self):
+        # a packet received from the remote station could end the call at the same time
+        with self.state_machine.locked():
+            state = self.state_machine.state
+            if state != ALE.STATE_CALLING and state != ALE.STATE_CONNECTING and state != ALE.STATE_CONNECTED:
+                return None
+
+            self._send_ale(ALE.CMD_END, state.call_address)
+            # send now, the scanning state leaves the channel before the aggregate window passes
+            self._process_ale_queue()
+
+            address = state.call_address.decode('utf-8')
+            call_duration = int(self.clock.time() - state.call_started_timestamp)
+            self.log('Call ended with address ' + address + ' (call duration: ' + str(call_duration) + ' seconds)')
+
+            self.state_machine.queue_callback('disconnected', state.call_address, call_duration)
+            self.state_machine.change_state(ALE.STATE_SCANNING)
+
+        self.scheduler.wake()
+
+    # number of queued fragments or modem frames not yet sent
+    def backlog(self):
+        if self.transport_negotiated():
+            return len(self.transport.tx_queue) + len(self.transport.tx_unacked)
+
+        if self.modem != None:
+            return len(self.modem._tx_buffer)
+
+        return 0
 
     def send(self, data, keep_alive=False):
+        if self.transport_negotiated():
+            # the transport keeps the call alive while data is outstanding
+            self.transport.send(data)
+            self.scheduler.wake()
+        else:
+            self._send_data(data, keep_alive)
+
+    def _send_data(self, data, keep_alive=False):
+        if self.compression_negotiated():
+            data = self.compressor.compress(data)
+
         #TODO
         if self._text_mode:
             print(data)
@@ -405,49 +609,206 @@ class ALE:
 
         packet = ale.Packet(self.address, address, command, data)
 
-        # pad call and sound packets to have a minimum transmit time of 1/3 of the scan window
+        # advertise capabilities so the called or sounding station can negotiate features, call handshake
+        # packets always carry them so that capabilities learned earlier are replaced
+        capabilities = self.capabilities()
+        if command == ALE.CMD_CALL or command == ALE.CMD_ACK or (command == ALE.CMD_SOUND and len(capabilities) > 0):
+            packet.data = ale.Packet.pack_options({ale.Packet.OPTION_CAPABILITIES: capabilities}) + packet.data
+
+        if self.short_addresses and command != ALE.CMD_SOUND:
+            # the destination station can always resolve its own short address
+            packet.destination = self.address_table.compress(address)
+
+            # acks and ends within a call use a short origin address once the destination station has sent us
+            # our short address, which it only does if it resolves it without a collision
+            if command != ALE.CMD_CALL and address == self.state_machine.state.call_address and address in self.short_address_peers:
+                packet.origin = self.address_table.compress(self.address)
+
+        # only use the binary packet format if the destination station advertised support
+        packet.binary = self.binary_packets and self.supports(address, ALE.CAP_BINARY)
+
+        # queue the packet so that packets sent within the aggregate window share a single transmission
+        packet.channel = self.channel
+        with self.ale_queue_lock:
+            if len(self.ale_queue) == 0:
+                self.ale_queue_timestamp = self.clock.time()
+
+            self.ale_queue.append(packet)
+
+        if self.aggregate_window <= 0:
+            self._process_ale_queue()
+        else:
+            self.scheduler.wake_at(self.ale_queue_timestamp + self.aggregate_window)
+
+    def _process_ale_queue(self):
+        # take the queue as a whole, packets queued from another thread go into the next transmission
+        with self.ale_queue_lock:
+            queue = self.ale_queue
+            self.ale_queue = []
+
+        # drop queued packets for a channel other than the current channel
+        packets = [packet for packet in queue if packet.channel == self.channel]
+
+        if len(packets) == 0:
+            return None
+
+        raw = self._pack_transmission(packets)
+
+        # pad call and sound transmissions to have a minimum transmit time of 1/3 of the scan window
         # example:  scan window: 3 seconds
         #           baudrate:    300 bps
         #           min length:  (300 / 8) * (3 * 1/3)  ~= 37 characters for 1 second tx
-        if command == ALE.CMD_CALL or command == ALE.CMD_SOUND:
-            # length of packet, including modem packet delimiters (6 characters)
-            len_packet = len(packet.pack()) + 6
+        padded_packets = [packet for packet in packets if packet.command == ALE.CMD_CALL or packet.command == ALE.CMD_SOUND]
+        if len(padded_packets) > 0:
+            # length of transmission, including modem packet delimiters (6 characters)
+            len_tx = len(raw) + 6
             # (baudrate (bps) / 8 bits per character) * (scan window / 3)
-            len_min_tx = int( (self.baudrate / 8) * (ALE.SCAN_WINDOW / 3) )
-            if len_packet < len_min_tx:
+            len_min_tx = int( (self.modem_baudrate / 8) * (ALE.SCAN_WINDOW / 3) )
+            if len_tx < len_min_tx and self.lqa_exchange:
+                # fill the padding with an lqa digest, option tag and length use 2 bytes
+                digest = self.lqa.digest(min(len_min_tx - len_tx - 2, 255))
+                if len(digest) > 0:
+                    padded_packets[-1].data += ale.Packet.pack_options({ale.Packet.OPTION_LQA: digest})
+                    raw = self._pack_transmission(packets)
+                    len_tx = len(raw) + 6
+
+            if len_tx < len_min_tx:
                 #TODO pad with a different character since b'#' is the default fskmodem sync byte?
-                # pad packet data to equal minimum transmit time
-                packet.data = b'#' * (len_min_tx - len_packet)
+                # pad packet data to equal minimum transmit time, only one packet per transmission needs padding
+                padded_packets[-1].data += ale.Packet.OPTION_PADDING * (len_min_tx - len_tx)
+                raw = self._pack_transmission(packets)
+
+        self._transmit(raw)
+
+    def _pack_transmission(self, packets):
+        if len(packets) == 1:
+            raw = packets[0].pack()
+        else:
+            raw = ale.Packet.aggregate([packet.pack() for packet in packets])
+
+        if self.fec_packets:
+            raw = self.fec.encode(raw)
+
+        return raw
 
-        self.send(packet.pack())
+    def _transmit(self, raw):
+        if self._text_mode:
+            print(raw)
+        else:
+            self.modem.send(raw)
 
     def _receive(self, raw, confidence):
-        preamble = raw[:len(ale.Packet.PREAMBLE)]
+        corrections = 0
+
+        # correct errors in fec encoded ale packets
+        if not ale.Packet.is_packet(raw) and not ale.Packet.is_aggregate(raw) and ale.FEC.is_fec(raw):
+            try:
+                decoded, corrections = self.fec.decode(raw)
+            except ValueError:
+                decoded = None
+
+            # fec frames only carry ale packets
+            if decoded == None or not (ale.Packet.is_packet(decoded) or ale.Packet.is_aggregate(decoded)):
+                # drop corrupted fec frames, except that connected state data only matching the preamble with an
+                # error is passed on unchanged below
+                if ale.FEC.is_fec(raw, exact = True) or self.state_machine.state != ALE.STATE_CONNECTED:
+                    return None
+
+                corrections = 0
+            else:
+                raw = decoded
+
+        # connected state data can start like an ale frame, so only well formed ale frames are taken as packets
+        connected = self.state_machine.state == ALE.STATE_CONNECTED
+        packets = self._unpack_frame(raw, strict = connected)
+
         # handle non-ale packets
-        if preamble != ale.Packet.PREAMBLE:
-            if self.state_machine.state == ale.ALE.CONNECTED:
-                self.state.keep_alive()
+        if packets == None:
+            if connected:
+                self.state_machine.keep_alive()
+
+                if self.compression_negotiated():
+                    try:
+                        raw = self.compressor.decompress(raw)
+                    except Exception:
+                        # drop corrupted data
+                        return None
                 
-                # pass to data handling application when connected
-                if self.callback['receive'] != None:
-                    self.callback['receive'](raw)
+                # reassemble transport fragments before passing data to the application
+                if self.transport_negotiated():
+                    self.transport.receive(raw)
+                    self.scheduler.wake()
+                else:
+                    self._deliver(raw)
 
             # drop the packet, no further processing
             return None
 
-        # load received data into packet
-        packet = ale.Packet()
-        # discard packet if it fails to unpack, which likely means it is corrupted
-        try:
-            packet.unpack(raw)
-        except:
+        # pass each packet of an aggregated transmission on for handling
+        for packet in packets:
+            self._handle_packet(packet, confidence, corrections)
+
+    # returns the packets of a received ale frame, or None if it is not an ale frame
+    # packets that fail to unpack are likely corrupted and are skipped, unless strict, where any malformed
+    # packet means the frame is not an ale frame
+    def _unpack_frame(self, raw, strict=False):
+        if ale.Packet.is_aggregate(raw):
+            try:
+                packed_packets = ale.Packet.disaggregate(raw, strict)
+            except ValueError:
+                return None
+        elif ale.Packet.is_packet(raw):
+            packed_packets = [raw]
+        else:
             return None
 
-        packet.timestamp = time.time()
+        packets = []
+        for packed_packet in packed_packets:
+            packet = ale.Packet()
+            try:
+                packet.unpack(packed_packet)
+            except ValueError:
+                if strict:
+                    return None
+                continue
+
+            if strict and packet.command not in ALE.COMMANDS:
+                return None
+
+            packets.append(packet)
+
+        return packets
+
+    # pass to data handling application when connected, without copying the received buffer
+    def _deliver(self, data):
+        if self.callback['rx'] != None:
+            self.callback['rx'](data)
+
+    # receive callback for modem backends that deliver a byte stream instead of complete frames
+    def _receive_stream(self, chunk, confidence, end_of_transmission=False):
+        packets = self.packet_stream.feed(chunk)
+        if end_of_transmission:
+            packets.extend(self.packet_stream.flush())
+
+        for packet in packets:
+            self._handle_packet(packet, confidence, packet.corrections)
+
+    def _handle_packet(self, packet, confidence, corrections):
+        if not self._resolve_addresses(packet):
+            return None
+
+        packet.timestamp = self.clock.time()
         packet.channel = self.channel
         packet.confidence = confidence
+        packet.corrections = corrections
         # store packet in lqa history
         self.lqa.store(packet)
+        self._learn_capabilities(packet)
+
+        if packet.command == ALE.CMD_CALL or packet.command == ALE.CMD_SOUND:
+            options = ale.Packet.unpack_options(packet.data)
+            if ale.Packet.OPTION_LQA in options:
+                self.lqa.merge_digest(packet.origin, options[ale.Packet.OPTION_LQA])
 
         if self.enable_whitelist and packet.origin not in self.whitelist_addresses:
             return None
@@ -457,25 +818,94 @@ class ALE:
 
         # pass packet to the current state for handling
         self.state_machine.receive_packet(packet)
-
-    def _jobs(self):
-        while self.online:
-            # process log queue
-            if time.time() > (self.last_log_timestamp + 1) and len(self.log_queue) > 0:
+        self.scheduler.wake()
+
+    # resolve short addresses in a received packet, returns False if an address could not be resolved
+    def _resolve_addresses(self, packet):
+        short_destination = False
+
+        if ale.AddressTable.is_short(packet.destination):
+            # check own addresses first since they are known to be valid
+            for address in self.addresses:
+                if ale.AddressTable.short_address(address) == packet.destination:
+                    packet.destination = address
+                    short_destination = True
+                    break
+            else:
+                # an unresolved destination is not one of our addresses, leave it short
+                destination = self.address_table.resolve(packet.destination)
+                if destination != None:
+                    packet.destination = destination
+
+        origin = self.address_table.resolve(packet.origin)
+        if origin == None:
+            return False
+
+        packet.origin = origin
+        self.address_table.learn(origin)
+
+        if short_destination:
+            self.short_address_peers.add(origin)
+
+        return True
+
+    # time of the next job, the loop sleeps until then unless woken by a received packet or user request
+    def _next_deadline(self):
+        deadlines = [self.state_machine.next_deadline(), self.transport.next_deadline(), self.lqa.next_deadline()]
+
+        if len(self.ale_queue) > 0:
+            deadlines.append(self.ale_queue_timestamp + self.aggregate_window)
+
+        if len(self.log_queue) > 0:
+            deadlines.append(self.last_log_timestamp + 1)
+
+        return min([deadline for deadline in deadlines if deadline != None], default = None)
+
+    # run due jobs once, returns the time of the next job
+    def _run_jobs(self):
+        current_time = self.clock.time()
+
+        # send queued ale packets once the aggregate window has passed
+        if len(self.ale_queue) > 0 and current_time > (self.ale_queue_timestamp + self.aggregate_window):
+            self._process_ale_queue()
+
+        # process log queue
+        if current_time > (self.last_log_timestamp + 1) and len(self.log_queue) > 0:
+            # avoid starting a thread per simulated second
+            if isinstance(self.scheduler, ale.VirtualScheduler):
+                self._process_log_queue()
+            else:
                 thread = threading.Thread(target=self._process_log_queue)
                 thread.setDaemon(True)
                 thread.start()
 
-            # tick state machine
-            self.state_machine.tick()
+        # tick state machine
+        self.state_machine.tick()
+        self.transport.tick()
+        # expire lqa stats, flush and cull the lqa history store
+        self.lqa.tick()
 
-            # remove packets in the modem tx buffer if they are for a channel other than the current channel
-            if self.modem != None and (len(self.modem._tx_buffer) > 0):
-                for i in range(len(self.modem._tx_buffer)):
-                    if self.modem._tx_buffer[i].channel != self.channel:
-                        self.modem._tx_buffer.remove(i)
+        return self._next_deadline()
 
-            # simmer down
-            time.sleep(0.001)
+    def _jobs(self):
+        while self.online:
+            # sleep until the next deadline
+            deadline = self._run_jobs()
+            if deadline != None:
+                self.scheduler.wake_at(deadline)
+
+            self.scheduler.wait()
+
+    # run the jobs loop on the calling thread until the clock reaches the given time, for use with a virtual
+    # clock (e.g. station.run_until(station.clock.time() + 24 * 60 * 60) simulates a day)
+    def run_until(self, timestamp):
+        while self.online and self.clock.time() < timestamp:
+            deadline = self._run_jobs()
+            if deadline != None:
+                self.scheduler.wake_at(min(deadline, timestamp))
+            else:
+                self.scheduler.wake_at(timestamp)
+
+            self.scheduler.wait()
 
 
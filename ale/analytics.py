@@ -0,0 +1,149 @@
+# LQA analytics module
+#
+# Columnar view of LQA history for batch queries over large histories (e.g. monitoring dashboards ranking
+# all addresses and channels over days of history). Packets are converted once into NumPy arrays:
+#
+#   timestamps      float64, seconds since the epoch
+#   channels        int32 index into channel_names
+#   origins         int32 index into origin_names
+#   confidences     float64
+#
+# Queries are vectorized over the arrays and do not touch Packet objects. NumPy is an optional dependency,
+# it is only required to create an LQAArrays object.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class LQAArrays:
+
+    def __init__(self, timestamps, channels, origins, confidences, channel_names, origin_names):
+        if numpy == None:
+            raise ImportError('LQA analytics require numpy')
+
+        self.timestamps = numpy.asarray(timestamps, dtype = numpy.float64)
+        self.channels = numpy.asarray(channels, dtype = numpy.int32)
+        self.origins = numpy.asarray(origins, dtype = numpy.int32)
+        self.confidences = numpy.asarray(confidences, dtype = numpy.float64)
+        self.channel_names = channel_names
+        self.origin_names = origin_names
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    # packets are ale.Packet objects or packet dicts (see ale.Packet.to_dict)
+    @staticmethod
+    def from_packets(packets, channel_names=None):
+        channel_names = list(channel_names) if channel_names != None else []
+        channel_ids = {channel: i for i, channel in enumerate(channel_names)}
+        origin_names = []
+        origin_ids = {}
+
+        timestamps = []
+        channels = []
+        origins = []
+        confidences = []
+
+        for packet in packets:
+            if isinstance(packet, dict):
+                timestamp = packet['timestamp']
+                channel = packet['channel']
+                origin = packet['origin'].encode('utf-8')
+                confidence = packet['confidence']
+            else:
+                timestamp = packet.timestamp
+                channel = packet.channel
+                origin = packet.origin
+                confidence = packet.confidence
+
+            if channel not in channel_ids:
+                channel_ids[channel] = len(channel_names)
+                channel_names.append(channel)
+
+            if origin not in origin_ids:
+                origin_ids[origin] = len(origin_names)
+                origin_names.append(origin)
+
+            timestamps.append(timestamp)
+            channels.append(channel_ids[channel])
+            origins.append(origin_ids[origin])
+            confidences.append(confidence)
+
+        return LQAArrays(timestamps, channels, origins, confidences, channel_names, origin_names)
+
+    # boolean mask of packets within [since, until)
+    def _window(self, since=None, until=None):
+        mask = numpy.ones(len(self.timestamps), dtype = bool)
+
+        if since != None:
+            mask &= self.timestamps >= since
+        if until != None:
+            mask &= self.timestamps < until
+
+        return mask
+
+    # list of (channel, max confidence, mean confidence, packet count) ordered by max confidence
+    def channel_ranking(self, since=None, until=None):
+        mask = self._window(since, until)
+        channels = self.channels[mask]
+        confidences = self.confidences[mask]
+        num_channels = len(self.channel_names)
+
+        counts = numpy.bincount(channels, minlength = num_channels)
+        sums = numpy.bincount(channels, weights = confidences, minlength = num_channels)
+        maximums = numpy.zeros(num_channels)
+        numpy.maximum.at(maximums, channels, confidences)
+        means = numpy.divide(sums, counts, out = numpy.zeros(num_channels), where = counts > 0)
+
+        ranking = []
+        for i in numpy.lexsort((-means, -maximums)):
+            if counts[i] > 0:
+                ranking.append((self.channel_names[i], float(maximums[i]), float(means[i]), int(counts[i])))
+
+        return ranking
+
+    # max confidence matrix, rows are origin_names and columns are channel_names, 0.0 if never heard
+    def reachability(self, since=None, until=None):
+        mask = self._window(since, until)
+        matrix = numpy.zeros((len(self.origin_names), len(self.channel_names)))
+        numpy.maximum.at(matrix, (self.origins[mask], self.channels[mask]), self.confidences[mask])
+        return matrix
+
+    # channel -> array of confidence percentiles, channels without packets are omitted
+    def percentiles(self, q=(10, 50, 90), since=None, until=None):
+        mask = self._window(since, until)
+        channels = self.channels[mask]
+        confidences = self.confidences[mask]
+
+        # sort by channel so each channel is a contiguous slice
+        order = numpy.argsort(channels, kind = 'stable')
+        channels = channels[order]
+        confidences = confidences[order]
+        bounds = numpy.searchsorted(channels, numpy.arange(len(self.channel_names) + 1))
+
+        result = {}
+        for i, channel in enumerate(self.channel_names):
+            if bounds[i + 1] > bounds[i]:
+                result[channel] = numpy.percentile(confidences[bounds[i]:bounds[i + 1]], q)
+
+        return result
+
+    # tuple of bucket start times and a packet count matrix, rows are time buckets and columns are channel_names
+    def activity(self, bucket_size=3600, since=None, until=None):
+        mask = self._window(since, until)
+        timestamps = self.timestamps[mask]
+        channels = self.channels[mask]
+        num_channels = len(self.channel_names)
+
+        if len(timestamps) == 0:
+            return (numpy.zeros(0), numpy.zeros((0, num_channels), dtype = numpy.int64))
+
+        start = numpy.floor(timestamps.min() / bucket_size) * bucket_size
+        buckets = ((timestamps - start) // bucket_size).astype(numpy.int64)
+        num_buckets = int(buckets.max()) + 1
+
+        counts = numpy.bincount((buckets * num_channels) + channels, minlength = num_buckets * num_channels)
+        bucket_starts = start + (numpy.arange(num_buckets) * bucket_size)
+        return (bucket_starts, counts.reshape(num_buckets, num_channels))
@@ -0,0 +1,197 @@
+# asyncio ALE front end module
+#
+# Classes:
+#   Connection
+#   AsyncALE
+#
+# AsyncALE runs the ALE jobs (state machine, transport and packet queue) as a task on the asyncio event loop
+# instead of on the jobs thread. Received frames from the modem thread are handed to the event loop, so the
+# state machine only runs on the event loop thread. The task sleeps until the next ALE deadline (see
+# ale.Scheduler) or until woken by a received frame or a user request.
+#
+# With a virtual scheduler (see ale.VirtualScheduler) there is no jobs task, the jobs are run by the owner of
+# the virtual clock on the event loop thread (see ale.Simulator.add_station).
+#
+# Example:
+#
+#   station = ale.AsyncALE()
+#   await station.start()
+#   connection = await station.call(b'ADDRESS', timeout=60)
+#   await connection.send(b'hello')
+#   async for data in connection:
+#       ...
+#   await connection.close()
+
+import asyncio
+
+import ale
+
+
+class Connection:
+    """
+    Connection to a remote station
+
+    Received data is returned by iterating the connection, iteration ends when the call ends.
+    """
+
+    def __init__(self, owner, address):
+        self.owner = owner
+        self.address = address
+        self.connected = True
+        self._rx_queue = asyncio.Queue()
+
+    def __repr__(self):
+        return '<ALE Connection ' + self.address.decode('utf-8') + '>'
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        data = await self._rx_queue.get()
+        if data == None:
+            raise StopAsyncIteration
+
+        return data
+
+    # returns once the data is queued and the transmit backlog is below AsyncALE.MAX_BACKLOG
+    async def send(self, data):
+        await self.owner._wait_backlog()
+
+        if not self.connected:
+            raise ConnectionError('Not connected to ' + self.address.decode('utf-8'))
+
+        self.owner.ale.send(data)
+
+    async def close(self):
+        if self.connected:
+            self.owner.ale.end()
+
+    def _closed(self):
+        self.connected = False
+        self._rx_queue.put_nowait(None)
+
+
+class AsyncALE:
+
+    MAX_BACKLOG = 8 # queued transport fragments or modem frames before send blocks
+
+    # other keyword arguments are passed to ale.ALE (e.g. scheduler, modem, radio, config_dir, rng)
+    def __init__(self, config_path=None, text_mode=False, **kwargs):
+        self.ale = ale.ALE(config_path, text_mode, run_jobs = False, **kwargs)
+        self.loop = None
+        self.connection = None
+        self._task = None
+        self._wake_event = None
+        self._drained_event = None
+        self._incoming = None
+        # (address, future) of the call in progress
+        self._call = None
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._wake_event = asyncio.Event()
+        self._drained_event = asyncio.Event()
+        self._incoming = asyncio.Queue()
+
+        self.ale.callback['connected'] = self._threadsafe(self._connected)
+        self.ale.callback['disconnected'] = self._threadsafe(self._disconnected)
+        self.ale.callback['rx'] = self._threadsafe_data(self._received)
+
+        if self.ale.modem != None:
+            self.ale.modem.set_rx_callback(self._threadsafe_data(self.ale._receive))
+
+        # the owner of a virtual clock runs the jobs
+        if not isinstance(self.ale.scheduler, ale.VirtualScheduler):
+            self.ale.scheduler.listener = self._wake
+            self._task = self.loop.create_task(self._jobs())
+
+    async def stop(self):
+        self.ale.stop()
+
+        if self._task != None:
+            await self._task
+
+    # call an address, returns a Connection or raises asyncio.TimeoutError if the call is not answered
+    async def call(self, address, timeout=None):
+        if not isinstance(address, bytes):
+            address = address.encode('utf-8')
+
+        future = self.loop.create_future()
+        self._call = (address, future)
+        self.ale.call(address)
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            # stop calling
+            if self.connection == None:
+                self.ale.end()
+            raise
+        finally:
+            self._call = None
+
+    # wait for an incoming call, returns a Connection
+    async def accept(self):
+        return await self._incoming.get()
+
+    # callbacks may be called from other threads, run them on the event loop
+    def _threadsafe(self, func):
+        def callback(*args):
+            self.loop.call_soon_threadsafe(func, *args)
+
+        return callback
+
+    # received data may be a view of the modem buffer, so it is copied before leaving the calling thread
+    def _threadsafe_data(self, func):
+        def callback(data, *args):
+            self.loop.call_soon_threadsafe(func, bytes(data), *args)
+
+        return callback
+
+    def _wake(self):
+        self.loop.call_soon_threadsafe(self._wake_event.set)
+
+    def _connected(self, address):
+        self.connection = Connection(self, address)
+
+        if self._call != None and self._call[0] == address and not self._call[1].done():
+            self._call[1].set_result(self.connection)
+        else:
+            self._incoming.put_nowait(self.connection)
+
+    def _disconnected(self, address, call_duration):
+        if self.connection != None and self.connection.address == address:
+            self.connection._closed()
+            self.connection = None
+
+        elif self._call != None and self._call[0] == address and not self._call[1].done():
+            self._call[1].set_exception(asyncio.TimeoutError('No answer from ' + address.decode('utf-8')))
+
+    def _received(self, data):
+        if self.connection != None:
+            self.connection._rx_queue.put_nowait(data)
+
+    async def _wait_backlog(self):
+        while self.ale.backlog() >= AsyncALE.MAX_BACKLOG:
+            self._drained_event.clear()
+
+            # modem transmit buffer draining does not wake the jobs task, so check at the poll interval
+            try:
+                await asyncio.wait_for(self._drained_event.wait(), ale.Scheduler.POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _jobs(self):
+        while self.ale.online:
+            self._wake_event.clear()
+            deadline = self.ale._run_jobs()
+            self._drained_event.set()
+
+            timeout = ale.Scheduler.MAX_SLEEP
+            if deadline != None:
+                timeout = min(max(deadline - self.ale.clock.time(), 0), timeout)
+
+            try:
+                await asyncio.wait_for(self._wake_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,125 @@
+# Outgoing call channel selection module
+#
+# Classes:
+#   GreedySelector
+#   ThompsonSelector
+#
+# Channel selectors choose the channel for each outgoing call attempt and learn from call outcomes recorded
+# by the state machine. All selectors implement:
+#
+#   select(address, exclude)            channel to call the address on, excluding already attempted channels
+#   record(channel, address, success)   outcome of a call attempt on a channel
+#
+# The selector is chosen by the 'channel_selection' key of the 'lqa' config section.
+
+import math
+import threading
+
+
+class GreedySelector:
+    """
+    Greedy channel selector
+
+    Always selects the channel with the best LQA confidence (see ale.LQA.best_channel). Call outcomes are
+    not used.
+    """
+
+    def __init__(self, lqa):
+        self.lqa = lqa
+
+    def select(self, address, exclude):
+        return self.lqa.best_channel(address, exclude = exclude)
+
+    def record(self, channel, address, success):
+        pass
+
+
+class ThompsonSelector:
+    """
+    Thompson sampling channel selector
+
+    The handshake success probability of each channel is modeled as a beta distribution. The prior is
+    derived from LQA confidence, so an untried channel starts at its sounding based estimate, and recorded
+    call outcomes for the channel and for the (channel, address) pair are added as evidence. Outcomes for
+    other addresses on the channel count with CHANNEL_WEIGHT, and all outcomes decay with a time constant
+    of OUTCOME_WINDOW so that the model follows changing propagation.
+
+    Each call attempt samples every candidate channel and selects the highest sample, which balances
+    calling on the best known channel with trying channels that have little evidence.
+    """
+
+    PRIOR_STRENGTH = 2.0 # pseudo-observations given to the LQA confidence prior
+    CHANNEL_WEIGHT = 0.5 # weight of outcomes for other addresses on the same channel
+    OUTCOME_WINDOW = 6 * 60 * 60 # 6 hours
+
+    def __init__(self, lqa):
+        self.lqa = lqa
+        self.lock = threading.Lock()
+        # channel or (channel, address) -> [successes, failures, last update timestamp]
+        self.outcomes = {}
+
+    # decayed (successes, failures) at the current time
+    def _evidence(self, key, current_time):
+        if key not in self.outcomes:
+            return (0.0, 0.0)
+
+        successes, failures, timestamp = self.outcomes[key]
+        decay = math.exp(-max(current_time - timestamp, 0) / ThompsonSelector.OUTCOME_WINDOW)
+        return (successes * decay, failures * decay)
+
+    # LQA confidence mapped to a success probability, linear over a confidence range of 1.0 above the modem minimum
+    def _prior(self, channel, address, current_time):
+        confidence = self.lqa._blended_confidence(self.lqa.address_stats, (channel, address), current_time)
+        if confidence == 0.0:
+            confidence = self.lqa._blended_confidence(self.lqa.channel_stats, channel, current_time)
+
+        if confidence == 0.0:
+            return 0.5
+
+        return min(max(confidence - self.lqa.owner.modem_confidence, 0.05), 0.95)
+
+    def select(self, address, exclude):
+        exclude = exclude if exclude != None else []
+        current_time = self.lqa.clock.time()
+        best_sample = -1.0
+        best_channel = None
+
+        for channel in list(self.lqa.owner.channels.keys()):
+            if channel in exclude:
+                continue
+
+            prior = self._prior(channel, address, current_time)
+            alpha = 1 + (ThompsonSelector.PRIOR_STRENGTH * prior)
+            beta = 1 + (ThompsonSelector.PRIOR_STRENGTH * (1 - prior))
+
+            with self.lock:
+                channel_successes, channel_failures = self._evidence(channel, current_time)
+                address_successes, address_failures = self._evidence((channel, address), current_time)
+
+            # channel outcomes include the outcomes for this address, only count the other addresses with reduced weight
+            alpha += address_successes + (ThompsonSelector.CHANNEL_WEIGHT * max(channel_successes - address_successes, 0))
+            beta += address_failures + (ThompsonSelector.CHANNEL_WEIGHT * max(channel_failures - address_failures, 0))
+
+            sample = self.lqa.owner.random.betavariate(alpha, beta)
+            if sample > best_sample:
+                best_sample = sample
+                best_channel = channel
+
+        # all channels excluded
+        if best_channel == None:
+            return self.lqa.best_channel(address, exclude = exclude)
+
+        return best_channel
+
+    def record(self, channel, address, success):
+        current_time = self.lqa.clock.time()
+
+        with self.lock:
+            for key in (channel, (channel, address)):
+                successes, failures = self._evidence(key, current_time)
+                if success:
+                    successes += 1
+                else:
+                    failures += 1
+
+                self.outcomes[key] = [successes, failures, current_time]
@@ -0,0 +1,129 @@
+# Data compression module
+#
+# Connected state data is compressed when both stations advertise compression support during the call
+# handshake. Each compressed payload starts with a single byte header identifying the compression method.
+# Data is sent uncompressed (raw method) if compression would not reduce the size.
+#
+# Deflate uses a preset dictionary shared by both stations. The default dictionary is hand-written, a
+# dictionary derived from sample traffic can be built with Compressor.train_dictionary, and is used if both
+# stations are given the same dictionary.
+
+import time
+import collections
+import zlib
+import lzma
+
+
+class Compressor:
+
+    METHOD_RAW          = 0x0
+    METHOD_DEFLATE      = 0x1 # raw deflate using the preset dictionary
+    METHOD_LZMA         = 0x2 # raw lzma2, only tried for larger payloads
+
+    LZMA_MIN_LENGTH = 512
+    LZMA_FILTERS = [{'id': lzma.FILTER_LZMA2, 'preset': 6}]
+
+    # hand-written preset dictionary of common ham radio text and Reticulum strings, most common strings last
+    PRESET_DICTIONARY = (
+        b'QRZ? QRL? QRM QRN QSB QSY QTH QSO QSL CONDX ANT RIG PWR WX TEMP NAME OP HR UR FB OM YL XYL '
+        b'GM GA GE GN TNX TKS TU PSE AGN HW CPY? SRI BK KN SK AR 599 5NN RST '
+        b'destination announce link request proof identity path resource packet interface transport '
+        b'LXMF lxmf message title content fields timestamp hash '
+        b'the and you for that this with have will are from your was not can all '
+        b'CQ CQ CQ DE DE 73 73 '
+    )
+
+    def __init__(self, level=9, dictionary=PRESET_DICTIONARY):
+        self.level = level
+        self.dictionary = dictionary
+
+        # statistics
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0
+
+    # returns a preset dictionary of at most size bytes built from the segments shared by the most samples,
+    # most common last since deflate encodes nearer matches with shorter distances
+    @staticmethod
+    def train_dictionary(samples, size=1024, segment=8):
+        counts = collections.Counter()
+        first_seen = {}
+
+        for sample in samples:
+            # count each segment once per sample, so that a long sample does not dominate
+            segments = dict.fromkeys(sample[i:i + segment] for i in range(len(sample) - segment + 1))
+            counts.update(list(segments))
+            for data in segments:
+                first_seen.setdefault(data, len(first_seen))
+
+        # equally common segments in reverse order of appearance, so that overlapping segments are joined below
+        ranked = sorted(counts, key = lambda data: (counts[data], first_seen[data]), reverse = True)
+
+        dictionary = b''
+        for data in ranked:
+            if counts[data] < 2:
+                break
+
+            if data in dictionary:
+                continue
+
+            # join a segment overlapping the start of the dictionary, e.g. consecutive segments of a common string
+            candidate = data + dictionary
+            for overlap in range(segment - 1, 0, -1):
+                if dictionary.startswith(data[-overlap:]):
+                    candidate = data[:-overlap] + dictionary
+                    break
+
+            if len(candidate) > size:
+                break
+
+            dictionary = candidate
+
+        return dictionary
+
+    def ratio(self):
+        if self.bytes_in == 0:
+            return 1.0
+
+        return self.bytes_out / self.bytes_in
+
+    def compress(self, data):
+        start = time.process_time()
+        compressed = bytes([Compressor.METHOD_RAW]) + data
+
+        candidate = bytes([Compressor.METHOD_DEFLATE]) + self._deflate(data)
+        if len(candidate) < len(compressed):
+            compressed = candidate
+
+        if len(data) >= Compressor.LZMA_MIN_LENGTH:
+            candidate = bytes([Compressor.METHOD_LZMA]) + lzma.compress(data, format=lzma.FORMAT_RAW, filters=Compressor.LZMA_FILTERS)
+            if len(candidate) < len(compressed):
+                compressed = candidate
+
+        self.cpu_time += time.process_time() - start
+        self.bytes_in += len(data)
+        self.bytes_out += len(compressed)
+        return compressed
+
+    def decompress(self, data):
+        if len(data) == 0:
+            raise ValueError('Missing compression header')
+
+        method = data[0]
+
+        if method == Compressor.METHOD_RAW:
+            return bytes(data[1:])
+        elif method == Compressor.METHOD_DEFLATE:
+            return self._inflate(data[1:])
+        elif method == Compressor.METHOD_LZMA:
+            return lzma.decompress(data[1:], format=lzma.FORMAT_RAW, filters=Compressor.LZMA_FILTERS)
+        else:
+            raise ValueError('Unknown compression method {}'.format(method))
+
+    def _deflate(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=self.dictionary)
+        return compressor.compress(data) + compressor.flush()
+
+    def _inflate(self, data):
+        decompressor = zlib.decompressobj(-15, zdict=self.dictionary)
+        return decompressor.decompress(data) + decompressor.flush()
@@ -0,0 +1,258 @@
+# Forward error correction module
+#
+# Reed-Solomon coding over GF(2^8) applied to packed ALE packets before they are passed to the modem.
+# A single bit error otherwise causes the packet to be dropped, and the call or sounding is only retried
+# one scan window later.
+#
+# FEC frame format:
+#
+#   preamble (3) | data length (2) | inverted data length (2) | RS block | RS block | ...
+#
+# The data length gives the length of the frame to stream receivers (see frame_length), and is only used if it
+# matches the inverted copy. Frame based receivers decode the blocks of the whole frame.
+#
+# Each RS block holds up to (255 - nsym) bytes of the packed packet followed by nsym parity bytes, and can
+# correct up to nsym / 2 byte errors. The preamble is not protected, but is matched allowing one byte error
+# unless an exact match is required (e.g. where the frame could also be connected state data).
+
+
+import struct
+
+
+# GF(2^8) lookup tables, primitive polynomial x^8 + x^4 + x^3 + x^2 + 1
+_GF_EXP = [0] * 512
+_GF_LOG = [0] * 256
+
+_x = 1
+for _i in range(255):
+    _GF_EXP[_i] = _x
+    _GF_LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11d
+for _i in range(255, 512):
+    _GF_EXP[_i] = _GF_EXP[_i - 255]
+
+
+def _gf_mul(x, y):
+    if x == 0 or y == 0:
+        return 0
+    return _GF_EXP[_GF_LOG[x] + _GF_LOG[y]]
+
+def _gf_div(x, y):
+    if y == 0:
+        raise ZeroDivisionError()
+    if x == 0:
+        return 0
+    return _GF_EXP[(_GF_LOG[x] + 255 - _GF_LOG[y]) % 255]
+
+def _gf_pow(x, power):
+    return _GF_EXP[(_GF_LOG[x] * power) % 255]
+
+def _gf_inverse(x):
+    return _GF_EXP[255 - _GF_LOG[x]]
+
+def _poly_scale(p, x):
+    return [_gf_mul(p[i], x) for i in range(len(p))]
+
+def _poly_add(p, q):
+    r = [0] * max(len(p), len(q))
+    for i in range(len(p)):
+        r[i + len(r) - len(p)] = p[i]
+    for i in range(len(q)):
+        r[i + len(r) - len(q)] ^= q[i]
+    return r
+
+def _poly_mul(p, q):
+    r = [0] * (len(p) + len(q) - 1)
+    for j in range(len(q)):
+        for i in range(len(p)):
+            r[i + j] ^= _gf_mul(p[i], q[j])
+    return r
+
+def _poly_eval(p, x):
+    y = p[0]
+    for i in range(1, len(p)):
+        y = _gf_mul(y, x) ^ p[i]
+    return y
+
+
+class FEC:
+
+    PREAMBLE = b'ALF'
+    HEADER = struct.Struct('>HH')
+    BLOCK_SIZE = 255
+
+    def __init__(self, nsym=10):
+        if nsym < 2 or nsym >= FEC.BLOCK_SIZE:
+            raise ValueError('Invalid number of RS parity symbols')
+
+        self.nsym = nsym
+        self.generator = [1]
+        for i in range(nsym):
+            self.generator = _poly_mul(self.generator, [1, _gf_pow(2, i)])
+
+    @staticmethod
+    def is_fec(raw, exact=False):
+        preamble = FEC.PREAMBLE
+        if len(raw) < len(preamble):
+            return False
+
+        if exact:
+            return raw.startswith(preamble)
+
+        # allow a single corrupted preamble byte
+        mismatch = 0
+        for i in range(len(preamble)):
+            if raw[i] != preamble[i]:
+                mismatch += 1
+
+        return mismatch <= 1
+
+    # returns the frame length given the frame header at offset, None if the header is incomplete, raises
+    # ValueError if the header is corrupted
+    def frame_length(self, raw, offset=0):
+        offset += len(FEC.PREAMBLE)
+        if len(raw) < offset + FEC.HEADER.size:
+            return None
+
+        length, inverted_length = FEC.HEADER.unpack_from(raw, offset)
+        if length != inverted_length ^ 0xffff:
+            raise ValueError('Corrupted FEC header')
+
+        len_data = FEC.BLOCK_SIZE - self.nsym
+        num_blocks = (length + len_data - 1) // len_data
+        return offset + FEC.HEADER.size + length + (num_blocks * self.nsym)
+
+    def encode(self, raw):
+        blocks = [FEC.PREAMBLE, FEC.HEADER.pack(len(raw), len(raw) ^ 0xffff)]
+        len_data = FEC.BLOCK_SIZE - self.nsym
+
+        for i in range(0, len(raw), len_data):
+            blocks.append(self._encode_block(raw[i:i + len_data]))
+
+        return b''.join(blocks)
+
+    # returns a tuple of the decoded data and the number of corrected bytes, raises ValueError if uncorrectable
+    def decode(self, raw):
+        data = []
+        corrections = 0
+
+        for i in range(len(FEC.PREAMBLE) + FEC.HEADER.size, len(raw), FEC.BLOCK_SIZE):
+            block = raw[i:i + FEC.BLOCK_SIZE]
+            if len(block) <= self.nsym:
+                raise ValueError('Truncated FEC block')
+
+            block, corrected = self._decode_block(block)
+            data.append(block)
+            corrections += corrected
+
+        return (b''.join(data), corrections)
+
+    def _encode_block(self, data):
+        generator = self.generator
+        remainder = list(data) + [0] * self.nsym
+
+        # polynomial division by the generator, the remainder is the parity
+        for i in range(len(data)):
+            coef = remainder[i]
+            if coef != 0:
+                for j in range(1, len(generator)):
+                    remainder[i + j] ^= _gf_mul(generator[j], coef)
+
+        return bytes(data) + bytes(remainder[len(data):])
+
+    # syndromes are prefixed with a zero coefficient to simplify the decoding polynomial math
+    def _syndromes(self, block):
+        return [0] + [_poly_eval(block, _gf_pow(2, i)) for i in range(self.nsym)]
+
+    def _decode_block(self, block):
+        block = list(block)
+        len_data = len(block) - self.nsym
+        syndromes = self._syndromes(block)
+
+        if max(syndromes) == 0:
+            return (bytes(block[:len_data]), 0)
+
+        error_locator = self._error_locator(syndromes)
+        error_positions = self._error_positions(error_locator, len(block))
+        block = self._correct_errata(block, syndromes, error_positions)
+
+        if max(self._syndromes(block)) != 0:
+            raise ValueError('Uncorrectable FEC block')
+
+        return (bytes(block[:len_data]), len(error_positions))
+
+    # Berlekamp-Massey
+    def _error_locator(self, syndromes):
+        error_locator = [1]
+        old_locator = [1]
+
+        for i in range(1, self.nsym + 1):
+            old_locator.append(0)
+            delta = syndromes[i]
+            for j in range(1, len(error_locator)):
+                delta ^= _gf_mul(error_locator[-(j + 1)], syndromes[i - j])
+
+            if delta != 0:
+                if len(old_locator) > len(error_locator):
+                    new_locator = _poly_scale(old_locator, delta)
+                    old_locator = _poly_scale(error_locator, _gf_inverse(delta))
+                    error_locator = new_locator
+
+                error_locator = _poly_add(error_locator, _poly_scale(old_locator, delta))
+
+        while len(error_locator) > 0 and error_locator[0] == 0:
+            del error_locator[0]
+
+        if (len(error_locator) - 1) * 2 > self.nsym:
+            raise ValueError('Too many errors to correct')
+
+        return error_locator
+
+    # Chien search
+    def _error_positions(self, error_locator, len_block):
+        num_errors = len(error_locator) - 1
+        error_locator = error_locator[::-1]
+        positions = []
+
+        for i in range(len_block):
+            if _poly_eval(error_locator, _gf_pow(2, i)) == 0:
+                positions.append(len_block - 1 - i)
+
+        if len(positions) != num_errors:
+            raise ValueError('Could not locate errors')
+
+        return positions
+
+    # Forney algorithm
+    def _correct_errata(self, block, syndromes, error_positions):
+        coef_positions = [len(block) - 1 - p for p in error_positions]
+
+        errata_locator = [1]
+        for i in coef_positions:
+            errata_locator = _poly_mul(errata_locator, _poly_add([1], [_gf_pow(2, i), 0]))
+
+        # error evaluator polynomial
+        syndromes_reversed = syndromes[::-1]
+        evaluator = _poly_mul(syndromes_reversed, errata_locator)
+        evaluator = evaluator[len(evaluator) - len(errata_locator):]
+
+        locations = [_gf_pow(2, i) for i in coef_positions]
+        magnitudes = [0] * len(block)
+
+        for i, location in enumerate(locations):
+            location_inverse = _gf_inverse(location)
+
+            locator_prime = 1
+            for j in range(len(locations)):
+                if j != i:
+                    locator_prime = _gf_mul(locator_prime, 1 ^ _gf_mul(location_inverse, locations[j]))
+
+            if locator_prime == 0:
+                raise ValueError('Could not correct errors')
+
+            y = _gf_mul(_poly_eval(evaluator, location_inverse), location)
+            magnitudes[error_positions[i]] = _gf_div(y, locator_prime)
+
+        return [block[i] ^ magnitudes[i] for i in range(len(block))]
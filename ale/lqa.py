@@ -1,42 +1,591 @@
 import os
 import threading
 import time
-import random
+import collections
+import heapq
+import itertools
+import math
+import array
 import pickle
+import struct
+import zlib
 
 import ale
 
 #TODO
 # - test LQA time settings
 
+# Packet history is stored per channel and per (channel, origin address) in bounded deques ordered by
+# timestamp, so stale packets are always at the head and are expired lazily. Each deque has a matching
+# peak deque with decreasing confidence (sliding window maximum), so the max confidence of a channel or
+# address is at the head of the peak deque after expiry. Ranking channels costs O(channels).
+#
+# Each channel and (channel, address) key also keeps running aggregates updated as packets are stored: an
+# exponentially weighted mean confidence with a time constant of SOUND_WINDOW, the total packet count, and
+# the last heard time. With verify enabled the aggregates are cross-checked against a recompute over the
+# raw history whenever a channel is selected.
+#
+# Long-term propagation histograms keep the confidence sum and packet count per channel and per (channel,
+# address) for each hour of the week (UTC). When a channel has no packets within SOUND_WINDOW, best_channel
+# uses the historical mean for the current hour, scaled by PRIOR_WEIGHT, in place of recent confidence.
+#
+# Packets are stored from the receive thread while channel selection, reports and culling run on other
+# threads. Each LinkStats has its own lock held only for an update or a lazy expiry, and readers iterate
+# snapshots (copies of the dict items or the history deque), so a slow reader never blocks storing and
+# never sees a deque mutated mid-iteration. Stats entries are only added or evicted by the receive thread,
+# and a reader holding an evicted entry still sees a complete object.
+#
+# Expiry is scheduled on a min-heap keyed on the time the oldest packet of each stats entry leaves the
+# SOUND_WINDOW, with at most one live heap entry per stats entry. Due entries are expired as packets are
+# stored, in amortized O(log n), and readers still expire lazily. Memory is capped: each deque holds at
+# most MAX_HISTORY packets, and beyond MAX_KEYS (channel, address) entries or histograms the least
+# recently heard (or least used) EVICT_FRACTION are evicted at once. The packets held across the channel,
+# address and remote stats are counted as they are added and dropped, and beyond MAX_PACKETS the oldest
+# packets are evicted first, using the expiry heap, until EVICT_FRACTION of the budget is free. There is
+# no polling thread, the
+# history store is flushed and culled by tick, run from the ALE jobs loop at next_deadline. The expiry heap
+# is shared by the receive path and tick, and is guarded by the expiry lock.
+#
+# Sounding acks are counted in a sliding window index keyed by channel and destination. Only packets meeting
+# the minimum ack confidence are indexed, so should_ack_sound only expires the head of one deque. The index
+# of a channel is culled whenever the channel history is expired or evicted. The ack thresholds can be set
+# per scanlist, and the index is rebuilt from the channel history if the minimum confidence changes.
+#
+# Stations exchange LQA digests in the padding of call and sounding transmissions. A digest lists the best
+# first-hand (channel, address) observations of the sending station:
+#
+#   scanlist check (2) | address hash (2) | channel index (1) | confidence (1) | age (1) | ...
+#
+# The scanlist check is a hash of the channel names, so channel indices are only used if both stations share
+# the scanlist. The address hash is the short address hash (see ale.AddressTable), confidence is quantized in
+# steps of 1 / DIGEST_CONFIDENCE_SCALE, and age is in minutes. Received digests are stored as second-hand
+# observations, which are only used when there is no first-hand data and are weighted by REMOTE_WEIGHT.
+# An observation of one of our own addresses describes the link to the digest origin station.
+
+class PropagationHistogram:
+
+    BUCKETS = 7 * 24 # hour of week
+    MIN_SAMPLES = 3
+
+    def __init__(self, sums=None, counts=None):
+        if sums == None:
+            sums = [0.0] * PropagationHistogram.BUCKETS
+        if counts == None:
+            counts = [0] * PropagationHistogram.BUCKETS
+
+        self.sums = array.array('d', sums)
+        self.counts = array.array('L', counts)
+
+    @staticmethod
+    def bucket(timestamp):
+        utc = time.gmtime(timestamp)
+        return (utc.tm_wday * 24) + utc.tm_hour
+
+    def update(self, packet):
+        bucket = PropagationHistogram.bucket(packet.timestamp)
+        self.sums[bucket] += packet.confidence
+        self.counts[bucket] += 1
+
+    # mean confidence for the hour of week, or for the hour of day across the week if samples are sparse
+    def mean(self, timestamp):
+        bucket = PropagationHistogram.bucket(timestamp)
+
+        if self.counts[bucket] >= PropagationHistogram.MIN_SAMPLES:
+            return self.sums[bucket] / self.counts[bucket]
+
+        hour = bucket % 24
+        total = 0.0
+        count = 0
+        for day in range(7):
+            total += self.sums[(day * 24) + hour]
+            count += self.counts[(day * 24) + hour]
+
+        if count >= PropagationHistogram.MIN_SAMPLES:
+            return total / count
+
+        return 0.0
+
+    def to_tuple(self):
+        return (list(self.sums), list(self.counts))
+
+
+class LinkStats:
+
+    def __init__(self, lqa=None):
+        # held for updates and for lazy expiry on reads, only ever for O(1) amortized work
+        self.lock = threading.RLock()
+        # counts the packets held by all stats entries, see LQA.packet_count
+        self.lqa = lqa
+        self.history = collections.deque(maxlen = LQA.MAX_HISTORY)
+        # decreasing confidence, head is the window maximum
+        self.peaks = collections.deque()
+        self.mean = 0.0
+        self.weight = 0.0
+        self.total = 0
+        self.last_heard = 0
+
+    def update(self, packet):
+        with self.lock:
+            if len(self.history) > 0 and packet.timestamp < self.history[-1].timestamp:
+                self._insert(packet)
+                return None
+
+            # the oldest packet leaves the bounded history, and the peaks if it is the window maximum
+            if len(self.history) == self.history.maxlen:
+                if len(self.peaks) > 0 and self.peaks[0] is self.history[0]:
+                    self.peaks.popleft()
+            else:
+                self._count(1)
+
+            self.history.append(packet)
+            self._add_peak(packet)
+
+            # time decayed weights, older packets decay by exp(-age / SOUND_WINDOW)
+            age = max(packet.timestamp - self.last_heard, 0)
+            self.weight = (self.weight * math.exp(-age / LQA.SOUND_WINDOW)) + 1
+            self.mean += (packet.confidence - self.mean) / self.weight
+            self.total += 1
+            self.last_heard = max(self.last_heard, packet.timestamp)
+
+    def _add_peak(self, packet):
+        # packets with lower confidence than the new packet can no longer be the window maximum
+        while len(self.peaks) > 0 and self.peaks[-1].confidence <= packet.confidence:
+            self.peaks.pop()
+
+        self.peaks.append(packet)
+
+    # store a back-dated packet (e.g. a second-hand observation from a digest) in timestamp order, O(history)
+    def _insert(self, packet):
+        index = len(self.history)
+        while index > 0 and self.history[index - 1].timestamp > packet.timestamp:
+            index -= 1
+
+        if len(self.history) == self.history.maxlen:
+            # older than the whole bounded history
+            if index == 0:
+                return None
+
+            self.history.popleft()
+            index -= 1
+        else:
+            self._count(1)
+
+        self.history.insert(index, packet)
+
+        self.peaks.clear()
+        for history_packet in self.history:
+            self._add_peak(history_packet)
+
+        # the packet weight has already decayed by its age relative to the last heard packet
+        packet_weight = math.exp(-(self.last_heard - packet.timestamp) / LQA.SOUND_WINDOW)
+        self.weight += packet_weight
+        self.mean += packet_weight * (packet.confidence - self.mean) / self.weight
+        self.total += 1
+
+    def _count(self, count):
+        if self.lqa != None:
+            self.lqa._count_packets(count)
+
+    # drop stale packets from the head of the deques
+    def expire(self, current_time):
+        with self.lock:
+            length = len(self.history)
+
+            for packets in (self.history, self.peaks):
+                while len(packets) > 0 and current_time > (packets[0].timestamp + LQA.SOUND_WINDOW):
+                    packets.popleft()
+
+            self._count(len(self.history) - length)
+
+    # drop the oldest packet, and from the peaks if it is the window maximum
+    def evict_oldest(self):
+        with self.lock:
+            if len(self.history) == 0:
+                return None
+
+            if len(self.peaks) > 0 and self.peaks[0] is self.history[0]:
+                self.peaks.popleft()
+
+            self.history.popleft()
+            self._count(-1)
+
+    # stop counting the packets of an evicted entry, readers may still hold it
+    def detach(self):
+        with self.lock:
+            self._count(-len(self.history))
+            self.lqa = None
+
+    # time the oldest packet leaves the sound window, or None if there are no packets
+    def expiry(self):
+        with self.lock:
+            timestamps = [packets[0].timestamp for packets in (self.history, self.peaks) if len(packets) > 0]
+            if len(timestamps) == 0:
+                return None
+
+            return min(timestamps) + LQA.SOUND_WINDOW
+
+    # unexpired packets as a tuple, safe to iterate while packets are stored
+    def snapshot(self, current_time):
+        with self.lock:
+            self.expire(current_time)
+            return tuple(self.history)
+
+    def max(self, current_time):
+        with self.lock:
+            self.expire(current_time)
+
+            if len(self.peaks) == 0:
+                return 0.0
+
+            return self.peaks[0].confidence
+
+    def count(self, current_time):
+        with self.lock:
+            self.expire(current_time)
+            return len(self.history)
+
+    # weight of the mean at the current time, indicates how much recent data the mean is based on
+    def current_weight(self, current_time):
+        with self.lock:
+            return self.weight * math.exp(-max(current_time - self.last_heard, 0) / LQA.SOUND_WINDOW)
+
+    def report(self, current_time):
+        with self.lock:
+            return {
+                'mean': self.mean,
+                'weight': self.current_weight(current_time),
+                'max': self.max(current_time),
+                'count': self.count(current_time),
+                'total': self.total,
+                'last_heard': self.last_heard
+            }
+
+    # compare aggregates to a recompute over the raw history, returns a list of mismatched fields
+    def verify(self, current_time):
+        with self.lock:
+            history = self.snapshot(current_time)
+            max_peak = self.max(current_time)
+            total = self.total
+            mean = self.mean
+            weight = self.weight
+            last_heard = self.last_heard
+
+        mismatched = []
+
+        max_confidence = max([packet.confidence for packet in history], default = 0.0)
+        if max_confidence != max_peak:
+            mismatched.append('max')
+
+        if len(history) > 0 and max(packet.timestamp for packet in history) != last_heard:
+            mismatched.append('last_heard')
+
+        # the mean can only be recomputed if no packets have been expired or evicted
+        if total == len(history) and total > 0:
+            weight_sum = 0.0
+            confidence_sum = 0.0
+            for packet in history:
+                packet_weight = math.exp(-(last_heard - packet.timestamp) / LQA.SOUND_WINDOW)
+                weight_sum += packet_weight
+                confidence_sum += packet_weight * packet.confidence
+
+            if not math.isclose(confidence_sum / weight_sum, mean, rel_tol = 1e-6):
+                mismatched.append('mean')
+
+            if not math.isclose(weight_sum, weight, rel_tol = 1e-6):
+                mismatched.append('weight')
+
+        return mismatched
+
+
 class LQA:
     SOUND_WINDOW  = 60 * 60 # 60 minutes
-    MAX_HISTORY = 1000
+    MAX_HISTORY = 1000 # per channel or address
+    MAX_KEYS = 5000 # (channel, address) entries per stats table
+    MAX_PACKETS = 100000 # packets held across the channel, address and remote stats
+    EVICT_FRACTION = 0.1
+    FLUSH_INTERVAL = 1 # seconds
 
     SHOULD_ACK_MAX_PACKET_COUNT = 3
     SHOULD_ACK_MIN_CONFIDENCE = 1.7
+    SHOULD_ACK_WINDOW = 3 # scan windows
+
+    # weight of historical propagation data relative to recent confidence
+    PRIOR_WEIGHT = 0.8
+    # weight of second-hand observations from received digests relative to recent confidence
+    REMOTE_WEIGHT = 0.7
+
+    DIGEST_HEADER = struct.Struct('>H')
+    DIGEST_ENTRY = struct.Struct('>HBBB')
+    DIGEST_CONFIDENCE_SCALE = 50
 
     def __init__(self, owner):
         self.owner = owner
-        self.history = []
+        self.clock = owner.clock
+        # channel -> LinkStats
+        self.channel_stats = {}
+        # (channel, origin) -> LinkStats
+        self.address_stats = {}
+        # channel or (channel, address) -> LinkStats of second-hand observations from received digests
+        self.remote_stats = {}
+        # channel or (channel, origin) -> PropagationHistogram
+        self.histograms = {}
         self.next_sound = {}
-        self.next_history_cull_timestamp = time.time() + LQA.SOUND_WINDOW
-        self.history_path = os.path.join(self.owner.config_dir, 'lqa_history')
+        # channel -> destination -> deque of timestamps of strong packets within the ack window
+        self.ack_index = {}
+        self.ack_index_confidence = LQA.SHOULD_ACK_MIN_CONFIDENCE
+        self.ack_lock = threading.Lock()
+        self.verify = False
+        # forward error correction statistics per channel: [fec packets, corrected bytes]
+        self.fec_stats = {}
+        # (expiry timestamp, sequence, stats table, key), see _schedule_expiry
+        self.expiry_heap = []
+        self.expiry_scheduled = set()
+        self.expiry_sequence = itertools.count()
+        self.expiry_lock = threading.RLock()
+        # packets held across the channel, address and remote stats, see MAX_PACKETS
+        self.packet_count = 0
+        self.packet_lock = threading.Lock()
+        self.next_history_cull_timestamp = self.clock.time() + LQA.SOUND_WINDOW
+        self.next_flush_timestamp = self.clock.time() + LQA.FLUSH_INTERVAL
+        # packets were appended to the history store since the last flush
+        self.flush_pending = False
+
+        if self.owner.lqa_backend == 'sqlite':
+            self.history_path = os.path.join(self.owner.config_dir, 'lqa_history.db')
+            self.backend = ale.SQLiteHistoryStore(self.history_path, self.clock)
+        elif self.owner.lqa_backend == 'journal':
+            self.history_path = os.path.join(self.owner.config_dir, 'lqa_journal')
+            self.backend = ale.JournalHistoryStore(self.history_path)
+        else:
+            self.history_path = os.path.join(self.owner.config_dir, 'lqa_history')
+            self.backend = ale.PickleHistoryStore(self.history_path)
+
+        self.histogram_path = os.path.join(self.owner.config_dir, 'lqa_histogram')
+
+        # outgoing call channel selection
+        if self.owner.channel_selection == 'thompson':
+            self.selector = ale.ThompsonSelector(self)
+        else:
+            self.selector = ale.GreedySelector(self)
 
-        if os.path.exists(self.history_path):
-            self.load_history()
+        self.load_histograms()
+        self.load_history()
 
         for channel in self.owner.channels.keys():
             self.set_next_sounding(channel)
 
-        thread = threading.Thread(target=self._jobs)
-        thread.setDaemon = True
-        thread.start()
-
     def store(self, packet):
-        self.history.append(packet)
+        current_time = self.clock.time()
+        # stored packets must not pin the received buffer
+        packet.materialize()
+        self._update(packet)
+        self.backend.append(packet)
+
+        for key in (packet.channel, (packet.channel, packet.origin)):
+            if key not in self.histograms:
+                if len(self.histograms) >= LQA.MAX_KEYS:
+                    self._evict_histograms()
+
+                self.histograms[key] = PropagationHistogram()
+
+            self.histograms[key].update(packet)
+
+        self.flush_pending = True
+        self._expire_due(current_time)
+
+    # time of the next tick with work to do, see ale.Scheduler
+    def next_deadline(self):
+        deadlines = [self.next_history_cull_timestamp]
+
+        if self.flush_pending:
+            deadlines.append(self.next_flush_timestamp)
+
+        with self.expiry_lock:
+            if len(self.expiry_heap) > 0:
+                deadlines.append(self.expiry_heap[0][0])
+
+        return min(deadlines)
+
+    # expire stats, and flush and cull the history store when due
+    def tick(self):
+        current_time = self.clock.time()
+        self._expire_due(current_time)
+
+        if self.flush_pending and current_time > self.next_flush_timestamp:
+            self.flush_pending = False
+            self.backend.flush()
+            self.next_flush_timestamp = current_time + LQA.FLUSH_INTERVAL
+
+        if current_time > self.next_history_cull_timestamp:
+            self._cull_history()
+
+    def _update(self, packet):
+        self._store(self.channel_stats, packet.channel, packet)
+        self._store(self.address_stats, (packet.channel, packet.origin), packet)
+        self._index_ack(packet)
         self.set_next_sounding(packet.channel)
 
+        if packet.corrections > 0:
+            if packet.channel not in self.fec_stats:
+                self.fec_stats[packet.channel] = [0, 0]
+
+            self.fec_stats[packet.channel][0] += 1
+            self.fec_stats[packet.channel][1] += packet.corrections
+
+    def _store(self, stats, key, packet):
+        # only the receive path creates entries, readers see either no entry or a complete one
+        link_stats = stats.get(key)
+        if link_stats == None:
+            if len(stats) >= LQA.MAX_KEYS:
+                self._evict_stats(stats)
+
+            link_stats = LinkStats(self)
+            stats[key] = link_stats
+
+        link_stats.update(packet)
+        self._schedule_expiry(stats, key, link_stats)
+
+        if self.packet_count > LQA.MAX_PACKETS:
+            self._evict_packets()
+
+    def _count_packets(self, count):
+        with self.packet_lock:
+            self.packet_count += count
+
+    def _schedule_expiry(self, stats, key, link_stats):
+        with self.expiry_lock:
+            if (id(stats), key) in self.expiry_scheduled:
+                return None
+
+            expiry = link_stats.expiry()
+            if expiry != None:
+                heapq.heappush(self.expiry_heap, (expiry, next(self.expiry_sequence), stats, key))
+                self.expiry_scheduled.add((id(stats), key))
+
+    # expire stats entries whose oldest packet has left the sound window, and reschedule them
+    def _expire_due(self, current_time):
+        with self.expiry_lock:
+            while len(self.expiry_heap) > 0 and current_time > self.expiry_heap[0][0]:
+                expiry, sequence, stats, key = heapq.heappop(self.expiry_heap)
+                self.expiry_scheduled.discard((id(stats), key))
+
+                # entry was evicted
+                link_stats = stats.get(key)
+                if link_stats == None:
+                    continue
+
+                link_stats.expire(current_time)
+                self._schedule_expiry(stats, key, link_stats)
+
+                if stats is self.channel_stats:
+                    self._cull_ack_channel(key, current_time)
+
+    # evict the oldest packets across the stats tables until EVICT_FRACTION of the packet budget is free
+    def _evict_packets(self):
+        current_time = self.clock.time()
+        max_packets = int(LQA.MAX_PACKETS * (1 - LQA.EVICT_FRACTION))
+        channels = set()
+
+        with self.expiry_lock:
+            # the heap head is the entry with the oldest packet
+            while self.packet_count > max_packets and len(self.expiry_heap) > 0:
+                expiry, sequence, stats, key = heapq.heappop(self.expiry_heap)
+                self.expiry_scheduled.discard((id(stats), key))
+
+                # entry was evicted
+                link_stats = stats.get(key)
+                if link_stats == None:
+                    continue
+
+                # readers expired packets since the entry was scheduled, so its oldest packet is newer
+                if link_stats.expiry() == expiry:
+                    link_stats.evict_oldest()
+                    if stats is self.channel_stats:
+                        channels.add(key)
+
+                self._schedule_expiry(stats, key, link_stats)
+
+        for channel in channels:
+            self._cull_ack_channel(channel, current_time)
+
+    # evict the least recently heard (channel, address) entries, channel entries are never evicted
+    def _evict_stats(self, stats):
+        keys = [key for key in list(stats.keys()) if isinstance(key, tuple)]
+        keys.sort(key = lambda key: stats[key].last_heard)
+
+        with self.expiry_lock:
+            for key in keys[:int(LQA.MAX_KEYS * LQA.EVICT_FRACTION)]:
+                stats.pop(key).detach()
+                # a stale heap entry is skipped when it is due
+                self.expiry_scheduled.discard((id(stats), key))
+
+    # evict the (channel, address) histograms with the fewest packets
+    def _evict_histograms(self):
+        keys = [key for key in list(self.histograms.keys()) if isinstance(key, tuple)]
+        keys.sort(key = lambda key: sum(self.histograms[key].counts))
+
+        for key in keys[:int(LQA.MAX_KEYS * LQA.EVICT_FRACTION)]:
+            del self.histograms[key]
+
+    def _max_confidence(self, stats, key, current_time):
+        link_stats = stats.get(key)
+        if link_stats == None:
+            return 0.0
+
+        return link_stats.max(current_time)
+
+    # recent max confidence, or weighted second-hand confidence or historical mean for the current hour if there is no recent data
+    def _blended_confidence(self, stats, key, current_time):
+        confidence = self._max_confidence(stats, key, current_time)
+
+        if confidence == 0.0:
+            confidence = self._max_confidence(self.remote_stats, key, current_time) * LQA.REMOTE_WEIGHT
+
+        if confidence == 0.0:
+            # single lookup, the histogram can be evicted by the receive thread
+            histogram = self.histograms.get(key)
+            if histogram != None:
+                confidence = histogram.mean(current_time) * LQA.PRIOR_WEIGHT
+
+        return confidence
+
+    # all unexpired packets by default, or history after since, ordered by timestamp
+    def packets(self, since=None):
+        current_time = self.clock.time()
+        packets = []
+
+        for stats in list(self.channel_stats.values()):
+            packets.extend(stats.snapshot(current_time))
+
+        packets.sort(key = lambda packet: packet.timestamp)
+
+        if since == None:
+            return packets
+
+        if self.backend.complete:
+            self.backend.flush()
+            entries = self.backend.load(since)
+            packets = []
+        else:
+            # the history store only holds the history saved on the last shutdown, which is merged with the
+            # unexpired packets (including those loaded from the store on startup)
+            first_timestamp = packets[0].timestamp if len(packets) > 0 else None
+            entries = [entry for entry in self.backend.load(since) if first_timestamp == None or entry['timestamp'] < first_timestamp]
+            packets = [packet for packet in packets if packet.timestamp > since]
+
+        history = []
+        for entry in entries:
+            packet = ale.Packet()
+            packet.from_dict(entry)
+            history.append(packet)
+
+        return history + packets
+
+    # columnar view of history for batch analytics (requires numpy), see ale.LQAArrays
+    # unexpired packets by default, or history after since, see packets
+    def to_arrays(self, since=None):
+        return ale.LQAArrays.from_packets(self.packets(since), self.owner.channels.keys())
+
     def best_channel(self, address=None, exclude=None):
         max_channel_confidence = 0.0
         max_address_confidence = 0.0
@@ -49,128 +598,287 @@ class LQA:
         elif isinstance(exclude, str):
             exclude_channels.append(exclude)
 
-        current_time = time.time()
-        for i in range(len(self.history)):
-            packet = self.history.pop(0)
+        current_time = self.clock.time()
 
-            # discard the packet if stale
-            if current_time > (packet.timestamp + LQA.SOUND_WINDOW):
-                continue
-            
-            self.history.append(packet)
+        if self.verify:
+            self.verify_stats()
 
-            # skip the packet if excluding associated channel
-            if packet.channel in exclude_channels:
+        for channel in list(self.owner.channels.keys()):
+            # skip excluded channels
+            if channel in exclude_channels:
                 continue
-            
-            if address != None and packet.origin == address and packet.confidence > max_address_confidence:
-                max_address_confidence = packet.confidence
-                best_by_address = packet.channel
-            elif packet.confidence > max_channel_confidence:
-                max_channel_confidence = packet.confidence
-                best_by_channel = packet.channel
-            
+
+            channel_confidence = self._blended_confidence(self.channel_stats, channel, current_time)
+            if channel_confidence > max_channel_confidence:
+                max_channel_confidence = channel_confidence
+                best_by_channel = channel
+
+            if address != None:
+                address_confidence = self._blended_confidence(self.address_stats, (channel, address), current_time)
+                if address_confidence > max_address_confidence:
+                    max_address_confidence = address_confidence
+                    best_by_address = channel
+
         # use address-specific confidence if it is at least 90% of channel confidence
         # ensures use of best channel even if an address is specified
-        if address != None and max_address_confidence >= (max_channel_confidence * 0.9):
+        if address != None and best_by_address != None and max_address_confidence >= (max_channel_confidence * 0.9):
             best_by_channel = best_by_address
 
         # if history is empty, return the next unexcluded channel
         if best_by_channel == None:
             channels = list(self.owner.channels.keys())
-            for i in range(len(channels)):
-                channel = channels.pop(0)
+            for channel in channels:
                 if channel not in exclude_channels:
-                    channels.append(channel)
+                    return channel
 
             return channels[0]
 
         else:
             return best_by_channel
-            
+
+    # max confidence of recent packets from an address on a channel
+    def link_confidence(self, channel, address):
+        return self._max_confidence(self.address_stats, (channel, address), self.clock.time())
+
+    def channel_report(self):
+        current_time = self.clock.time()
+        return {channel: stats.report(current_time) for channel, stats in list(self.channel_stats.items())}
+
+    def address_report(self, address):
+        current_time = self.clock.time()
+        report = {}
+
+        for channel in list(self.channel_stats.keys()):
+            stats = self.address_stats.get((channel, address))
+            if stats != None:
+                report[channel] = stats.report(current_time)
+
+        return report
+
+    # cross-check running aggregates against the raw history, mismatches are logged
+    def verify_stats(self):
+        current_time = self.clock.time()
+        verified = True
+
+        for stats_type, stats in (('channel', self.channel_stats), ('address', self.address_stats), ('remote', self.remote_stats)):
+            for key, link_stats in list(stats.items()):
+                mismatched = link_stats.verify(current_time)
+                if len(mismatched) > 0:
+                    verified = False
+                    self.owner.log('LQA ' + stats_type + ' aggregates for ' + str(key) + ' do not match history: ' + ', '.join(mismatched))
+
+        return verified
+
+    # hash of the current scanlist channel names, digests are only merged between stations sharing a scanlist
+    def _scanlist_check(self):
+        return zlib.crc32(','.join(self.owner.channels.keys()).encode('utf-8')) & 0xffff
+
+    # digest of the best first-hand (channel, address) observations, at most max_length bytes
+    def digest(self, max_length):
+        max_entries = (max_length - LQA.DIGEST_HEADER.size) // LQA.DIGEST_ENTRY.size
+        if max_entries <= 0:
+            return b''
+
+        current_time = self.clock.time()
+        channels = list(self.owner.channels.keys())
+        observations = []
+
+        for (channel, address), stats in list(self.address_stats.items()):
+            if channel not in channels:
+                continue
+
+            confidence = stats.max(current_time)
+            if confidence > 0.0:
+                observations.append((confidence, channel, address, stats.last_heard))
+
+        observations.sort(key = lambda observation: observation[0], reverse = True)
+        if len(observations) == 0:
+            return b''
+
+        digest = [LQA.DIGEST_HEADER.pack(self._scanlist_check())]
+        for confidence, channel, address, last_heard in observations[:max_entries]:
+            address_hash = zlib.crc32(address) & 0xffff
+            quantized_confidence = min(int(round(confidence * LQA.DIGEST_CONFIDENCE_SCALE)), 255)
+            age = min(int(max(current_time - last_heard, 0) // 60), 255)
+            digest.append(LQA.DIGEST_ENTRY.pack(address_hash, channels.index(channel), quantized_confidence, age))
+
+        return b''.join(digest)
+
+    # store the observations in a digest received from the origin station as second-hand observations
+    def merge_digest(self, origin, digest):
+        if len(digest) < LQA.DIGEST_HEADER.size or LQA.DIGEST_HEADER.unpack_from(digest)[0] != self._scanlist_check():
+            return None
+
+        current_time = self.clock.time()
+        channels = list(self.owner.channels.keys())
+        entries = digest[LQA.DIGEST_HEADER.size:]
+
+        for i in range(len(entries) // LQA.DIGEST_ENTRY.size):
+            address_hash, channel_index, quantized_confidence, age = LQA.DIGEST_ENTRY.unpack_from(entries, i * LQA.DIGEST_ENTRY.size)
+            if channel_index >= len(channels):
+                continue
+
+            address = self.owner.address_table.resolve(ale.AddressTable.SHORT_PREFIX + b'%04x' % address_hash)
+            if address in self.owner.addresses:
+                # the origin station heard us, so the link to the origin station is usable
+                address = origin
+
+            packet = ale.Packet(origin, address, b'')
+            packet.channel = channels[channel_index]
+            packet.confidence = quantized_confidence / LQA.DIGEST_CONFIDENCE_SCALE
+            packet.timestamp = current_time - (age * 60)
+
+            self._store(self.remote_stats, packet.channel, packet)
+            # unknown or colliding address hashes are only used for channel quality
+            if address != None:
+                self._store(self.remote_stats, (packet.channel, address), packet)
+
+        self._expire_due(current_time)
+
     def channel_stale(self, channel):
-        if channel in self.owner.channels.keys() and time.time() > self.next_sound[channel]:
+        if channel in self.owner.channels.keys() and self.clock.time() > self.next_sound[channel]:
                 return True
 
         return False
 
     def set_next_sounding(self, channel):
-        random_interval = random.randint(0, 15) * 60 # 0-15 minutes
-        self.next_sound[channel] = time.time() + LQA.SOUND_WINDOW + random_interval    
+        random_interval = self.owner.random.randint(0, 15) * 60 # 0-15 minutes
+        self.next_sound[channel] = self.clock.time() + LQA.SOUND_WINDOW + random_interval
+
+    # (max packet count, min confidence) for the current scanlist
+    def ack_thresholds(self):
+        thresholds = self.owner.ack_thresholds.get(self.owner.scanlist, {})
+        max_packet_count = thresholds.get('max_packet_count', LQA.SHOULD_ACK_MAX_PACKET_COUNT)
+        min_confidence = thresholds.get('min_confidence', LQA.SHOULD_ACK_MIN_CONFIDENCE)
+        return (max_packet_count, min_confidence)
+
+    def _index_ack(self, packet):
+        with self.ack_lock:
+            if packet.confidence < self.ack_index_confidence:
+                return None
+
+            if packet.channel not in self.ack_index:
+                self.ack_index[packet.channel] = {}
+
+            destinations = self.ack_index[packet.channel]
+            if packet.destination not in destinations:
+                destinations[packet.destination] = collections.deque()
+
+            destinations[packet.destination].append(packet.timestamp)
+            self._expire_acks(destinations[packet.destination], packet.timestamp)
+
+    # rebuild the ack index from the channel history after the min confidence threshold changes
+    def _rebuild_ack_index(self, min_confidence, current_time):
+        packets = []
+        for stats in list(self.channel_stats.values()):
+            packets.extend(stats.snapshot(current_time))
+
+        packets.sort(key = lambda packet: packet.timestamp)
+
+        with self.ack_lock:
+            self.ack_index.clear()
+            self.ack_index_confidence = min_confidence
+
+        for packet in packets:
+            self._index_ack(packet)
+
+    def _expire_acks(self, timestamps, current_time):
+        ack_window = ale.ALE.SCAN_WINDOW * LQA.SHOULD_ACK_WINDOW
+        while len(timestamps) > 0 and current_time > (timestamps[0] + ack_window):
+            timestamps.popleft()
 
     # avoid congestion by not ack-ing a sounding if other strong stations already ack-ed
     def should_ack_sound(self, channel, sound_origin):
-        packet_count = 0
-        current_time = time.time()
+        current_time = self.clock.time()
+        max_packet_count, min_confidence = self.ack_thresholds()
 
-        # start at the end for most recent packets
-        for i in range(len(self.history)):
-            packet = self.history.pop()
+        if min_confidence != self.ack_index_confidence:
+            self._rebuild_ack_index(min_confidence, current_time)
 
-            # drop stale packets, because why not
-            if current_time > packet.timestamp + LQA.SOUND_WINDOW:
-                continue
+        with self.ack_lock:
+            timestamps = self.ack_index.get(channel, {}).get(sound_origin)
+            if timestamps == None:
+                return True
 
-            # if packet matches channel, sounding origin, minimum confidence, and maximum age
-            packet_stale_timestamp = packet.timestamp + self.owner.sound_timeout
-            if (
-                packet.channel == channel and
-                packet.destination == sound_origin and
-                packet.confidence >= LQA.SHOULD_ACK_MIN_CONFIDENCE and
-                #TODO validate timing
-                current_time < (packet.timestamp + (ale.ALE.SCAN_WINDOW * 3))
-            ):
-                packet_count += 1
-
-            self.history.insert(0, packet)
-            
-        if packet_count > LQA.SHOULD_ACK_MAX_PACKET_COUNT:
+            self._expire_acks(timestamps, current_time)
+            packet_count = len(timestamps)
+
+        if packet_count > max_packet_count:
             return False
         else:
             return True
 
+    def _cull_ack_index(self, current_time):
+        for channel in list(self.ack_index.keys()):
+            self._cull_ack_channel(channel, current_time)
+
+    def _cull_ack_channel(self, channel, current_time):
+        with self.ack_lock:
+            destinations = self.ack_index.get(channel)
+            if destinations == None:
+                return None
+
+            for destination in list(destinations.keys()):
+                self._expire_acks(destinations[destination], current_time)
+                if len(destinations[destination]) == 0:
+                    del destinations[destination]
+
+            if len(destinations) == 0:
+                del self.ack_index[channel]
+
     def save_history(self):
-        history = []
+        try:
+            self.backend.save(self.packets())
+        except:
+            pass
+
+        self.save_histograms()
 
+    def save_histograms(self):
         try:
-            for packet in self.history:
-                history.append(packet.to_dict())
-            
-            with open(self.history_path, 'wb') as fd:
-                pickle.dump(history, fd)
+            histograms = {key: histogram.to_tuple() for key, histogram in list(self.histograms.items())}
+
+            with open(self.histogram_path, 'wb') as fd:
+                pickle.dump(histograms, fd)
+
+        except:
+            return None
+
+    def load_histograms(self):
+        if not os.path.exists(self.histogram_path):
+            return None
+
+        try:
+            with open(self.histogram_path, 'rb') as fd:
+                histograms = pickle.load(fd)
+
+            for key, (sums, counts) in histograms.items():
+                self.histograms[key] = PropagationHistogram(sums, counts)
 
         except:
             return None
 
     def load_history(self):
         try:
-            with open(self.history_path, 'rb') as fd:
-                history = pickle.load(fd)
-    
-            for entry in history:
+            # history is ordered by timestamp
+            for entry in self.backend.load(self.clock.time() - LQA.SOUND_WINDOW):
                 packet = ale.Packet()
                 packet.from_dict(entry)
-                self.history.append(packet)
-    
+                self._update(packet)
+
             self._cull_history()
 
         except:
             return None
-    
-    def _cull_history(self):
-        current_time = time.time()
 
-        for i in range(len(self.history)):
-            packet = self.history.pop(0)
-            if current_time < (packet.timestamp + LQA.SOUND_WINDOW) and i < LQA.MAX_HISTORY:
-                self.history.append(packet)
-        
-            self.next_history_cull_timestamp = current_time + LQA.SOUND_WINDOW
+    # stats are expired as packets are stored and on tick, the history store and ack index are culled once per sound window
+    def _cull_history(self):
+        current_time = self.clock.time()
 
-    def _jobs(self):
-        while self.owner.online:
-            if time.time() > self.next_history_cull_timestamp:
-                self._cull_history()
+        self._expire_due(current_time)
+        self._cull_ack_index(current_time)
+        self.backend.cull(current_time - LQA.SOUND_WINDOW)
+        self.save_histograms()
 
-            time.sleep(1)
+        self.next_history_cull_timestamp = current_time + LQA.SOUND_WINDOW
 
@@ -0,0 +1,376 @@
+# LQA history storage module
+#
+# Classes:
+#   PickleHistoryStore
+#   SQLiteHistoryStore
+#   JournalHistoryStore
+#
+# History stores persist received packets for the LQA object. Packets are exchanged as packet dicts
+# (see ale.Packet.to_dict). All stores implement:
+#
+#   load(since)     list of packet dicts with a timestamp after since, ordered by timestamp
+#   append(packet)  persist a received packet
+#   save(packets)   persist the given packets on shutdown
+#   flush()         write any pending packets
+#   cull(before)    delete packets with a timestamp before the given time
+#   close()
+#
+# and the attribute:
+#
+#   complete        True if every appended packet is persisted, so load(since) returns all history since
+
+import os
+import json
+import mmap
+import zlib
+import struct
+import pickle
+import sqlite3
+import threading
+
+import ale
+
+
+class PickleHistoryStore:
+    """
+    Pickle file history store
+
+    The full history is written on shutdown only, packets received since the last save are lost on an
+    unclean shutdown.
+    """
+
+    complete = False
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, since):
+        if not os.path.exists(self.path):
+            return []
+
+        with open(self.path, 'rb') as fd:
+            history = pickle.load(fd)
+
+        history = [entry for entry in history if entry['timestamp'] > since]
+        history.sort(key = lambda entry: entry['timestamp'])
+        return history
+
+    def append(self, packet):
+        pass
+
+    def save(self, packets):
+        history = [packet.to_dict() for packet in packets]
+
+        with open(self.path, 'wb') as fd:
+            pickle.dump(history, fd)
+
+    def flush(self):
+        pass
+
+    def cull(self, before):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteHistoryStore:
+    """
+    SQLite database history store
+
+    Packets are inserted in batches as they are received, and the database is used in WAL mode so that
+    queries do not block inserts. History is kept for RETENTION seconds so that longer term queries can
+    run against the database without loading the history into memory. Rows that can't be decoded (e.g. a
+    corrupted address) are skipped on load.
+    """
+
+    BATCH_SIZE = 50
+    RETENTION = 30 * 24 * 60 * 60 # 30 days
+
+    complete = True
+
+    def __init__(self, path, clock=None):
+        self.path = path
+        # retention is measured on the owner clock, see ale.Clock
+        self.clock = clock if clock != None else ale.Clock()
+        self.pending = []
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS packets ('
+            'timestamp REAL NOT NULL, '
+            'channel TEXT, '
+            'origin BLOB, '
+            'destination BLOB, '
+            'command BLOB, '
+            'confidence REAL, '
+            'corrections INTEGER DEFAULT 0)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS packets_channel_timestamp ON packets (channel, timestamp)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS packets_origin_timestamp ON packets (origin, timestamp)')
+        self.db.commit()
+
+    def load(self, since):
+        self.flush()
+
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT timestamp, channel, origin, destination, command, confidence, corrections '
+                'FROM packets WHERE timestamp > ? ORDER BY timestamp', (since,)
+            ).fetchall()
+
+        history = []
+        for timestamp, channel, origin, destination, command, confidence, corrections in rows:
+            try:
+                entry = {
+                    'timestamp': timestamp,
+                    'channel': channel,
+                    'origin': bytes(origin).decode('utf-8'),
+                    'destination': bytes(destination).decode('utf-8'),
+                    'command': bytes(command).decode('utf-8'),
+                    'data': '',
+                    'confidence': confidence,
+                    'corrections': corrections
+                }
+            except (TypeError, UnicodeDecodeError):
+                continue
+
+            history.append(entry)
+
+        return history
+
+    def append(self, packet):
+        row = (packet.timestamp, packet.channel, packet.origin, packet.destination, packet.command, packet.confidence, packet.corrections)
+
+        with self.lock:
+            self.pending.append(row)
+            flush = len(self.pending) >= SQLiteHistoryStore.BATCH_SIZE
+
+        if flush:
+            self.flush()
+
+    # packets are already stored as they are received
+    def save(self, packets):
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            if len(self.pending) == 0:
+                return None
+
+            self.db.executemany('INSERT INTO packets VALUES (?, ?, ?, ?, ?, ?, ?)', self.pending)
+            self.db.commit()
+            self.pending.clear()
+
+    # history older than the retention period is deleted, regardless of the LQA sounding window
+    def cull(self, before):
+        before = min(before, self.clock.time() - SQLiteHistoryStore.RETENTION)
+
+        with self.lock:
+            self.db.execute('DELETE FROM packets WHERE timestamp < ?', (before,))
+            self.db.commit()
+
+    def close(self):
+        self.flush()
+
+        with self.lock:
+            self.db.close()
+
+    # returns (channel, max confidence) for the address since the given time, or None
+    def best_channel_for_address(self, address, since, exclude=None):
+        self.flush()
+
+        query = 'SELECT channel, MAX(confidence) FROM packets WHERE origin = ? AND timestamp > ?'
+        params = [address, since]
+
+        if exclude != None and len(exclude) > 0:
+            query += ' AND channel NOT IN (' + ', '.join('?' * len(exclude)) + ')'
+            params.extend(exclude)
+
+        query += ' GROUP BY channel ORDER BY MAX(confidence) DESC LIMIT 1'
+
+        with self.lock:
+            return self.db.execute(query, params).fetchone()
+
+    # returns a list of (channel, packet count, mean confidence, max confidence) since the given time
+    def channel_summary(self, since):
+        self.flush()
+
+        with self.lock:
+            return self.db.execute(
+                'SELECT channel, COUNT(*), AVG(confidence), MAX(confidence) FROM packets '
+                'WHERE timestamp > ? GROUP BY channel ORDER BY MAX(confidence) DESC', (since,)
+            ).fetchall()
+
+
+class JournalHistoryStore:
+    """
+    Append-only binary journal history store
+
+    Packets are appended to the journal as fixed width records as they are received, so history survives
+    an unclean shutdown (a partially written trailing record is discarded). Channel names and origin
+    addresses are stored as indexes and hashes, resolved by a small name table file next to the journal.
+    Loading memory-maps the journal and binary searches for the first record in the requested time range,
+    so startup cost does not depend on the journal size. The journal is compacted when more than half of
+    the records are culled.
+
+    Record: timestamp (8) | channel index (2) | origin hash (4) | confidence (4) | command (2)
+    """
+
+    RECORD = struct.Struct('<dHIf2s')
+
+    complete = True
+
+    def __init__(self, path):
+        self.path = path
+        self.names_path = path + '.names'
+        self.lock = threading.Lock()
+
+        self.channels = []
+        self.addresses = {}
+        if os.path.exists(self.names_path):
+            with open(self.names_path, 'r') as fd:
+                names = json.load(fd)
+            self.channels = names['channels']
+            self.addresses = {int(origin_hash): address for origin_hash, address in names['addresses'].items()}
+
+        # discard a partially written record
+        if os.path.exists(self.path):
+            size = os.path.getsize(self.path)
+            if size % JournalHistoryStore.RECORD.size != 0:
+                with open(self.path, 'r+b') as fd:
+                    fd.truncate(size - (size % JournalHistoryStore.RECORD.size))
+
+        self.fd = open(self.path, 'ab', buffering = 0)
+
+    def _save_names(self):
+        names = {
+            'channels': self.channels,
+            'addresses': {str(origin_hash): address for origin_hash, address in self.addresses.items()}
+        }
+
+        with open(self.names_path + '.tmp', 'w') as fd:
+            json.dump(names, fd)
+
+        os.replace(self.names_path + '.tmp', self.names_path)
+
+    def _first_record(self, journal, num_records, since):
+        # records are appended in time order, binary search for the first record after since
+        low = 0
+        high = num_records
+        while low < high:
+            middle = (low + high) // 2
+            timestamp = struct.unpack_from('<d', journal, middle * JournalHistoryStore.RECORD.size)[0]
+            if timestamp > since:
+                high = middle
+            else:
+                low = middle + 1
+
+        return low
+
+    def load(self, since):
+        history = []
+
+        with self.lock:
+            size = os.path.getsize(self.path)
+            num_records = size // JournalHistoryStore.RECORD.size
+            if num_records == 0:
+                return history
+
+            with open(self.path, 'rb') as fd:
+                journal = mmap.mmap(fd.fileno(), num_records * JournalHistoryStore.RECORD.size, access = mmap.ACCESS_READ)
+
+            try:
+                first = self._first_record(journal, num_records, since)
+                for record in JournalHistoryStore.RECORD.iter_unpack(journal[first * JournalHistoryStore.RECORD.size:]):
+                    timestamp, channel_index, origin_hash, confidence, command = record
+
+                    if channel_index >= len(self.channels) or origin_hash not in self.addresses:
+                        continue
+
+                    history.append({
+                        'timestamp': timestamp,
+                        'channel': self.channels[channel_index],
+                        'origin': self.addresses[origin_hash],
+                        'destination': '',
+                        'command': command.decode('utf-8'),
+                        'data': '',
+                        'confidence': confidence,
+                        'corrections': 0
+                    })
+            finally:
+                journal.close()
+
+        return history
+
+    def append(self, packet):
+        origin_hash = zlib.crc32(packet.origin)
+
+        # packet dicts hold utf-8 addresses, a packet with a corrupted origin address is not journaled
+        try:
+            origin = packet.origin.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+
+        with self.lock:
+            names_changed = False
+
+            if packet.channel not in self.channels:
+                self.channels.append(packet.channel)
+                names_changed = True
+
+            if origin_hash not in self.addresses:
+                self.addresses[origin_hash] = origin
+                names_changed = True
+
+            if names_changed:
+                self._save_names()
+
+            record = JournalHistoryStore.RECORD.pack(
+                packet.timestamp,
+                self.channels.index(packet.channel),
+                origin_hash,
+                packet.confidence,
+                packet.command[:2]
+            )
+            self.fd.write(record)
+
+    # packets are already stored as they are received
+    def save(self, packets):
+        pass
+
+    def flush(self):
+        pass
+
+    def cull(self, before):
+        with self.lock:
+            size = os.path.getsize(self.path)
+            num_records = size // JournalHistoryStore.RECORD.size
+            if num_records == 0:
+                return None
+
+            with open(self.path, 'rb') as fd:
+                journal = mmap.mmap(fd.fileno(), num_records * JournalHistoryStore.RECORD.size, access = mmap.ACCESS_READ)
+
+            try:
+                first = self._first_record(journal, num_records, before)
+
+                # compact once more than half of the journal is stale
+                if first * 2 <= num_records:
+                    return None
+
+                with open(self.path + '.tmp', 'wb') as fd:
+                    fd.write(journal[first * JournalHistoryStore.RECORD.size:])
+            finally:
+                journal.close()
+
+            self.fd.close()
+            os.replace(self.path + '.tmp', self.path)
+            self.fd = open(self.path, 'ab', buffering = 0)
+
+    def close(self):
+        with self.lock:
+            self.fd.close()
@@ -1,21 +1,160 @@
+import struct
+
 # 7-bit packet overhead (not including addresses or data)
 #
 # ALE packet transmit time using 20-bit RNS addresses (no data, 47 characters, 300 baud): 1.25 seconds
 # Note: RNS github discussion #72 proposing move to 128-bit address space (263 characters: 7 second transmit time)
+#
+# Binary packet format (5 byte overhead, not including addresses or data):
+#
+#   preamble (1) | version (1) | command code (1) | origin length (1) | destination length (1) | origin | destination | data
+#
+# The preamble and version bytes are matched together, so arbitrary data is only mistaken for a binary packet
+# when it starts with both bytes.
+#
+# The ASCII format is always accepted on receive, binary packets are only sent to stations that advertise support.
+#
+# Multiple packed packets sent in a single transmission are aggregated:
+#
+#   aggregate preamble (3) | packet count (2) | packet length (2) | packet | packet length (2) | packet | ...
+#
+# The packet count and lengths give the length of an aggregate, so stream receivers do not look for frame
+# preambles inside the aggregated packets (see ale.PacketStream).
+#
+# Unpacking does not copy the received buffer. Field offsets are stored and the origin, destination, command
+# and data fields are only materialized as bytes when accessed. The received buffer must not be modified
+# while the packet is in use. The reference to the buffer is released once all fields are materialized, see
+# materialize, so packets kept in LQA history do not pin receive buffers.
 
 class Packet:
 
+    __slots__ = ('_origin', '_destination', '_command', '_data', '_view', '_offsets', '_pending', 'timestamp', 'confidence', 'channel', 'binary', 'corrections')
+
     PREAMBLE    = b'ALE'
     SEPARATOR   = b':'
 
+    BINARY_PREAMBLE = b'\xae'
+    BINARY_VERSION  = 1
+    BINARY_HEADER   = struct.Struct('>BBBB')
+    # preamble and version, matched together to recognize binary packets
+    BINARY_START    = BINARY_PREAMBLE + bytes([BINARY_VERSION])
+
+    AGGREGATE_PREAMBLE  = b'ALM'
+    AGGREGATE_COUNT     = struct.Struct('>H')
+    AGGREGATE_LENGTH    = struct.Struct('>H')
+
+    # single byte command codes used by the binary format
+    COMMAND_CODES = {
+        b'CS' : 0x1,
+        b'CA' : 0x2,
+        b'CC' : 0x3,
+        b'CE' : 0x4
+    }
+    CODE_COMMANDS = {code: command for command, code in COMMAND_CODES.items()}
+
+    # option fields carried in the data of ale command packets: tag (1) | length (1) | value
+    # padding (b'#') or the end of the data terminates the option fields
+    OPTION_CAPABILITIES = b'C'
+    OPTION_LQA          = b'L' # lqa digest, see ale.LQA.digest
+    OPTION_PADDING      = b'#'
+
     def __init__(self, origin=b'', destination=b'', command=b'', data=b''):
-        self.origin = origin
-        self.destination = destination
-        self.command = command
-        self.data = data
+        self._origin = origin
+        self._destination = destination
+        self._command = command
+        self._data = data
+        self._view = None
+        self._offsets = None
+        # number of fields not yet materialized from the received buffer
+        self._pending = 0
         self.timestamp = 0
         self.confidence = None
         self.channel = None
+        self.binary = False
+        # number of bytes corrected by forward error correction
+        self.corrections = 0
+
+    # materialize a field from the received buffer, field offsets are stored as (start, end) pairs
+    def _field(self, index):
+        start = self._offsets[index * 2]
+        end = self._offsets[(index * 2) + 1]
+        field = bytes(self._view[start:end])
+        self._release_field()
+        return field
+
+    # release the received buffer once the last field is materialized or replaced
+    def _release_field(self):
+        self._pending -= 1
+        if self._pending == 0:
+            self._view = None
+            self._offsets = None
+
+    # materialize all fields and release the received buffer, called before a packet is stored
+    def materialize(self):
+        if self._view == None:
+            return None
+
+        self.command
+        self.origin
+        self.destination
+        self.data
+
+    @property
+    def command(self):
+        if self._command == None:
+            self._command = self._field(0)
+        return self._command
+
+    @command.setter
+    def command(self, command):
+        if self._command == None and self._view != None:
+            self._release_field()
+        self._command = command
+
+    @property
+    def origin(self):
+        if self._origin == None:
+            self._origin = self._field(1)
+        return self._origin
+
+    @origin.setter
+    def origin(self, origin):
+        if self._origin == None and self._view != None:
+            self._release_field()
+        self._origin = origin
+
+    @property
+    def destination(self):
+        if self._destination == None:
+            self._destination = self._field(2)
+        return self._destination
+
+    @destination.setter
+    def destination(self, destination):
+        if self._destination == None and self._view != None:
+            self._release_field()
+        self._destination = destination
+
+    @property
+    def data(self):
+        if self._data == None:
+            self._data = self._field(3)
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        if self._data == None and self._view != None:
+            self._release_field()
+        self._data = data
+
+    def _set_offsets(self, raw, offsets):
+        self._view = memoryview(raw)
+        self._offsets = offsets
+        self._pending = 4
+        self._command = None
+        self._origin = None
+        self._destination = None
+        self._data = None
 
     def __repr__(self):
         try:
@@ -23,34 +162,174 @@ class Packet:
         except:
             return 'ale.Packet[ : : ]'
 
-    def pack(self):
-        packet = Packet.PREAMBLE + self.command + self.origin + Packet.SEPARATOR + self.destination + Packet.SEPARATOR + self.data
+    @staticmethod
+    def is_packet(raw):
+        # check the preamble without slicing the buffer
+        return raw.startswith(Packet.PREAMBLE) or raw.startswith(Packet.BINARY_START)
+
+    @staticmethod
+    def is_aggregate(raw):
+        return raw.startswith(Packet.AGGREGATE_PREAMBLE)
+
+    @staticmethod
+    def aggregate(packed_packets):
+        raw = [Packet.AGGREGATE_PREAMBLE, Packet.AGGREGATE_COUNT.pack(len(packed_packets))]
+        for packed_packet in packed_packets:
+            raw.append(Packet.AGGREGATE_LENGTH.pack(len(packed_packet)))
+            raw.append(packed_packet)
+
+        return b''.join(raw)
+
+    # if strict, raises ValueError unless the packet count and lengths span the whole aggregate and each packet
+    # has a packet preamble, otherwise truncated trailing packets are dropped
+    @staticmethod
+    def disaggregate(raw, strict=False):
+        packed_packets = []
+        offset = len(Packet.AGGREGATE_PREAMBLE) + Packet.AGGREGATE_COUNT.size
+        len_length = Packet.AGGREGATE_LENGTH.size
+
+        if len(raw) < offset:
+            if strict:
+                raise ValueError('Malformed aggregate')
+            return packed_packets
+
+        count = Packet.AGGREGATE_COUNT.unpack_from(raw, len(Packet.AGGREGATE_PREAMBLE))[0]
+
+        while len(packed_packets) < count and offset + len_length <= len(raw):
+            length = Packet.AGGREGATE_LENGTH.unpack_from(raw, offset)[0]
+            offset += len_length
+            # drop a truncated trailing packet
+            if offset + length > len(raw):
+                break
+
+            packed_packets.append(raw[offset:offset + length])
+            offset += length
+
+        if strict:
+            if offset != len(raw) or len(packed_packets) != count or count == 0:
+                raise ValueError('Malformed aggregate')
+
+            if not all(Packet.is_packet(packed_packet) for packed_packet in packed_packets):
+                raise ValueError('Malformed aggregate')
+
+        return packed_packets
+
+    def pack(self, binary=None):
+        if binary == None:
+            binary = self.binary
+
+        if binary:
+            return self.pack_binary()
+
+        packet = b''.join((Packet.PREAMBLE, self.command, self.origin, Packet.SEPARATOR, self.destination, Packet.SEPARATOR, self.data))
         return packet
 
+    def pack_binary(self):
+        if self.command not in Packet.COMMAND_CODES:
+            raise ValueError('Command \'{}\' has no binary command code'.format(self.command))
+
+        if len(self.origin) > 255 or len(self.destination) > 255:
+            raise ValueError('Address too long for binary packet format')
+
+        header = Packet.BINARY_HEADER.pack(Packet.BINARY_VERSION, Packet.COMMAND_CODES[self.command], len(self.origin), len(self.destination))
+        return b''.join((Packet.BINARY_PREAMBLE, header, self.origin, self.destination, self.data))
+
     def unpack(self, raw):
-        # remove preamble
-        len_preamble = len(Packet.PREAMBLE)
-        raw = raw[len_preamble:]
+        if raw.startswith(Packet.BINARY_START):
+            self.unpack_binary(raw)
+            return None
+
+        if not raw.startswith(Packet.PREAMBLE):
+            raise ValueError('Unknown packet preamble')
+
+        # skip preamble
+        offset = len(Packet.PREAMBLE)
 
         len_command = 2
         len_separator = len(Packet.SEPARATOR)
-        address_separator = raw.find(Packet.SEPARATOR)
+        address_separator = raw.find(Packet.SEPARATOR, offset)
         data_separator = raw.find(Packet.SEPARATOR, address_separator + len_separator)
 
-        self.command = raw[:len_command]
-        self.origin = raw[len_command:address_separator]
-        self.destination = raw[address_separator + len_separator:data_separator]
-        self.data = raw[data_separator + len_separator:]
+        if address_separator < (offset + len_command) or data_separator < 0:
+            raise ValueError('Malformed packet')
+
+        self._set_offsets(raw, (
+            offset, offset + len_command,
+            offset + len_command, address_separator,
+            address_separator + len_separator, data_separator,
+            data_separator + len_separator, len(raw)
+        ))
+        self.binary = False
+
+    def unpack_binary(self, raw):
+        offset = len(Packet.BINARY_PREAMBLE)
+        if len(raw) < offset + Packet.BINARY_HEADER.size:
+            raise ValueError('Truncated packet')
+
+        version, code, len_origin, len_destination = Packet.BINARY_HEADER.unpack_from(raw, offset)
+
+        if version != Packet.BINARY_VERSION:
+            raise ValueError('Unsupported binary packet version {}'.format(version))
+
+        offset += Packet.BINARY_HEADER.size
+        if len(raw) < offset + len_origin + len_destination:
+            raise ValueError('Truncated packet')
+
+        if code not in Packet.CODE_COMMANDS:
+            raise ValueError('Unknown binary command code {}'.format(code))
+
+        destination_offset = offset + len_origin
+        data_offset = destination_offset + len_destination
+        self._set_offsets(raw, (
+            0, 0,
+            offset, destination_offset,
+            destination_offset, data_offset,
+            data_offset, len(raw)
+        ))
+        # the command is looked up rather than sliced from the buffer
+        self.command = Packet.CODE_COMMANDS[code]
+        self.binary = True
+
+    @staticmethod
+    def pack_options(options):
+        data = b''
+        for tag, value in options.items():
+            data += tag + bytes([len(value)]) + value
+
+        return data
+
+    @staticmethod
+    def unpack_options(data):
+        options = {}
+        offset = 0
+
+        while offset + 2 <= len(data):
+            tag = data[offset:offset + 1]
+            if tag == Packet.OPTION_PADDING:
+                break
+
+            length = data[offset + 1]
+            value = data[offset + 2:offset + 2 + length]
+            # stop at a truncated option field, the rest of the data is not usable
+            if len(value) < length:
+                break
+
+            options[tag] = value
+            offset += 2 + length
+
+        return options
 
     def to_dict(self):
         packet = {}
         packet['origin'] = self.origin.decode('utf-8')
         packet['destination'] = self.destination.decode('utf-8')
         packet['command'] = self.command.decode('utf-8')
-        packet['data'] = self.data.decode('utf-8')
+        # latin-1 round-trips the binary option fields carried in ale command packets
+        packet['data'] = self.data.decode('latin-1')
         packet['timestamp'] = self.timestamp
         packet['confidence'] = self.confidence
         packet['channel'] = self.channel
+        packet['corrections'] = self.corrections
 
         return packet
 
@@ -58,8 +337,8 @@ class Packet:
         self.origin = packet['origin'].encode('utf-8')
         self.destination = packet['destination'].encode('utf-8')
         self.command = packet['command'].encode('utf-8')
-        self.data = packet['data'].encode('utf-8')
+        self.data = packet['data'].encode('latin-1')
         self.timestamp = packet['timestamp']
         self.confidence = packet['confidence']
         self.channel = packet['channel']
-
+        self.corrections = packet.get('corrections', 0)
@@ -0,0 +1,259 @@
+# Streaming packet parser module
+#
+# Parses ALE packets from a byte stream delivered in arbitrary chunks, for modem backends that do not
+# deliver exactly one frame per receive callback. Bytes before the start of a frame are discarded as noise, and
+# a frame that grows beyond the maximum buffer size is discarded.
+#
+# A frame start is a frame preamble (ALE, aggregate, FEC or binary) followed by a valid header: a known command
+# for packets, a non-zero packet count for aggregates, and a matching length copy for FEC frames.
+#
+# Frames are consumed by length where the length is known:
+#
+#   FEC frames      data length in the FEC header
+#   aggregates      packet count and packet lengths
+#   packets         addresses, then option fields (tag, length, value) with known tags and padding
+#
+# The stream is only searched for the start of the next frame after the known part of a frame, so preambles
+# inside FEC parity, aggregated packets, addresses or option values (e.g. an LQA digest) do not split frames.
+# Packets are padded to the end of the transmission, so a packet ends with its padding. Packet data that is
+# not option fields ends at the start of the next frame, or with flush() at the end of a transmission.
+#
+# Non-ALE data is not delimited and is discarded, so connected state data requires a frame based modem.
+
+import ale
+
+
+class PacketStream:
+
+    MAX_BUFFER = 16384 # bytes
+    # bytes following a preamble that are checked to find the start of a frame, see _check_start
+    LEN_HEADER = len(ale.FEC.PREAMBLE) + ale.FEC.HEADER.size
+
+    # option tags whose length fields are followed when finding the end of a packet
+    OPTION_TAGS = (ale.Packet.OPTION_CAPABILITIES[0], ale.Packet.OPTION_LQA[0])
+
+    def __init__(self, fec=None, max_buffer=MAX_BUFFER):
+        if fec == None:
+            fec = ale.FEC()
+
+        self.fec = fec
+        self.max_buffer = max_buffer
+        self.buffer = bytearray()
+        # offset to resume searching for the start of the next frame
+        self.scan_offset = 1
+        self.dropped_bytes = 0
+
+        self.starts = [
+            ale.Packet.PREAMBLE,
+            ale.Packet.AGGREGATE_PREAMBLE,
+            ale.FEC.PREAMBLE,
+            ale.Packet.BINARY_START
+        ]
+
+    # returns True if a frame starts at offset, False if not, or None if more bytes are needed to tell
+    def _check_start(self, offset):
+        buffer = self.buffer
+
+        if buffer.startswith(ale.Packet.PREAMBLE, offset):
+            offset += len(ale.Packet.PREAMBLE)
+            if len(buffer) < offset + 2:
+                return None
+            return bytes(buffer[offset:offset + 2]) in ale.Packet.COMMAND_CODES
+
+        if buffer.startswith(ale.Packet.BINARY_START, offset):
+            offset += len(ale.Packet.BINARY_START)
+            if len(buffer) < offset + 1:
+                return None
+            return buffer[offset] in ale.Packet.CODE_COMMANDS
+
+        if buffer.startswith(ale.Packet.AGGREGATE_PREAMBLE, offset):
+            offset += len(ale.Packet.AGGREGATE_PREAMBLE)
+            if len(buffer) < offset + ale.Packet.AGGREGATE_COUNT.size:
+                return None
+            return ale.Packet.AGGREGATE_COUNT.unpack_from(buffer, offset)[0] > 0
+
+        if buffer.startswith(ale.FEC.PREAMBLE, offset):
+            try:
+                return self.fec.frame_length(buffer, offset) != None or None
+            except ValueError:
+                return False
+
+        return False
+
+    # returns (offset, pending) for the first frame start at or after offset, or (-1, False) if there is none
+    # pending is True if more bytes are needed to check the frame start at offset
+    def _find_start(self, offset):
+        while True:
+            position = -1
+            for start in self.starts:
+                index = self.buffer.find(start, offset)
+                if index >= 0 and (position < 0 or index < position):
+                    position = index
+
+            if position < 0:
+                return (-1, False)
+
+            valid = self._check_start(position)
+            if valid != False:
+                return (position, valid == None)
+
+            offset = position + 1
+
+    # end of the option fields and padding of packet data starting at offset, returns (end, complete), see _frame_end
+    def _options_end(self, offset):
+        buffer = self.buffer
+        padding = ale.Packet.OPTION_PADDING[0]
+
+        while offset < len(buffer):
+            tag = buffer[offset]
+
+            # padding runs to the end of the packet, which is known once another byte follows it
+            if tag == padding:
+                while offset < len(buffer) and buffer[offset] == padding:
+                    offset += 1
+                return (offset, True if offset < len(buffer) else None)
+
+            if tag not in PacketStream.OPTION_TAGS:
+                return (offset, False)
+
+            if offset + 2 > len(buffer) or offset + 2 + buffer[offset + 1] > len(buffer):
+                return (offset, None)
+
+            offset += 2 + buffer[offset + 1]
+
+        return (offset, None)
+
+    # returns (end, complete) for the frame at the start of the buffer, complete is True if the frame ends at
+    # end, None if more bytes are needed to find the end, or False if the frame data from end is not delimited
+    # and the frame ends at the start of the next frame
+    def _frame_end(self):
+        buffer = self.buffer
+
+        if buffer.startswith(ale.FEC.PREAMBLE):
+            length = self.fec.frame_length(buffer)
+            return (length, True if length <= len(buffer) else None)
+
+        if buffer.startswith(ale.Packet.AGGREGATE_PREAMBLE):
+            offset = len(ale.Packet.AGGREGATE_PREAMBLE)
+            count = ale.Packet.AGGREGATE_COUNT.unpack_from(buffer, offset)[0]
+            offset += ale.Packet.AGGREGATE_COUNT.size
+
+            for i in range(count):
+                if offset + ale.Packet.AGGREGATE_LENGTH.size > len(buffer):
+                    return (offset, None)
+                offset += ale.Packet.AGGREGATE_LENGTH.size + ale.Packet.AGGREGATE_LENGTH.unpack_from(buffer, offset)[0]
+
+            return (offset, True if offset <= len(buffer) else None)
+
+        if buffer.startswith(ale.Packet.BINARY_START):
+            offset = len(ale.Packet.BINARY_PREAMBLE) + ale.Packet.BINARY_HEADER.size
+            if len(buffer) < offset:
+                return (offset, None)
+
+            offset += buffer[offset - 2] + buffer[offset - 1]
+            if len(buffer) < offset:
+                return (offset, None)
+
+            return self._options_end(offset)
+
+        # ascii packet, the addresses end at the second separator, a packet without separators is malformed and
+        # ends at the start of the next frame
+        offset = len(ale.Packet.PREAMBLE) + 2
+        for i in range(2):
+            offset = buffer.find(ale.Packet.SEPARATOR, offset)
+            if offset < 0:
+                return (len(ale.Packet.PREAMBLE) + 2, False)
+            offset += len(ale.Packet.SEPARATOR)
+
+        return self._options_end(offset)
+
+    def _drop(self, length):
+        self.dropped_bytes += length
+        del self.buffer[:length]
+
+    # returns a list of complete packets
+    def feed(self, chunk):
+        self.buffer += chunk
+        packets = []
+
+        while len(self.buffer) > 0:
+            # resynchronize on the first frame start, keeping a possible partial frame start at the end of the buffer
+            if self._check_start(0) != True:
+                start, pending = self._find_start(0)
+                if start < 0:
+                    self._drop(max(len(self.buffer) - PacketStream.LEN_HEADER + 1, 0))
+                    break
+                elif start > 0:
+                    self._drop(start)
+                    self.scan_offset = 1
+
+                if pending:
+                    break
+
+            end, complete = self._frame_end()
+
+            if complete == None:
+                break
+
+            if complete == False:
+                # the end of packet data that is not option fields is the start of the next frame
+                next_start, pending = self._find_start(max(end, self.scan_offset))
+                if next_start < 0 or pending:
+                    self.scan_offset = max(len(self.buffer) - PacketStream.LEN_HEADER + 1, end, 1)
+                    break
+
+                end = next_start
+
+            packets.extend(self.parse(bytes(self.buffer[:end])))
+            del self.buffer[:end]
+            self.scan_offset = 1
+
+        if len(self.buffer) > self.max_buffer:
+            self._drop(len(self.buffer))
+            self.scan_offset = 1
+
+        return packets
+
+    # end of transmission, the buffered frame is complete
+    def flush(self):
+        packets = []
+
+        if self._check_start(0) == True:
+            packets = self.parse(bytes(self.buffer))
+            self.buffer.clear()
+        else:
+            self._drop(len(self.buffer))
+
+        self.scan_offset = 1
+        return packets
+
+    def parse(self, raw):
+        packets = []
+        corrections = 0
+
+        if raw.startswith(ale.FEC.PREAMBLE):
+            try:
+                raw, corrections = self.fec.decode(raw)
+            except ValueError:
+                return packets
+
+        if ale.Packet.is_aggregate(raw):
+            packed_packets = ale.Packet.disaggregate(raw)
+        else:
+            packed_packets = [raw]
+
+        for packed_packet in packed_packets:
+            if not ale.Packet.is_packet(packed_packet):
+                continue
+
+            packet = ale.Packet()
+            # discard packet if it fails to unpack, which likely means it is corrupted
+            try:
+                packet.unpack(packed_packet)
+            except Exception:
+                continue
+
+            packet.corrections = corrections
+            packets.append(packet)
+
+        return packets
@@ -0,0 +1,154 @@
+# Deadline scheduler module
+#
+# The ALE jobs loop sleeps until the earliest registered deadline instead of polling. Deadlines are kept on
+# a min-heap, and threads that change state outside of the loop (packet receive, user calls and sends) wake
+# the loop early through a condition variable. Deadlines that have passed are discarded when the loop wakes,
+# so registering a deadline that later moves (e.g. a call timeout extended by keep alive) only causes a
+# spurious wake.
+#
+# Classes:
+#   Clock
+#   VirtualClock
+#   Scheduler
+#   VirtualScheduler
+#
+# The ALE stack reads the time from the clock of its scheduler (ale.ALE.clock). With a VirtualScheduler the
+# clock only moves when the loop waits, and it jumps straight to the next deadline, so hours of scanning,
+# sounding and calling run in seconds (see ale.ALE.run_until). A VirtualClock can be shared by the schedulers
+# of several stations so that they run on the same timeline.
+
+import heapq
+import threading
+import time
+
+
+class Clock:
+
+    def time(self):
+        return time.time()
+
+
+class VirtualClock:
+
+    # start defaults to the current time so that timestamps stay meaningful to the time module
+    def __init__(self, start=None):
+        self.current_time = start if start != None else time.time()
+
+    def time(self):
+        return self.current_time
+
+    # move the clock forward to the given time, the clock never moves backwards
+    def advance(self, timestamp):
+        self.current_time = max(self.current_time, timestamp)
+
+
+class Scheduler:
+
+    MAX_SLEEP = 1 # seconds, upper bound on sleep time so that unregistered conditions are still checked
+    POLL_INTERVAL = 0.1 # seconds, while waiting on a condition that does not wake the loop (e.g. modem transmit buffer)
+    CARRIER_SENSE_INTERVAL = 0.01 # seconds
+
+    def __init__(self, clock=None):
+        self.clock = clock if clock != None else Clock()
+        self.condition = threading.Condition()
+        self.deadlines = []
+        self.pending = False
+        # called on every wake or new deadline, used by an event loop that replaces wait (see ale.AsyncALE)
+        self.listener = None
+        # statistics
+        self.wake_count = 0
+
+    # wake the loop at the given time
+    def wake_at(self, timestamp):
+        # the listener owner waits on its own deadlines
+        if self.listener != None:
+            self.listener()
+            return None
+
+        with self.condition:
+            earliest = len(self.deadlines) == 0 or timestamp < self.deadlines[0]
+            heapq.heappush(self.deadlines, timestamp)
+
+            if earliest:
+                self.condition.notify()
+
+    # wake the loop now
+    def wake(self):
+        with self.condition:
+            self.pending = True
+            self.condition.notify()
+
+        if self.listener != None:
+            self.listener()
+
+    # block until the earliest deadline, a call to wake, or MAX_SLEEP
+    def wait(self):
+        with self.condition:
+            timeout_timestamp = self.clock.time() + Scheduler.MAX_SLEEP
+
+            while True:
+                current_time = self.clock.time()
+
+                while len(self.deadlines) > 0 and self.deadlines[0] <= current_time:
+                    heapq.heappop(self.deadlines)
+                    self.pending = True
+
+                if self.pending or current_time >= timeout_timestamp:
+                    break
+
+                timeout = timeout_timestamp - current_time
+                if len(self.deadlines) > 0:
+                    timeout = min(self.deadlines[0] - current_time, timeout)
+
+                self.condition.wait(timeout)
+
+            self.pending = False
+            self.wake_count += 1
+
+
+class VirtualScheduler(Scheduler):
+    """
+    Scheduler for simulation on a virtual clock
+
+    wait does not block, it advances the clock to just past the earliest deadline, or by MAX_SLEEP if there
+    is no deadline. Jobs compare deadlines with >, so the clock always moves at least RESOLUTION past the
+    deadline. A pending wake returns without advancing the clock.
+    """
+
+    RESOLUTION = 0.001 # seconds
+
+    def __init__(self, clock=None):
+        super().__init__(clock if clock != None else VirtualClock())
+
+    # earliest registered deadline, or None
+    def next_deadline(self):
+        with self.condition:
+            if len(self.deadlines) == 0:
+                return None
+
+            return self.deadlines[0]
+
+    def wait(self):
+        with self.condition:
+            current_time = self.clock.time()
+
+            if not self.pending:
+                timestamp = current_time + Scheduler.MAX_SLEEP
+                if len(self.deadlines) > 0:
+                    timestamp = min(self.deadlines[0], timestamp)
+
+                self.clock.advance(max(timestamp, current_time) + VirtualScheduler.RESOLUTION)
+
+        self.expire()
+
+    # discard passed deadlines and a pending wake without advancing the clock, used by a driver that advances
+    # a clock shared by several stations (see ale.Simulator)
+    def expire(self):
+        with self.condition:
+            current_time = self.clock.time()
+
+            while len(self.deadlines) > 0 and self.deadlines[0] <= current_time:
+                heapq.heappop(self.deadlines)
+
+            self.pending = False
+            self.wake_count += 1
@@ -0,0 +1,379 @@
+# HF channel simulator module
+#
+# Classes:
+#   SimulatedMedium
+#   SimulatedRadio
+#   SimulatedModem
+#   Simulator
+#
+# Runs any number of ALE stations in one process against a simulated HF medium, without radios or modems.
+# Each station gets a SimulatedRadio (qdx interface: set_vfo_a, set_sideband) and a SimulatedModem
+# (fskmodem interface: send, set_rx_callback, carrier_sense, _tx_buffer, stop) attached to a shared
+# SimulatedMedium. All stations run on one virtual clock (see ale.VirtualClock), so hours of scanning,
+# sounding and calling run in seconds.
+#
+# The medium models:
+#
+#   propagation     a base confidence per pair of stations and frequency, random unless set, plus
+#                   gaussian noise per received frame
+#   airtime         frame length (including modem delimiters) at the modem baudrate
+#   half duplex     a transmitting station does not receive
+#   collisions      frames overlapping in time on the same frequency are lost at receivers hearing both
+#
+# A frame is received if the receiver is tuned to the frequency for the whole frame and the received
+# confidence is at least the modem confidence. Carrier sense is set while any station the receiver can
+# hear transmits on its frequency.
+#
+# Example:
+#
+#   sim = ale.Simulator(seed=1)
+#   stations = [sim.add_station('STATION' + str(i)) for i in range(20)]
+#   sim.run(60 * 60)
+#   stations[0].call(b'STATION1')
+#   sim.run(5 * 60)
+#   print(sim.call_latencies, sim.utilization())
+
+import os
+import json
+import random
+import shutil
+import tempfile
+import collections
+
+import ale
+
+
+class SimulatedMedium:
+
+    DELIMITER_LENGTH = 6 # modem frame delimiter characters, see ale.ALE._process_ale_queue
+    MAX_CONFIDENCE = 3.0 # upper bound of random link confidence
+    NOISE = 0.2 # standard deviation of received confidence
+    SENSE_CONFIDENCE = 0.5 # minimum link confidence to sense a carrier
+
+    def __init__(self, clock, baudrate=300, rng=None):
+        self.clock = clock
+        self.baudrate = baudrate
+        self.random = rng if rng != None else random.Random()
+        self.radios = []
+        # (radio id, radio id, freq) -> base confidence, lower radio id first
+        self.links = {}
+        # transmissions on air, see transmit
+        self.transmissions = []
+        self.start_timestamp = clock.time()
+        # statistics
+        # freq -> seconds on air
+        self.airtime = collections.defaultdict(float)
+        self.frame_count = 0
+        self.delivered_count = 0
+        # frames lost at a receiver to an overlapping transmission
+        self.collision_count = 0
+
+    def add_radio(self, radio):
+        radio.id = len(self.radios)
+        self.radios.append(radio)
+
+    def _link_key(self, radio_a, radio_b, freq):
+        if radio_a.id < radio_b.id:
+            return (radio_a.id, radio_b.id, freq)
+
+        return (radio_b.id, radio_a.id, freq)
+
+    # base confidence between two radios on a frequency, links are symmetric
+    def link(self, radio_a, radio_b, freq):
+        key = self._link_key(radio_a, radio_b, freq)
+
+        if key not in self.links:
+            self.links[key] = self.random.uniform(0, SimulatedMedium.MAX_CONFIDENCE)
+
+        return self.links[key]
+
+    def set_link(self, radio_a, radio_b, freq, confidence):
+        self.links[self._link_key(radio_a, radio_b, freq)] = confidence
+
+    # transmit time in seconds
+    def frame_airtime(self, data):
+        return ((len(data) + SimulatedMedium.DELIMITER_LENGTH) * 8) / self.baudrate
+
+    # start transmitting the next frame in the modem transmit buffer
+    def transmit(self, modem):
+        radio = modem.radio
+        data = modem._tx_buffer[0]
+        current_time = self.clock.time()
+        airtime = self.frame_airtime(data)
+
+        # receiver radio -> received confidence, or None if the frame is lost at the receiver
+        receptions = {}
+        for receiver in self.radios:
+            if receiver is radio or receiver.freq != radio.freq or receiver.modem.transmitting:
+                continue
+
+            receptions[receiver] = self.link(radio, receiver, radio.freq) + self.random.gauss(0, SimulatedMedium.NOISE)
+
+        for transmission in self.transmissions:
+            # half duplex, the transmitting station loses any frame it is receiving
+            if radio in transmission['receptions']:
+                transmission['receptions'][radio] = None
+
+            if transmission['freq'] != radio.freq:
+                continue
+
+            # collision at receivers hearing both frames
+            for receiver in receptions:
+                if receiver in transmission['receptions']:
+                    if transmission['receptions'][receiver] != None:
+                        self.collision_count += 1
+
+                    transmission['receptions'][receiver] = None
+                    receptions[receiver] = None
+
+        self.transmissions.append({
+            'modem': modem,
+            'freq': radio.freq,
+            'data': data,
+            'end': current_time + airtime,
+            'receptions': receptions
+        })
+
+        modem.transmitting = True
+        self.airtime[radio.freq] += airtime
+        self.frame_count += 1
+
+    # end of the next transmission, or None
+    def next_deadline(self):
+        return min([transmission['end'] for transmission in self.transmissions], default = None)
+
+    # deliver frames that have finished transmitting and start the next queued frames
+    def update(self):
+        current_time = self.clock.time()
+        ended = [transmission for transmission in self.transmissions if transmission['end'] <= current_time]
+        ended.sort(key = lambda transmission: transmission['end'])
+
+        for transmission in ended:
+            self.transmissions.remove(transmission)
+            modem = transmission['modem']
+            modem.transmitting = False
+
+            # the frame is cut short if the station retuned or cleared its transmit buffer
+            if len(modem._tx_buffer) > 0 and modem._tx_buffer[0] is transmission['data']:
+                modem._tx_buffer.pop(0)
+
+                if modem.radio.freq == transmission['freq']:
+                    for receiver, confidence in transmission['receptions'].items():
+                        if confidence != None and receiver.freq == transmission['freq'] and confidence >= receiver.modem.confidence:
+                            self.delivered_count += 1
+                            receiver.modem.receive(transmission['data'], confidence)
+
+            if len(modem._tx_buffer) > 0 and not modem.stopped:
+                self.transmit(modem)
+
+    def carrier_sense(self, radio):
+        for transmission in self.transmissions:
+            origin = transmission['modem'].radio
+            if origin is not radio and transmission['freq'] == radio.freq and self.link(origin, radio, radio.freq) >= SimulatedMedium.SENSE_CONFIDENCE:
+                return True
+
+        return False
+
+    # freq -> fraction of the elapsed time with a transmission on air
+    def utilization(self):
+        elapsed = self.clock.time() - self.start_timestamp
+        if elapsed <= 0:
+            return {}
+
+        return {freq: airtime / elapsed for freq, airtime in self.airtime.items()}
+
+
+class SimulatedRadio:
+
+    def __init__(self, medium):
+        self.medium = medium
+        self.id = None
+        self.freq = None
+        self.sideband = 0
+        self.modem = None
+        medium.add_radio(self)
+
+    def set_vfo_a(self, freq):
+        self.freq = freq
+
+    def set_sideband(self, sideband):
+        self.sideband = sideband
+
+
+class SimulatedModem:
+
+    def __init__(self, medium, radio, confidence=1.5):
+        self.medium = medium
+        self.radio = radio
+        self.confidence = confidence
+        self.transmitting = False
+        self.stopped = False
+        self.rx_callback = None
+        self._tx_buffer = []
+        radio.modem = self
+
+    @property
+    def carrier_sense(self):
+        return self.medium.carrier_sense(self.radio)
+
+    def send(self, data):
+        if self.stopped:
+            return None
+
+        self._tx_buffer.append(bytes(data))
+
+        if not self.transmitting:
+            self.medium.transmit(self)
+
+    def set_rx_callback(self, func):
+        self.rx_callback = func
+
+    def receive(self, data, confidence):
+        if self.rx_callback != None and not self.stopped:
+            self.rx_callback(data, confidence)
+
+    def stop(self):
+        self.stopped = True
+        self._tx_buffer.clear()
+
+
+class Simulator:
+    """
+    Multi-station ALE simulator
+
+    Stations are ale.ALE objects using a simulated radio and modem, a VirtualScheduler on the shared clock
+    and a temporary config directory. run advances the clock from deadline to deadline, running the jobs of
+    each station that is due and delivering frames as transmissions end. Stations are driven on the calling
+    thread, so calls made between runs (e.g. station.call) take effect at the current simulated time.
+
+    Call setup latency (call to connected, in seconds) is recorded for each connected call attempt in
+    call_latencies, and call attempts ending in the scanning state are counted in failed_calls.
+
+    seed seeds the medium and the random generator of each station (ale.ALE.random), so a seeded run with
+    the same stations and calls is reproducible. stop removes the temporary config directory.
+    """
+
+    def __init__(self, scanlist='General', baudrate=300, seed=None, start=None):
+        self.scanlist = scanlist
+        self.random = random.Random(seed)
+        self.clock = ale.VirtualClock(start)
+        self.medium = SimulatedMedium(self.clock, baudrate, self.random)
+        self.stations = []
+        self.config_dir = tempfile.mkdtemp(prefix = 'ale-sim-')
+        # calling station address -> call started timestamp
+        self.calls = {}
+        # statistics
+        self.call_latencies = []
+        self.failed_calls = 0
+
+    # config is merged into the station config file (e.g. {'packet': {'binary': True}}), returns the ale.ALE object
+    # factory is called instead of ale.ALE with the same keyword arguments, except run_jobs, and may return an
+    # ale.AsyncALE, which is returned instead. Its jobs are run by the simulator, so run must then be called on
+    # the event loop thread.
+    def add_station(self, address, config=None, factory=None):
+        config_dir = os.path.join(self.config_dir, address)
+        os.mkdir(config_dir)
+
+        station_config = {
+            'address': address,
+            'scanlist': self.scanlist,
+            'modem': {'baudrate': self.medium.baudrate}
+        }
+
+        if config != None:
+            station_config.update(config)
+
+        config_path = os.path.join(config_dir, 'config')
+        with open(config_path, 'w') as fd:
+            json.dump(station_config, fd)
+
+        radio = SimulatedRadio(self.medium)
+        modem = SimulatedModem(self.medium, radio)
+        # each station draws from its own generator seeded by the simulator, so a seed reproduces the whole run
+        rng = random.Random(self.random.getrandbits(64))
+        kwargs = {'scheduler': ale.VirtualScheduler(self.clock), 'modem': modem, 'radio': radio, 'config_dir': config_dir, 'rng': rng}
+
+        if factory != None:
+            instance = factory(config_path, **kwargs)
+        else:
+            instance = ale.ALE(config_path, run_jobs = False, **kwargs)
+
+        station = instance.ale if isinstance(instance, ale.AsyncALE) else instance
+        modem.confidence = station.modem_confidence
+        station.state_machine.listeners.append(lambda event: self._state_changed(station, event))
+
+        self.stations.append(station)
+        # run on the next pass
+        station.scheduler.wake()
+
+        return instance
+
+    def get_station(self, address):
+        if not isinstance(address, bytes):
+            address = address.encode('utf-8')
+
+        for station in self.stations:
+            if station.address == address:
+                return station
+
+        return None
+
+    # set the base confidence between two stations on a channel of the simulator scanlist
+    def set_link(self, address_a, address_b, channel, confidence):
+        freq = self.get_station(address_a).scanlists[self.scanlist][channel]['freq']
+        self.medium.set_link(self.get_station(address_a).radio, self.get_station(address_b).radio, freq, confidence)
+
+    def _state_changed(self, station, event):
+        if event.state == ale.ALE.STATE_CALLING:
+            self.calls[station.address] = event.timestamp
+
+        # calling each other at the same time goes from calling to connecting before connected
+        elif event.state == ale.ALE.STATE_CONNECTED and station.address in self.calls:
+            self.call_latencies.append(event.timestamp - self.calls.pop(station.address))
+
+        elif event.state == ale.ALE.STATE_SCANNING and station.address in self.calls:
+            del self.calls[station.address]
+            self.failed_calls += 1
+
+    def run(self, duration):
+        self.run_until(self.clock.time() + duration)
+
+    def run_until(self, timestamp):
+        while self.clock.time() < timestamp:
+            current_time = self.clock.time()
+            deadlines = [timestamp]
+
+            for station in self.stations:
+                if not station.online:
+                    continue
+
+                deadline = station.scheduler.next_deadline()
+                if station.scheduler.pending or (deadline != None and deadline <= current_time):
+                    station.scheduler.expire()
+                    deadline = station._run_jobs()
+                    if deadline == None:
+                        deadline = current_time + ale.Scheduler.MAX_SLEEP
+
+                    station.scheduler.wake_at(deadline)
+                    deadline = station.scheduler.next_deadline()
+
+                if deadline != None:
+                    deadlines.append(deadline)
+
+            medium_deadline = self.medium.next_deadline()
+            if medium_deadline != None:
+                deadlines.append(medium_deadline)
+
+            self.clock.advance(max(min(deadlines), current_time) + ale.VirtualScheduler.RESOLUTION)
+            self.medium.update()
+
+    # freq -> fraction of the simulated time with a transmission on air
+    def utilization(self):
+        return self.medium.utilization()
+
+    # stop all stations and remove the temporary config directory
+    def stop(self):
+        for station in self.stations:
+            station.stop()
+
+        shutil.rmtree(self.config_dir, ignore_errors = True)
@@ -6,7 +6,8 @@
 #   StateConnecting
 #   StateConnected
 #   StateSounding
-#   StateMachine
+#   ALEStateMachine
+#   StateEvent
 #
 # Written by Howard at Simply Equipped LLC
 # June 2022
@@ -15,12 +16,22 @@
 # github.com/simplyequipped
 
 
-import time
-import random
+import collections
+import contextlib
+import threading
 
 import ale
 
 
+# emitted to ALEStateMachine listeners on each state transition
+#   timestamp:  time of the transition
+#   last_state: ale state left (e.g. ale.ALE.STATE_SCANNING)
+#   state:      ale state entered
+#   command:    command of the received packet that caused the transition, or None
+#   address:    call address of the entered state
+StateEvent = collections.namedtuple('StateEvent', ['timestamp', 'last_state', 'state', 'command', 'address'])
+
+
 class StateScanning:
     """
     ALE state machine object (ale.ALE.STATE_SCANNING)
@@ -43,8 +54,9 @@ class StateScanning:
         self.name = 'scanning'
         self.state = ale.ALE.STATE_SCANNING
         self.active = False
-        self.busy = False
         self.machine = machine
+        # command -> (guard, handler, next ale state), set by the state machine
+        self.transitions = {}
 
         self.call_address = b''
         self.last_channel_change_timestamp = 0
@@ -79,7 +91,7 @@ class StateScanning:
         
     def next_channel(self):
         channels = list(self.machine.owner.channels.keys())
-        channel_index = channels.index(self.channel)
+        channel_index = channels.index(self.machine.owner.channel)
 
         if channel_index < (len(channels) - 1):
             next_channel = channels[channel_index + 1]
@@ -87,39 +99,49 @@ class StateScanning:
             next_channel = channels[0]
 
         self.machine.owner.set_channel(next_channel)
-        self.last_channel_change_timestamp = current_time
+        self.last_channel_change_timestamp = self.machine.clock.time()
         self.last_carrier_sense_timestamp = 0
 
-    def receive_packet(self, packet):
+    def receive_sound(self, packet):
+        # ack once per sounding event, other sounding packets stored for lqa
+        if self.received_sound_packet == None:
+            self.last_activity_timestamp = self.machine.clock.time()
+            self.received_sound_packet = packet
+            # random delay to avoid multiple stations ack-ing a sounding at the same time
+            self.sound_ack_delay = self.machine.owner.random.uniform(0.25, 1)
+
+    def receive_call(self, packet):
+        self.last_activity_timestamp = self.machine.clock.time()
+        self.call_address = packet.origin
+
+    # time of the next tick that can change state, see ale.Scheduler
+    def next_deadline(self):
         if not self.active:
             return None
 
-        if packet.command == ale.ALE.CMD_SOUND:
-            # ack once per sounding event, other sounding packets stored for lqa
-            if self.received_sound_packet == None:
-                self.last_activity_timestamp = time.time()
-                self.received_sound_packet = packet
-                # random delay to avoid multiple stations ack-ing a sounding at the same time
-                self.sound_ack_delay = random.uniform(0.25, 1)
+        current_time = self.machine.clock.time()
+        deadlines = []
 
-        # if packet.command == ack, do nothing
+        # sounding ack delay, then sample carrier sense until the channel is clear
+        if self.received_sound_packet != None:
+            ack_timestamp = self.received_sound_packet.timestamp + self.sound_ack_delay
+            deadlines.append(max(ack_timestamp, self.last_carrier_sense_timestamp + ale.Scheduler.CARRIER_SENSE_INTERVAL))
 
-        elif packet.command == ale.ALE.CMD_CALL:
-            if packet.destination in self.machine.owner.addresses or packet.destination == ale.ALE.ADDRESS_ANY:
-                self.last_activity_timestamp = time.time()
-                self.call_address = packet.origin
-                self.machine.change_state(ale.ALE.STATE_CONNECTING)
+        channel_change_timestamp = max(self.last_channel_change_timestamp, self.last_activity_timestamp) + ale.ALE.SCAN_WINDOW
+        if channel_change_timestamp > current_time:
+            deadlines.append(channel_change_timestamp)
+        else:
+            # channel change is waiting on a sounding ack or the modem transmit buffer
+            deadlines.append(current_time + ale.Scheduler.POLL_INTERVAL)
+
+        return min(deadlines)
 
-        # if packet.command == end, do nothing
-                
     def tick(self):
         if not self.active:
             return None
 
-        self.busy = True
-
-        # store current time to avoid multiple calls to time.time()
-        current_time = time.time()
+        # store current time to avoid multiple calls to self.machine.clock.time()
+        current_time = self.machine.clock.time()
         should_ack_sounding = False
         
         if self.machine.owner.modem != None and self.machine.owner.modem.carrier_sense:
@@ -148,7 +170,7 @@ class StateScanning:
         ):
             #send ack
             self.machine.owner._send_ale(ale.ALE.CMD_ACK, self.received_sound_packet.origin)
-            self.received.sound_packet = None
+            self.received_sound_packet = None
 
         # if it is time to change the channel
         if (
@@ -166,8 +188,6 @@ class StateScanning:
                 # go to the next channel
                 self.next_channel()
 
-        self.busy = False
-
 
 class StateCalling:
     """
@@ -186,8 +206,9 @@ class StateCalling:
         self.name = 'calling'
         self.state = ale.ALE.STATE_CALLING
         self.active = False
-        self.busy = False
         self.machine = machine
+        # command -> (guard, handler, next ale state), set by the state machine
+        self.transitions = {}
         self.call_timeout = 30 # seconds
 
         self.call_address = b''
@@ -216,7 +237,7 @@ class StateCalling:
 
         # set calling timeout based on number of channels in current scanlist
         self.call_timeout = ale.ALE.SCAN_WINDOW * (len(self.machine.owner.channels.keys()) + 1) # seconds
-        self.call_started_timestamp = time.time()
+        self.call_started_timestamp = self.machine.clock.time()
         self.call_timeout_timestamp = 0
         self.last_call_packet_timestamp = 0
         self.call_channel_attempts.clear()
@@ -231,47 +252,22 @@ class StateCalling:
     def leave_state(self):
         self.active = False
 
-    def receive_packet(self, packet):
-        if not self.active:
-            return None
+    # call acknowledged, complete the handshake so that the called station can leave the connecting state
+    def receive_ack(self, packet):
+        self.last_activity_timestamp = self.machine.clock.time()
+        self.machine.owner.lqa.selector.record(self.best_channel, self.call_address, True)
+        self.machine.owner._send_ale(ale.ALE.CMD_ACK, self.call_address)
 
-        # store current time to avoid multiple calls to time.time()
-        current_time = time.time()
-        addresses = self.machine.ownder.addresses
-
-        # if packet.command == sound, do nothing
-        
-        # call acknowledged
-        if packet.command == ale.ALE.CMD_ACK:
-            if packet.destination in addresses and packet.origin == self.call_address:
-                self.last_activity_timestamp = time.time()
-                self.machine.change_state(ale.ALE.STATE_CONNECTED)
-
-        # calling each other at the same time
-        if packet.command == ale.ALE.CMD_CALL:
-            if packet.destination in addresses and packet.origin == self.call_address:
-                self.last_activity_timestamp = time.time()
-                self.machine.change_state(ale.ALE.STATE_CONNECTING)
-            
-        # ignored
-        if packet.command == ale.ALE.CMD_END:
-            if packet.destination in addresses and packet.origin == self.call_address:
-                self.last_activity_timestamp = time.time()
-
-                address = self.call_address.decode('utf-8')
-                call_duration = int(current_time - self.call_started_timestamp)
-                self.machine.owner.log('Call ended by address ' + address + ' (call duration: ' + str(call_duration) + ' seconds)')
-    
-                if self.machine.owner.callback['disconnected'] != None:
-                    self.machine.owner.callback['disconnected'](self.call_address, call_duration)
-
-                self.machine.change_state(ale.ALE.STATE_SCANNING)
+    # calling each other at the same time
+    def receive_call(self, packet):
+        self.last_activity_timestamp = self.machine.clock.time()
+        self.machine.owner.lqa.selector.record(self.best_channel, self.call_address, True)
 
     def next_channel(self):
-        self.best_channel = self.machine.owner.lqa.best_channel(self.call_address, exclude = self.call_channel_attempts)
+        self.best_channel = self.machine.owner.lqa.selector.select(self.call_address, self.call_channel_attempts)
         self.call_channel_attempts.append(self.best_channel)
         self.machine.owner.set_channel(self.best_channel)
-        self.last_channel_change_timestamp = time.time()
+        self.last_channel_change_timestamp = self.machine.clock.time()
         self.last_carrier_sense_timestamp = 0
 
         address = self.call_address.decode('utf-8')
@@ -279,20 +275,29 @@ class StateCalling:
         channel = self.best_channel
         self.machine.owner.log('Calling ' + address + ' on channel ' + scanlist + ':' + channel)
 
-    def tick(self):
+    # time of the next tick that can change state, see ale.Scheduler
+    def next_deadline(self):
         if not self.active:
             return None
 
-        self.busy = True
+        return min(self.call_timeout_timestamp, self.last_call_packet_timestamp + ale.ALE.SCAN_WINDOW)
 
-        # store current time to avoid multiple calls to time.time()
-        current_time = time.time()
+    def tick(self):
+        if not self.active:
+            return None
+
+        # store current time to avoid multiple calls to self.machine.clock.time()
+        current_time = self.machine.clock.time()
 
         if self.machine.owner.modem != None and self.machine.owner.modem.carrier_sense:
             self.last_carrier_sense_timestamp = current_time
 
         # if call timed out
         if current_time > self.call_timeout_timestamp:
+            # no answer on the last channel attempted
+            if len(self.call_channel_attempts) > 0:
+                self.machine.owner.lqa.selector.record(self.best_channel, self.call_address, False)
+
             # try the next best channel
             if len(self.call_channel_attempts) < self.max_call_channel_attempts:
                 self.next_channel()
@@ -303,8 +308,7 @@ class StateCalling:
                 call_duration = int(current_time - self.call_started_timestamp)
                 self.machine.owner.log('Call timed out, no answer from ' + address + ' (call duration: ' + str(call_duration) + ' seconds)')
                 
-                if self.machine.owner.callback['disconnected'] != None:
-                    self.machine.owner.callback['disconnected'](self.call_address, call_duration)
+                self.machine.queue_callback('disconnected', self.call_address, call_duration)
 
                 self.machine.change_state(ale.ALE.STATE_SCANNING)
 
@@ -313,8 +317,6 @@ class StateCalling:
             self.last_call_packet_timestamp = current_time
             self.machine.owner._send_ale(ale.ALE.CMD_CALL, self.call_address)
 
-        self.busy = False
-
 
 # only the called station can be in a connecting state, since the calling station goes from
 # the calling state directly to the connected state after ack
@@ -335,8 +337,9 @@ class StateConnecting:
         self.name = 'connecting'
         self.state = ale.ALE.STATE_CONNECTING
         self.active = False
-        self.busy = False
         self.machine = machine
+        # command -> (guard, handler, next ale state), set by the state machine
+        self.transitions = {}
         self.call_timeout = 5 * 60 # seconds
 
         self.call_address = b''
@@ -358,16 +361,15 @@ class StateConnecting:
     def enter_state(self):
         self.call_address = self.machine.last_state.call_address
         self.last_ack_packet_timestamp = 0
-        self.call_started_timestamp = time.time()
-        self.call_timeout_timestamp = time.time() + self.call_timeout
+        self.call_started_timestamp = self.machine.clock.time()
+        self.call_timeout_timestamp = self.machine.clock.time() + self.call_timeout
         
         address = self.call_address.decode('utf-8')
         scanlist = self.machine.owner.scanlist
         channel = self.machine.owner.channel
         self.machine.owner.log('Incoming call from address ' + address + ' on channel ' + scanlist + ':' + channel)
 
-        if self.machine.owner.callback['call'] != None:
-            self.machine.owner.callback['call'](self.call_address)
+        self.machine.queue_callback('call', self.call_address)
 
         if self.machine.last_state != None:
             self.last_carrier_sense_timestamp = self.machine.last_state.last_carrier_sense_timestamp
@@ -378,53 +380,33 @@ class StateConnecting:
     def leave_state(self):
         self.active = False
 
-    def receive_packet(self, packet):
-        if not self.active:
-            return None
-
-        # store current time to avoid multiple calls to time.time()
-        current_time = time.time()
-        addresses = self.machine.ownder.addresses
+    # call handshake complete
+    def receive_ack(self, packet):
+        self.last_activity_timestamp = self.machine.clock.time()
 
-        # if packet.command == sound, do nothing
-        
-        # call handshake complete
-        if packet.command == ale.ALE.CMD_ACK:
-            if packet.destination in addresses and packet.origin == self.call_address:
-                self.last_activity_timestamp = time.time()
-                self.machine.change_state(ale.ALE.STATE_CONNECTED)
-
-        # called again by the address we are already in the process of connecting
-        if packet.command == ale.ALE.CMD_CALL:
-            if packet.destination in addresses and packet.origin == self.call_address:
-                self.last_activity_timestamp = time.time()
-                # restart the connecting process
-                self.last_ack_packet_timestamp = 0
-                self.call_started_timestamp = time.time()
-                self.call_timeout_timestamp = time.time() + self.call_timeout
-            
-        # call ended before connection was established
-        if packet.command == ale.ALE.CMD_END:
-            if packet.destination in addresses and packet.origin == self.call_address:
-                self.last_activity_timestamp = time.time()
+    # called again by the address we are already in the process of connecting
+    def receive_call(self, packet):
+        self.last_activity_timestamp = self.machine.clock.time()
+        # our acks were not received or not resolved, retry with the full origin address
+        self.machine.owner.short_address_peers.discard(self.call_address)
+        # restart the connecting process
+        self.last_ack_packet_timestamp = 0
+        self.call_started_timestamp = self.machine.clock.time()
+        self.call_timeout_timestamp = self.machine.clock.time() + self.call_timeout
 
-                address = self.call_address.decode('utf-8')
-                call_duration = int(current_time - self.call_started_timestamp)
-                self.machine.owner.log('Call ended by address ' + address + ' (call duration: ' + str(call_duration) + ' seconds)')
-    
-                if self.machine.owner.callback['disconnected'] != None:
-                    self.machine.owner.callback['disconnected'](self.call_address, call_duration)
+    # time of the next tick that can change state, see ale.Scheduler
+    def next_deadline(self):
+        if not self.active:
+            return None
 
-                self.machine.change_state(ale.ALE.STATE_SCANNING)
+        return min(self.call_timeout_timestamp, self.last_ack_packet_timestamp + ale.ALE.SCAN_WINDOW)
 
     def tick(self):
         if not self.active:
             return None
 
-        self.busy = True
-
-        # store current time to avoid multiple calls to time.time()
-        current_time = time.time()
+        # store current time to avoid multiple calls to self.machine.clock.time()
+        current_time = self.machine.clock.time()
 
         if self.machine.owner.modem != None and self.machine.owner.modem.carrier_sense:
             self.last_carrier_sense_timestamp = current_time
@@ -436,8 +418,7 @@ class StateConnecting:
             call_duration = int(current_time - self.call_started_timestamp)
             self.machine.owner.log('Call timed out, no acknowledgement from ' + address + ' (call duration: ' + str(call_duration) + ' seconds)')
             
-            if self.machine.owner.callback['disconnected'] != None:
-                self.machine.owner.callback['disconnected'](self.call_address, call_duration)
+            self.machine.queue_callback('disconnected', self.call_address, call_duration)
                 
             self.machine.change_state(ale.ALE.STATE_SCANNING)
 
@@ -446,8 +427,6 @@ class StateConnecting:
             self.last_ack_packet_timestamp = current_time
             self.machine.owner._send_ale(ale.ALE.CMD_ACK, self.call_address)
 
-        self.busy = False
-
 
 class StateConnected:
     """
@@ -465,11 +444,13 @@ class StateConnected:
         self.name = 'connected'
         self.state = ale.ALE.STATE_CONNECTED
         self.active = True
-        self.busy = False
         self.machine = machine
+        # command -> (guard, handler, next ale state), set by the state machine
+        self.transitions = {}
         self.call_timeout = 5 * 60 # seconds
 
         self.call_address = b''
+        self.calling_station = False
         self.last_carrier_sense_timestamp = 0
         self.last_activity_timestamp = 0
         self.call_started_timestamp = 0
@@ -489,16 +470,16 @@ class StateConnected:
     #   connecting
     def enter_state(self):
         self.call_address = self.machine.last_state.call_address
+        self.calling_station = self.machine.last_state == ale.ALE.STATE_CALLING
         self.call_started_timestamp = self.machine.last_state.call_started_timestamp
-        self.call_timeout_timestamp = time.time() + self.call_timeout
+        self.call_timeout_timestamp = self.machine.clock.time() + self.call_timeout
         
         address = self.call_address.decode('utf-8')
         scanlist = self.machine.owner.scanlist
         channel = self.machine.owner.channel
-        self.machine.owner.log('Incoming call from address ' + address + ' on channel ' + scanlist + ':' + channel)
+        self.machine.owner.log('Connected to address ' + address + ' on channel ' + scanlist + ':' + channel)
 
-        if self.machine.owner.callback['call'] != None:
-            self.machine.owner.callback['call'](self.call_address)
+        self.machine.queue_callback('connected', self.call_address)
 
         if self.machine.last_state != None:
             self.last_carrier_sense_timestamp = self.machine.last_state.last_carrier_sense_timestamp
@@ -509,40 +490,30 @@ class StateConnected:
     def leave_state(self):
         self.active = False
 
-    def receive_packet(self, packet):
-        if not self.active:
-            return None
+    # the called station is still acking the call, so the handshake ack was lost, only the calling station
+    # answers to avoid both stations acking each other indefinitely
+    def receive_ack(self, packet):
+        self.last_activity_timestamp = self.machine.clock.time()
 
-        # if packet.command == sound, do nothing
-
-        # if packet.command == ack, do nothing
-
-        # if packet.command == call, do nothing
-
-        # call ended
-        if packet.command == ale.ALE.CMD_END:
-            self.last_activity_timestamp = time.time()
+        if self.calling_station:
+            self.machine.owner._send_ale(ale.ALE.CMD_ACK, self.call_address)
 
-            address = self.call_address.decode('utf-8')
-            call_duration = int(current_time - self.call_started_timestamp)
-            self.machine.owner.log('Call ended by address ' + address + ' (call duration: ' + str(call_duration) + ' seconds)')
-    
-            if self.machine.owner.callback['disconnected'] != None:
-                self.machine.owner.callback['disconnected'](self.call_address, call_duration)
+    def keep_alive(self):
+        self.call_timeout_timestamp = self.machine.clock.time() + self.call_timeout
 
-            self.machine.change_state(ale.ALE.STATE_SCANNING)
+    # time of the next tick that can change state, see ale.Scheduler
+    def next_deadline(self):
+        if not self.active:
+            return None
 
-    def keep_alive(self):
-        self.call_timeout_timestamp = time.time() + self.call_timeout
+        return self.call_timeout_timestamp
 
     def tick(self):
         if not self.active:
             return None
 
-        self.busy = True
-
-        # store current time to avoid multiple calls to time.time()
-        current_time = time.time()
+        # store current time to avoid multiple calls to self.machine.clock.time()
+        current_time = self.machine.clock.time()
 
         if self.machine.owner.modem != None and self.machine.owner.modem.carrier_sense:
             self.last_carrier_sense_timestamp = current_time
@@ -554,13 +525,10 @@ class StateConnected:
             call_duration = int(current_time - self.call_started_timestamp)
             self.machine.owner.log('Call timed out, disconnected from ' + address + ' (call duration: ' + str(call_duration) + ' seconds)')
             
-            if self.machine.owner.callback['disconnected'] != None:
-                self.machine.owner.callback['disconnected'](self.call_address, call_duration)
+            self.machine.queue_callback('disconnected', self.call_address, call_duration)
                 
             self.machine.change_state(ale.ALE.STATE_SCANNING)
 
-        self.busy = False
-
 class StateSounding:
     """
     ALE state machine object (ale.ALE.STATE_SOUNDING)
@@ -577,8 +545,9 @@ class StateSounding:
         self.name = 'sounding'
         self.state = ale.ALE.STATE_SOUNDING
         self.active = False
-        self.busy = False
         self.machine = machine
+        # command -> (guard, handler, next ale state), set by the state machine
+        self.transitions = {}
 
         self.call_address = b''
         self.sound_timeout = 0
@@ -601,8 +570,8 @@ class StateSounding:
     def enter_state(self):
         # set sounding timeout based on number of channels in current scanlist
         self.sound_timeout = ale.ALE.SCAN_WINDOW * (len(self.machine.owner.channels.keys()) + 1) # seconds
-        self.sound_started_timestamp = time.time()
-        self.sound_timeout_timestamp = time.time() + self.sound_timeout
+        self.sound_started_timestamp = self.machine.clock.time()
+        self.sound_timeout_timestamp = self.machine.clock.time() + self.sound_timeout
         self.sound_rx_ack_count = 0
 
         scanlist = self.machine.owner.scanlist
@@ -620,34 +589,29 @@ class StateSounding:
     def leave_state(self):
         self.active = False
 
-    def receive_packet(self, packet):
+    # count sounding acks
+    def receive_ack(self, packet):
+        self.last_activity_timestamp = self.machine.clock.time()
+        self.sound_rx_ack_count += 1
+
+    # incoming call
+    def receive_call(self, packet):
+        self.last_activity_timestamp = self.machine.clock.time()
+        self.call_address = packet.origin
+
+    # time of the next tick that can change state, see ale.Scheduler
+    def next_deadline(self):
         if not self.active:
             return None
 
-        # if packet.command == sound, do nothing
-        
-        # count sounding acks
-        if packet.command == ale.ALE.CMD_ACK:
-            if packet.destination in self.machine.owner.addresses:
-                self.last_activity_timestamp = time.time()
-                self.sound_rx_ack_count += 1
-
-        # incoming call
-        if packet.command == ale.ALE.CMD_CALL:
-            self.last_activity_timestamp = time.time()
-            self.call_address = packet.origin
-            self.machine.change_state(ale.ALE.STATE_CONNECTING)
-            
-        # if packet.command == end, do nothing
+        return min(self.sound_timeout_timestamp, self.last_sound_packet_timestamp + ale.ALE.SCAN_WINDOW)
 
     def tick(self):
         if not self.active:
             return None
 
-        self.busy = True
-
-        # store current time to avoid multiple calls to time.time()
-        current_time = time.time()
+        # store current time to avoid multiple calls to self.machine.clock.time()
+        current_time = self.machine.clock.time()
 
         if self.machine.owner.modem != None and self.machine.owner.modem.carrier_sense:
             self.last_carrier_sense_timestamp = current_time
@@ -669,8 +633,6 @@ class StateSounding:
             self.last_sound_packet_timestamp = current_time
             self.machine.owner._send_ale(ale.ALE.CMD_SOUND, ale.ALE.ADDRESS_ALL)
 
-        self.busy = False
-
 
 class ALEStateMachine:
     """
@@ -697,62 +659,170 @@ class ALEStateMachine:
 
     def __init__(self, owner):
         self.owner = owner
-        self.states = []
+        self.clock = owner.clock
         self.state = None
         self.last_state = None
-
-        self.states.append(StateScanning(self))
-        self.states.append(StateCalling(self))
-        self.states.append(StateConnecting(self))
-        self.states.append(StateConnected(self))
-        self.states.append(StateSounding(self))
+        # held while ticking, handling a received packet or changing state, so that a packet received during a
+        # tick cannot change state part way through the tick. Reentrant since ticks and packet handlers change state.
+        self.lock = threading.RLock()
+        # user callbacks queued while the lock is held, see locked
+        self.callbacks = []
+        self.lock_depth = 0
+        # called with a StateEvent on each state transition
+        self.listeners = []
+
+        # ale state -> state object
+        self.states = {
+            ale.ALE.STATE_SCANNING: StateScanning(self),
+            ale.ALE.STATE_CALLING: StateCalling(self),
+            ale.ALE.STATE_CONNECTING: StateConnecting(self),
+            ale.ALE.STATE_CONNECTED: StateConnected(self),
+            ale.ALE.STATE_SOUNDING: StateSounding(self)
+        }
+
+        self.transitions = self._transition_table()
+
+        # transitions for each state keyed by command, avoids building a key tuple per received packet
+        for (ale_state, command), transition in self.transitions.items():
+            self.states[ale_state].transitions[command] = transition
 
         # set initial state
-        init_state_index = self.states.index(ale.ALE.STATE_SCANNING)
-        self.state = self.states[init_state_index]
+        self.state = self.states[ale.ALE.STATE_SCANNING]
         self.state.enter_state()
 
-    def change_state(self, ale_state):
-        # leave the current state
-        self.state.leave_state()
-        # wait for current state to finish working
-        while self.state.busy:
-            time.sleep(0.001)
-        # save the last state
-        self.last_state = self.state
-        # get the object for the next state
-        next_state_index = self.states.index(ale_state)
-        self.state = self.states[next_state_index]
-        # enter the next state
-        self.state.enter_state()
+    # (ale state, command) -> (guard, handler, next ale state)
+    #
+    # A received packet is dropped if there is no entry for the current state and packet command, or if the
+    # guard returns False. Otherwise the handler is called with the packet and, if the next state is not None,
+    # the state machine changes state. Guards and handlers are bound methods, so dispatch is a dict lookup.
+    def _transition_table(self):
+        scanning = self.states[ale.ALE.STATE_SCANNING]
+        calling = self.states[ale.ALE.STATE_CALLING]
+        connecting = self.states[ale.ALE.STATE_CONNECTING]
+        connected = self.states[ale.ALE.STATE_CONNECTED]
+        sounding = self.states[ale.ALE.STATE_SOUNDING]
+
+        return {
+            # other sounding packets are only stored for lqa
+            (ale.ALE.STATE_SCANNING, ale.ALE.CMD_SOUND):    (None, scanning.receive_sound, None),
+            (ale.ALE.STATE_SCANNING, ale.ALE.CMD_CALL):     (self._to_us, scanning.receive_call, ale.ALE.STATE_CONNECTING),
+            (ale.ALE.STATE_CALLING, ale.ALE.CMD_ACK):       (self._from_call_address, calling.receive_ack, ale.ALE.STATE_CONNECTED),
+            (ale.ALE.STATE_CALLING, ale.ALE.CMD_CALL):      (self._from_call_address, calling.receive_call, ale.ALE.STATE_CONNECTING),
+            (ale.ALE.STATE_CALLING, ale.ALE.CMD_END):       (self._from_call_address, self._receive_end, ale.ALE.STATE_SCANNING),
+            (ale.ALE.STATE_CONNECTING, ale.ALE.CMD_ACK):    (self._from_call_address, connecting.receive_ack, ale.ALE.STATE_CONNECTED),
+            (ale.ALE.STATE_CONNECTING, ale.ALE.CMD_CALL):   (self._from_call_address, connecting.receive_call, None),
+            (ale.ALE.STATE_CONNECTING, ale.ALE.CMD_END):    (self._from_call_address, self._receive_end, ale.ALE.STATE_SCANNING),
+            (ale.ALE.STATE_CONNECTED, ale.ALE.CMD_ACK):     (self._from_call_address, connected.receive_ack, None),
+            (ale.ALE.STATE_CONNECTED, ale.ALE.CMD_END):     (self._from_call_address, self._receive_end, ale.ALE.STATE_SCANNING),
+            (ale.ALE.STATE_SOUNDING, ale.ALE.CMD_ACK):      (self._to_us, sounding.receive_ack, None),
+            (ale.ALE.STATE_SOUNDING, ale.ALE.CMD_CALL):     (self._to_us, sounding.receive_call, ale.ALE.STATE_CONNECTING)
+        }
+
+    # guard, packet is addressed to one of our addresses or to any address
+    def _to_us(self, packet):
+        return packet.destination in self.owner.addresses or packet.destination == ale.ALE.ADDRESS_ANY
+
+    # guard, packet is from the station we are calling or connected to
+    def _from_call_address(self, packet):
+        return packet.destination in self.owner.addresses and packet.origin == self.state.call_address
+
+    # call ended by the remote station
+    def _receive_end(self, packet):
+        self.state.last_activity_timestamp = self.clock.time()
+
+        address = self.state.call_address.decode('utf-8')
+        call_duration = int(self.clock.time() - self.state.call_started_timestamp)
+        self.owner.log('Call ended by address ' + address + ' (call duration: ' + str(call_duration) + ' seconds)')
+
+        self.queue_callback('disconnected', self.state.call_address, call_duration)
+
+    # hold the lock, user callbacks queued while it is held are called once the outermost hold is released, so a
+    # callback can call into the station from another thread (e.g. ale.end) without deadlock. Listeners are still
+    # called under the lock, in transition order.
+    @contextlib.contextmanager
+    def locked(self):
+        with self.lock:
+            self.lock_depth += 1
+            try:
+                yield
+            finally:
+                self.lock_depth -= 1
+                callbacks = []
+                if self.lock_depth == 0:
+                    callbacks = self.callbacks
+                    self.callbacks = []
+
+        for func, args in callbacks:
+            func(*args)
+
+    # call the user callback (e.g. 'connected') with args once the lock is released, must be called with the lock held
+    def queue_callback(self, name, *args):
+        func = self.owner.callback.get(name)
+        if func != None:
+            self.callbacks.append((func, args))
+
+    def change_state(self, ale_state, packet=None):
+        with self.locked():
+            # leave the current state
+            self.state.leave_state()
+            # save the last state
+            self.last_state = self.state
+            # get the object for the next state
+            self.state = self.states[ale_state]
+            # enter the next state
+            self.state.enter_state()
+
+            if len(self.listeners) > 0:
+                command = packet.command if packet != None else None
+                event = StateEvent(self.clock.time(), self.last_state.state, self.state.state, command, self.state.call_address)
+                for listener in self.listeners:
+                    listener(event)
 
     def get_state(self):
         return self.state
 
     def get_state_object(self, ale_state):
-        state_index = self.states.index(ale_state)
-        return self.states[state_index]
+        return self.states[ale_state]
 
     def receive_packet(self, packet):
-        # pass ale packets to the current state for handling
-        self.state.receive_packet(packet)
+        with self.locked():
+            state = self.state
+            transition = state.transitions.get(packet.command)
+            if transition == None or not state.active:
+                return None
+
+            guard, handler, next_state = transition
+            if guard != None and not guard(packet):
+                return None
+
+            handler(packet)
+
+            if next_state != None:
+                self.change_state(next_state, packet)
 
     def keep_alive(self):
-        if self.state == ale.ALE.STATE_CONNECTED:
-            self.state.keep_alive()
+        with self.lock:
+            if self.state == ale.ALE.STATE_CONNECTED:
+                self.state.keep_alive()
 
     def send(self, data, keep_alive=False):
-        if self.state == ale.ALE.STATE_CONNECTED and self.machine.owner.modem != None:
-            self.machine.owner.modem.send(data)
-            if keep_alive:
-                self.keep_alive()
+        with self.lock:
+            if self.state == ale.ALE.STATE_CONNECTED and self.owner.modem != None:
+                self.owner.modem.send(data)
+                if keep_alive:
+                    self.keep_alive()
 
     def call(self, address):
-        self.change_state(ale.ALE.STATE_CALLING)
-        self.state.call_address = address
-        self.state.enter_state()
+        with self.locked():
+            # set before entering the calling state, so that the state event carries the new call address
+            self.states[ale.ALE.STATE_CALLING].call_address = address
+            self.change_state(ale.ALE.STATE_CALLING)
+
+    def next_deadline(self):
+        return self.state.next_deadline()
 
     def tick(self):
-        self.state.tick()
+        with self.locked():
+            self.state.tick()
 
 
@@ -0,0 +1,230 @@
+# Connected state transport module
+#
+# Fragments messages sent while connected, numbers the fragments, and uses selective repeat ARQ to
+# retransmit lost fragments. Received fragments are reassembled in order before the message is passed to
+# the rx callback. The transmit window is sized from the LQA confidence of the link.
+#
+# Data fragment:    type (1) | sequence number (2) | flags (1) | payload
+# Ack:              type (1) | next expected sequence number (2) | received bitmap (4)
+#
+# Bit n of the received bitmap is set if fragment (next expected + 1 + n) has been received.
+#
+# If a fragment is not acknowledged after the maximum number of retries the link is considered failed. The
+# transport stops sending and stops keeping the call alive, and is reset once the call times out.
+#
+# Fragments are received on the modem thread while the jobs thread ticks the transport, so the transport state
+# is guarded by the state machine lock. Reassembled messages are passed to the rx callback after the lock is
+# released.
+
+import struct
+import collections
+
+import ale
+
+
+class Transport:
+
+    TYPE_DATA   = 0x1
+    TYPE_ACK    = 0x2
+
+    FLAG_LAST   = 0x1 # last fragment of a message
+
+    DATA_HEADER = struct.Struct('>BHB')
+    ACK_HEADER  = struct.Struct('>BHI')
+
+    SEQUENCE_MODULO = 0x10000
+    FRAGMENT_SIZE = 128 # bytes
+    MIN_WINDOW = 1
+    MAX_WINDOW = 8
+    MAX_RETRIES = 20
+    ACK_DELAY = 0.5 # seconds
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.fragment_size = Transport.FRAGMENT_SIZE
+        self.reset()
+
+    def reset(self):
+        # transmit
+        self.tx_queue = collections.deque()
+        self.tx_unacked = {}
+        self.next_tx_sequence = 0
+        # receive
+        self.rx_buffer = {}
+        self.rx_fragments = []
+        self.next_rx_sequence = 0
+        self.ack_pending_timestamp = None
+        self.failed = False
+        # statistics
+        self.retransmit_count = 0
+
+    def window(self):
+        confidence = self.owner.lqa.link_confidence(self.owner.channel, self.owner.state_machine.state.call_address)
+        min_confidence = self.owner.modem_confidence
+
+        # scale the window linearly over a confidence range of 1.0 above the modem minimum confidence
+        scale = min(max(confidence - min_confidence, 0), 1)
+        return Transport.MIN_WINDOW + int(scale * (Transport.MAX_WINDOW - Transport.MIN_WINDOW))
+
+    def retransmit_timeout(self):
+        # time to transmit a full window of fragments in both directions, plus one scan window for turnaround
+        len_fragment = self.fragment_size + Transport.DATA_HEADER.size + 6
+        airtime = (len_fragment * 8) / self.owner.modem_baudrate
+        return (2 * self.window() * airtime) + ale.ALE.SCAN_WINDOW
+
+    def pending(self):
+        return len(self.tx_queue) > 0 or len(self.tx_unacked) > 0 or self.ack_pending_timestamp != None
+
+    def send(self, data):
+        with self.owner.state_machine.lock:
+            for i in range(0, max(len(data), 1), self.fragment_size):
+                last = (i + self.fragment_size) >= len(data)
+                self.tx_queue.append((data[i:i + self.fragment_size], last))
+
+    def receive(self, raw):
+        if len(raw) == 0:
+            return None
+
+        messages = []
+        with self.owner.state_machine.lock:
+            if raw[0] == Transport.TYPE_DATA and len(raw) >= Transport.DATA_HEADER.size:
+                messages = self._receive_data(raw)
+            elif raw[0] == Transport.TYPE_ACK and len(raw) >= Transport.ACK_HEADER.size:
+                self._receive_ack(raw)
+
+        for message in messages:
+            self.owner._deliver(message)
+
+    def _offset(self, sequence, base):
+        return (sequence - base) % Transport.SEQUENCE_MODULO
+
+    # returns the reassembled messages
+    def _receive_data(self, raw):
+        messages = []
+        packet_type, sequence, flags = Transport.DATA_HEADER.unpack_from(raw)
+        payload = bytes(raw[Transport.DATA_HEADER.size:])
+        offset = self._offset(sequence, self.next_rx_sequence)
+
+        # buffer fragments within the receive window, anything else is a duplicate
+        if offset < Transport.MAX_WINDOW:
+            self.rx_buffer[sequence] = (payload, flags)
+
+        # deliver in order fragments
+        while self.next_rx_sequence in self.rx_buffer:
+            payload, flags = self.rx_buffer.pop(self.next_rx_sequence)
+            self.rx_fragments.append(payload)
+            self.next_rx_sequence = (self.next_rx_sequence + 1) % Transport.SEQUENCE_MODULO
+
+            if flags & Transport.FLAG_LAST:
+                messages.append(b''.join(self.rx_fragments))
+                self.rx_fragments.clear()
+
+        # acknowledge after a short delay so that a burst of fragments is acknowledged once
+        if self.ack_pending_timestamp == None:
+            self.ack_pending_timestamp = self.owner.clock.time()
+
+        return messages
+
+    def _receive_ack(self, raw):
+        packet_type, next_sequence, bitmap = Transport.ACK_HEADER.unpack_from(raw)
+
+        for sequence in list(self.tx_unacked.keys()):
+            # cumulative ack, sequence numbers in the half of the sequence space before next_sequence
+            if 0 < self._offset(next_sequence, sequence) < (Transport.SEQUENCE_MODULO // 2):
+                del self.tx_unacked[sequence]
+                continue
+
+            # selective ack
+            offset = self._offset(sequence, next_sequence)
+            if offset > 0 and offset <= 32 and bitmap & (1 << (offset - 1)):
+                del self.tx_unacked[sequence]
+
+    def _send_ack(self):
+        bitmap = 0
+        for sequence in self.rx_buffer:
+            offset = self._offset(sequence, self.next_rx_sequence)
+            if offset > 0 and offset <= 32:
+                bitmap |= 1 << (offset - 1)
+
+        self.owner._send_data(Transport.ACK_HEADER.pack(Transport.TYPE_ACK, self.next_rx_sequence, bitmap), keep_alive=True)
+        self.ack_pending_timestamp = None
+
+    def _send_fragment(self, sequence, current_time):
+        payload, last, sent_timestamp, retries = self.tx_unacked[sequence]
+        flags = Transport.FLAG_LAST if last else 0
+
+        self.tx_unacked[sequence] = (payload, last, current_time, retries + 1)
+        self.owner._send_data(Transport.DATA_HEADER.pack(Transport.TYPE_DATA, sequence, flags) + payload, keep_alive=True)
+
+    def _tx_window_used(self):
+        if len(self.tx_unacked) == 0:
+            return 0
+
+        return max(self._offset(self.next_tx_sequence, sequence) for sequence in self.tx_unacked)
+
+    # time of the next tick with work to do, or None if idle, see ale.Scheduler
+    def next_deadline(self):
+        with self.owner.state_machine.lock:
+            return self._next_deadline()
+
+    def _next_deadline(self):
+        if self.owner.state_machine.state != ale.ALE.STATE_CONNECTED or self.failed:
+            return None
+
+        deadlines = []
+
+        if self.ack_pending_timestamp != None:
+            deadlines.append(self.ack_pending_timestamp + Transport.ACK_DELAY)
+
+        if len(self.tx_unacked) > 0:
+            timeout = self.retransmit_timeout()
+            deadlines.append(min(sent_timestamp for payload, last, sent_timestamp, retries in self.tx_unacked.values()) + timeout)
+
+        if len(self.tx_queue) > 0 and self._tx_window_used() < self.window():
+            deadlines.append(self.owner.clock.time())
+
+        return min(deadlines, default = None)
+
+    def tick(self):
+        with self.owner.state_machine.lock:
+            self._tick()
+
+    def _tick(self):
+        if self.owner.state_machine.state != ale.ALE.STATE_CONNECTED:
+            if self.pending() or self.failed:
+                self.reset()
+            return None
+
+        if self.failed:
+            return None
+
+        current_time = self.owner.clock.time()
+
+        if self.ack_pending_timestamp != None and current_time > (self.ack_pending_timestamp + Transport.ACK_DELAY):
+            self._send_ack()
+
+        # retransmit timed out fragments
+        timeout = self.retransmit_timeout()
+        for sequence in list(self.tx_unacked.keys()):
+            payload, last, sent_timestamp, retries = self.tx_unacked[sequence]
+            if current_time > (sent_timestamp + timeout):
+                if retries > Transport.MAX_RETRIES:
+                    self.owner.log('Transport fragment ' + str(sequence) + ' not acknowledged, link failed')
+                    self.failed = True
+                    return None
+                else:
+                    self.retransmit_count += 1
+                    self._send_fragment(sequence, current_time)
+
+        # send new fragments while the window, starting at the oldest unacked fragment, is open
+        window = self.window()
+        while len(self.tx_queue) > 0 and self._tx_window_used() < window:
+            payload, last = self.tx_queue.popleft()
+            sequence = self.next_tx_sequence
+            self.next_tx_sequence = (self.next_tx_sequence + 1) % Transport.SEQUENCE_MODULO
+            self.tx_unacked[sequence] = (payload, last, 0, 0)
+            self._send_fragment(sequence, current_time)
+
+        # keep the call alive while data is outstanding
+        if self.pending():
+            self.owner.state_machine.keep_alive()
@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+# run the tests against the package in this tree
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ale
+
+
+@pytest.fixture
+def simulator():
+    sim = ale.Simulator(seed = 1)
+    yield sim
+    sim.stop()
+
+
+# returns a function connecting two new stations over a strong link, config is passed to both stations
+@pytest.fixture
+def connect(simulator):
+    def connect(config=None):
+        caller = simulator.add_station('CALLER', config)
+        called = simulator.add_station('CALLED', config)
+        for channel in caller.channels:
+            simulator.set_link('CALLER', 'CALLED', channel, 2.5)
+
+        simulator.run(10)
+        caller.call(b'CALLED')
+        simulator.run(120)
+        assert caller.state_machine.state == ale.ALE.STATE_CONNECTED
+        assert called.state_machine.state == ale.ALE.STATE_CONNECTED
+
+        return (caller, called)
+
+    return connect
@@ -0,0 +1,65 @@
+import ale
+
+
+def colliding_address(address):
+    short = ale.AddressTable.short_address(address)
+    i = 0
+    while True:
+        candidate = b'COLLIDE' + str(i).encode('utf-8')
+        if ale.AddressTable.short_address(candidate) == short:
+            return candidate
+        i += 1
+
+
+def test_compress_resolve():
+    table = ale.AddressTable()
+    table.learn(b'STATION1')
+    short = table.compress(b'STATION1')
+
+    assert ale.AddressTable.is_short(short)
+    assert table.resolve(short) == b'STATION1'
+    assert table.compress(b'UNKNOWN1') == b'UNKNOWN1'
+
+
+def test_collision():
+    table = ale.AddressTable()
+    table.learn(b'STATION1')
+    table.learn(colliding_address(b'STATION1'))
+
+    assert table.compress(b'STATION1') == b'STATION1'
+    assert table.resolve(ale.AddressTable.short_address(b'STATION1')) == None
+
+
+def test_call_learns_str_address(simulator):
+    station = simulator.add_station('STATION1', {'packet': {'short_addresses': True}})
+    station.call('STATION2')
+
+    assert station.address_table.resolve(ale.AddressTable.short_address(b'STATION2')) == b'STATION2'
+
+
+# the caller knows another address with the same short address as the called station, so it can't resolve
+# a short origin address from the called station
+def test_call_with_collision(simulator):
+    config = {'packet': {'short_addresses': True}}
+    caller = simulator.add_station('CALLER', config)
+    called = simulator.add_station('CALLED', config)
+    caller.address_table.learn(colliding_address(b'CALLED'))
+
+    for channel in caller.channels:
+        simulator.set_link('CALLER', 'CALLED', channel, 2.5)
+
+    simulator.run(10)
+    caller.call(b'CALLED')
+    simulator.run(120)
+
+    assert caller.state_machine.state == ale.ALE.STATE_CONNECTED
+    assert called.state_machine.state == ale.ALE.STATE_CONNECTED
+    assert b'CALLER' not in called.short_address_peers
+
+
+def test_short_origin_after_short_destination(connect):
+    caller, called = connect({'packet': {'short_addresses': True}})
+
+    # each station sent the other its short address in the call handshake
+    assert b'CALLED' in caller.short_address_peers
+    assert b'CALLER' in called.short_address_peers
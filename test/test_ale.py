@@ -0,0 +1,168 @@
+import os
+import threading
+
+import pytest
+
+import ale
+
+
+# connected state data that starts like an ale frame is delivered, not dropped
+def test_connected_data_with_ale_preamble(connect):
+    caller, called = connect()
+    received = []
+    called.callback['rx'] = lambda data: received.append(bytes(data))
+    data = [b'ALMOST there', b'ALM\x00\x05hello', b'ALEhello', ale.Packet.BINARY_START + b'\x09']
+
+    for raw in data:
+        called._receive(raw, 2.0)
+
+    assert received == data
+    assert called.state_machine.state == ale.ALE.STATE_CONNECTED
+
+
+# an aggregated end packet is still handled while connected
+def test_connected_aggregate(connect):
+    caller, called = connect()
+    packets = [ale.Packet(b'CALLER', b'CALLED', command).pack() for command in (ale.ALE.CMD_ACK, ale.ALE.CMD_END)]
+
+    called._receive(ale.Packet.aggregate(packets), 2.0)
+
+    assert called.state_machine.state == ale.ALE.STATE_SCANNING
+
+
+# packets queued from other threads while the queue is sent are never lost
+def test_ale_queue_threads(simulator):
+    station = simulator.add_station('STATION1')
+    transmissions = []
+    station._transmit = transmissions.append
+    count = 500
+
+    def send():
+        for i in range(count):
+            station._send_ale(ale.ALE.CMD_ACK, b'STATION2')
+
+    threads = [threading.Thread(target = send) for i in range(4)]
+    for thread in threads:
+        thread.start()
+
+    while any(thread.is_alive() for thread in threads):
+        station._process_ale_queue()
+
+    for thread in threads:
+        thread.join()
+
+    station._process_ale_queue()
+
+    sent = sum(len(station._unpack_frame(raw)) for raw in transmissions)
+    assert sent == len(threads) * count
+
+
+def test_handshake_replaces_capabilities(simulator):
+    station = simulator.add_station('STATION1')
+    station.peer_capabilities[b'STATION2'] = ale.ALE.CAP_COMPRESSION + ale.ALE.CAP_TRANSPORT
+
+    # a handshake packet from a station that no longer advertises any capabilities
+    station._learn_capabilities(ale.Packet(b'STATION2', b'STATION1', ale.ALE.CMD_CALL, ale.Packet.pack_options({ale.Packet.OPTION_CAPABILITIES: b''})))
+    assert station.peer_capabilities[b'STATION2'] == b''
+
+    station.peer_capabilities[b'STATION2'] = ale.ALE.CAP_COMPRESSION
+    station._learn_capabilities(ale.Packet(b'STATION2', b'STATION1', ale.ALE.CMD_ACK))
+    assert station.peer_capabilities[b'STATION2'] == b''
+
+
+def test_binary_capability_learned_once(simulator):
+    station = simulator.add_station('STATION1')
+    raw = ale.Packet(b'STATION2', b'STATION1', ale.ALE.CMD_SOUND).pack(binary = True)
+
+    for i in range(10):
+        packet = ale.Packet()
+        packet.unpack(raw)
+        station._learn_capabilities(packet)
+
+    assert station.peer_capabilities[b'STATION2'] == ale.ALE.CAP_BINARY
+
+
+def test_empty_capabilities_sent_on_handshake(simulator):
+    station = simulator.add_station('STATION1')
+    assert station.capabilities() == b''
+    transmissions = []
+    station._transmit = transmissions.append
+
+    station._send_ale(ale.ALE.CMD_ACK, b'STATION2')
+    station._process_ale_queue()
+
+    packet = station._unpack_frame(transmissions[0])[0]
+    assert ale.Packet.unpack_options(packet.data) == {ale.Packet.OPTION_CAPABILITIES: b''}
+
+
+def simulate(seed):
+    simulator = ale.Simulator(seed = seed, start = 1000000000)
+    stations = [simulator.add_station('STATION%d' % i, {'lqa': {'channel_selection': 'thompson'}}) for i in range(4)]
+    for channel in stations[0].channels:
+        simulator.set_link('STATION0', 'STATION1', channel, 2.5)
+
+    simulator.run(5 * 60)
+    stations[0].call(b'STATION1')
+    simulator.run(5 * 60)
+    stations[0].end()
+    # soundings and sounding acks
+    simulator.run(2 * 60 * 60)
+
+    result = (
+        simulator.medium.frame_count,
+        simulator.medium.delivered_count,
+        simulator.call_latencies,
+        [dict(station.lqa.next_sound) for station in stations]
+    )
+
+    simulator.stop()
+    return result
+
+
+# a seed reproduces sounding intervals, sounding ack delays and channel selection, not only the medium
+def test_simulator_seed():
+    assert simulate(1) == simulate(1)
+    assert simulate(1) != simulate(2)
+
+
+def test_simulator_stop_removes_config_dir():
+    simulator = ale.Simulator(seed = 1)
+    simulator.add_station('STATION1')
+    simulator.run(60)
+    config_dir = simulator.config_dir
+    assert os.path.isdir(config_dir)
+
+    simulator.stop()
+    assert not os.path.exists(config_dir)
+
+
+# airtime of a burst of ack packets sent with and without aggregation, reported with pytest -s
+@pytest.mark.parametrize('burst', [2, 4, 8])
+def test_benchmark_aggregation_airtime(burst):
+    results = {}
+
+    for aggregate_window in (0, 0.1):
+        simulator = ale.Simulator(seed = 1)
+        station = simulator.add_station('STATION1', {'packet': {'aggregate_window': aggregate_window}})
+        frames = []
+        transmit = station._transmit
+        station._transmit = lambda raw: (frames.append(raw), transmit(raw))
+        simulator.run(1)
+
+        for i in range(burst):
+            station._send_ale(ale.ALE.CMD_ACK, b'STATION%d' % (i + 2))
+        simulator.run(30)
+        simulator.stop()
+
+        assert sum(len(station._unpack_frame(raw)) for raw in frames) == burst
+        results[aggregate_window] = (sum(simulator.medium.airtime.values()), simulator.medium.frame_count)
+
+    airtime, frame_count = results[0]
+    aggregated_airtime, aggregated_frame_count = results[0.1]
+    print('\n{} packets: {:.2f} s in {} frames, aggregated {:.2f} s in {} frames, {:.0%} airtime saved'.format(
+        burst, airtime, frame_count, aggregated_airtime, aggregated_frame_count, 1 - (aggregated_airtime / airtime)))
+
+    assert aggregated_frame_count == 1
+    # the aggregate header costs more than the modem delimiters it saves for a pair of packets
+    if burst > 2:
+        assert aggregated_airtime < airtime
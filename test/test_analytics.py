@@ -0,0 +1,143 @@
+import random
+import collections
+
+import pytest
+
+import ale
+
+numpy = pytest.importorskip('numpy')
+
+
+@pytest.fixture
+def station(simulator):
+    return simulator.add_station('STATION1')
+
+
+# packets from 5 origins on the first 4 channels over 50 minutes
+@pytest.fixture
+def history(simulator, station):
+    rng = random.Random(1)
+    channels = list(station.channels)[:4]
+
+    for i in range(300):
+        packet = ale.Packet(b'ORIGIN%d' % rng.randrange(5), b'STATION1', ale.ALE.CMD_SOUND)
+        packet.channel = rng.choice(channels)
+        packet.confidence = round(rng.uniform(0, 3), 2)
+        packet.timestamp = simulator.clock.time()
+        station.lqa.store(packet)
+        simulator.clock.advance(simulator.clock.time() + 10)
+
+    packets = station.lqa.packets()
+    assert len(packets) == 300
+    return packets
+
+
+def window(packets, since, until):
+    return [packet for packet in packets if (since == None or packet.timestamp >= since) and (until == None or packet.timestamp < until)]
+
+
+# numpy default (linear) percentile
+def percentile(values, q):
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + ((values[upper] - values[lower]) * (position - lower))
+
+
+def windows(history):
+    middle = history[len(history) // 2].timestamp
+    return [(None, None), (middle, None), (None, middle), (history[10].timestamp, history[100].timestamp)]
+
+
+def test_from_packets(station, history):
+    arrays = station.lqa.to_arrays()
+
+    assert len(arrays) == len(history)
+    assert arrays.channel_names == list(station.channels)
+    assert [arrays.origin_names[i] for i in arrays.origins] == [packet.origin for packet in history]
+    assert [arrays.channel_names[i] for i in arrays.channels] == [packet.channel for packet in history]
+    assert list(arrays.confidences) == [packet.confidence for packet in history]
+
+    # packet dicts give the same arrays
+    dict_arrays = ale.LQAArrays.from_packets([packet.to_dict() for packet in history], station.channels.keys())
+    assert dict_arrays.origin_names == arrays.origin_names
+    assert (dict_arrays.channels == arrays.channels).all()
+
+
+def test_channel_ranking(station, history):
+    arrays = station.lqa.to_arrays()
+
+    for since, until in windows(history):
+        confidences = collections.defaultdict(list)
+        for packet in window(history, since, until):
+            confidences[packet.channel].append(packet.confidence)
+
+        expected = [(channel, max(values), sum(values) / len(values), len(values)) for channel, values in confidences.items()]
+        expected.sort(key = lambda entry: (-entry[1], -entry[2]))
+
+        ranking = arrays.channel_ranking(since, until)
+        assert [(channel, count) for channel, maximum, mean, count in ranking] == [(channel, count) for channel, maximum, mean, count in expected]
+        for entry, expected_entry in zip(ranking, expected):
+            assert entry[1:3] == pytest.approx(expected_entry[1:3])
+
+
+def test_reachability(station, history):
+    arrays = station.lqa.to_arrays()
+
+    for since, until in windows(history):
+        expected = collections.defaultdict(float)
+        for packet in window(history, since, until):
+            expected[(packet.origin, packet.channel)] = max(expected[(packet.origin, packet.channel)], packet.confidence)
+
+        matrix = arrays.reachability(since, until)
+        assert matrix.shape == (len(arrays.origin_names), len(arrays.channel_names))
+        for row, origin in enumerate(arrays.origin_names):
+            for column, channel in enumerate(arrays.channel_names):
+                assert matrix[row, column] == expected[(origin, channel)]
+
+
+def test_percentiles(station, history):
+    arrays = station.lqa.to_arrays()
+    q = (10, 50, 90)
+
+    for since, until in windows(history):
+        confidences = collections.defaultdict(list)
+        for packet in window(history, since, until):
+            confidences[packet.channel].append(packet.confidence)
+
+        result = arrays.percentiles(q, since, until)
+        assert set(result) == set(confidences)
+        for channel, values in confidences.items():
+            assert list(result[channel]) == pytest.approx([percentile(values, p) for p in q])
+
+
+def test_activity(station, history):
+    arrays = station.lqa.to_arrays()
+    bucket_size = 600
+
+    for since, until in windows(history):
+        packets = window(history, since, until)
+        start = (min(packet.timestamp for packet in packets) // bucket_size) * bucket_size
+        expected = collections.Counter((int((packet.timestamp - start) // bucket_size), packet.channel) for packet in packets)
+
+        bucket_starts, counts = arrays.activity(bucket_size, since, until)
+        assert list(bucket_starts) == pytest.approx([start + (i * bucket_size) for i in range(len(bucket_starts))])
+        assert counts.sum() == len(packets)
+        for bucket in range(len(bucket_starts)):
+            for column, channel in enumerate(arrays.channel_names):
+                assert counts[bucket, column] == expected[(bucket, channel)]
+
+
+def test_empty_history(station):
+    arrays = station.lqa.to_arrays()
+    num_channels = len(station.channels)
+
+    assert len(arrays) == 0
+    assert arrays.channel_ranking() == []
+    assert arrays.reachability().shape == (0, num_channels)
+    assert arrays.percentiles() == {}
+
+    bucket_starts, counts = arrays.activity()
+    assert len(bucket_starts) == 0
+    assert counts.shape == (0, num_channels)
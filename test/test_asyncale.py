@@ -0,0 +1,243 @@
+import os
+import json
+import asyncio
+
+import pytest
+
+import ale
+
+
+# run the simulator on the event loop thread, frames received by asyncio stations are handled between steps.
+# speed paces simulated time against the event loop clock, which times asyncio timeouts and polling, or runs the
+# simulator as fast as possible if None
+async def drive(simulator, step, speed):
+    while True:
+        simulator.run(step)
+        await asyncio.sleep(step / speed if speed != None else 0)
+
+
+# run a coroutine function with the simulator driven in the background
+def run(simulator, func, step=0.1, speed=None):
+    async def main():
+        driver = asyncio.ensure_future(drive(simulator, step, speed))
+        try:
+            return await func()
+        finally:
+            driver.cancel()
+
+    return asyncio.run(main())
+
+
+# wait on the event loop while the simulator runs
+async def until(condition, timeout=5):
+    async def wait():
+        while not condition():
+            await asyncio.sleep(0.001)
+
+    await asyncio.wait_for(wait(), timeout)
+
+
+def add_stations(simulator, async_address, address):
+    station = simulator.add_station(async_address, factory = ale.AsyncALE)
+    other = simulator.add_station(address)
+    for channel in other.channels:
+        simulator.set_link(async_address, address, channel, 2.5)
+
+    return (station, other)
+
+
+def test_call(simulator):
+    station, called = add_stations(simulator, 'CALLER', 'CALLED')
+
+    async def main():
+        await station.start()
+        connection = await station.call('CALLED')
+        assert connection.connected
+        assert connection.address == b'CALLED'
+        # the called station connects on the handshake ack
+        await until(lambda: called.state_machine.state == ale.ALE.STATE_CONNECTED)
+        await station.stop()
+
+    run(simulator, main)
+
+
+# the call times out on every channel without an answer
+def test_call_no_answer(simulator):
+    station, other = add_stations(simulator, 'CALLER', 'OTHER')
+
+    async def main():
+        await station.start()
+        with pytest.raises(asyncio.TimeoutError):
+            await station.call(b'NOBODY')
+
+        assert station.ale.state_machine.state == ale.ALE.STATE_SCANNING
+        await station.stop()
+
+    run(simulator, main)
+
+
+# the call attempt is ended when the timeout passes first
+def test_call_timeout(simulator):
+    station, other = add_stations(simulator, 'CALLER', 'OTHER')
+
+    async def main():
+        await station.start()
+        with pytest.raises(asyncio.TimeoutError):
+            await station.call(b'NOBODY', timeout = 0.05)
+
+        assert station.ale.state_machine.state == ale.ALE.STATE_SCANNING
+        assert station.connection == None
+        await station.stop()
+
+    run(simulator, main)
+
+
+def test_accept(simulator):
+    station, caller = add_stations(simulator, 'CALLED', 'CALLER')
+
+    async def main():
+        await station.start()
+        caller.call(b'CALLED')
+        connection = await asyncio.wait_for(station.accept(), 30)
+        assert connection.address == b'CALLER'
+        assert caller.state_machine.state == ale.ALE.STATE_CONNECTED
+        await station.stop()
+
+    run(simulator, main)
+
+
+# received data is iterated until the remote station ends the call
+def test_receive_iterator(simulator):
+    station, caller = add_stations(simulator, 'CALLED', 'CALLER')
+    messages = [b'message %d' % i for i in range(5)]
+
+    async def main():
+        await station.start()
+        caller.call(b'CALLED')
+        connection = await asyncio.wait_for(station.accept(), 30)
+
+        for message in messages:
+            caller.send(message)
+        # let the data arrive before the end of the call
+        await until(lambda: caller.backlog() == 0)
+        caller.end()
+
+        received = []
+        async for data in connection:
+            received.append(data)
+
+        assert received == messages
+        assert not connection.connected
+        await station.stop()
+
+    run(simulator, main)
+
+
+# send returns only once the transmit backlog is below MAX_BACKLOG
+def test_send_backpressure(simulator, monkeypatch):
+    monkeypatch.setattr(ale.AsyncALE, 'MAX_BACKLOG', 2)
+    station, called = add_stations(simulator, 'CALLER', 'CALLED')
+    received = []
+    called.callback['rx'] = lambda data: received.append(bytes(data))
+    messages = [os.urandom(100) for i in range(10)]
+
+    async def main():
+        await station.start()
+        connection = await station.call(b'CALLED')
+        # data sent before the called station completes the handshake is dropped
+        await until(lambda: called.state_machine.state == ale.ALE.STATE_CONNECTED)
+
+        max_backlog = 0
+        for message in messages:
+            await connection.send(message)
+            max_backlog = max(max_backlog, station.ale.backlog())
+
+        assert max_backlog == ale.AsyncALE.MAX_BACKLOG
+        await until(lambda: received == messages)
+
+        await station.stop()
+
+    # sends poll the backlog on the event loop clock, so the call must not time out between polls
+    run(simulator, main, speed = 100)
+
+
+def test_send_not_connected(simulator):
+    station, called = add_stations(simulator, 'CALLER', 'CALLED')
+
+    async def main():
+        await station.start()
+        connection = await station.call(b'CALLED')
+        await connection.close()
+        await until(lambda: not connection.connected)
+
+        with pytest.raises(ConnectionError):
+            await connection.send(b'data')
+
+        await station.stop()
+
+    run(simulator, main)
+
+
+class IdleModem:
+
+    def __init__(self):
+        self.confidence = 1.5
+        self.carrier_sense = False
+        self._tx_buffer = []
+        self.stopped = False
+
+    def send(self, data):
+        pass
+
+    def set_rx_callback(self, func):
+        pass
+
+    def stop(self):
+        self.stopped = True
+
+
+class IdleRadio:
+
+    def set_vfo_a(self, freq):
+        pass
+
+    def set_sideband(self, sideband):
+        pass
+
+
+# stop ends the jobs task of a real time station
+def test_stop(tmp_path):
+    config_path = os.path.join(tmp_path, 'config')
+    with open(config_path, 'w') as fd:
+        json.dump({'address': 'STATION1', 'scanlist': 'General'}, fd)
+
+    station = ale.AsyncALE(config_path, modem = IdleModem(), radio = IdleRadio(), config_dir = str(tmp_path))
+
+    async def main():
+        await station.start()
+        await asyncio.sleep(0.1)
+        assert not station._task.done()
+
+        await asyncio.wait_for(station.stop(), 5)
+        assert station._task.done()
+        assert not station.ale.online
+        assert station.ale.modem.stopped
+
+    asyncio.run(main())
+
+
+# received data is copied on the modem thread, before the modem can reuse its buffer
+def test_received_data_copied(simulator):
+    station, other = add_stations(simulator, 'CALLER', 'OTHER')
+
+    async def main():
+        await station.start()
+        station.connection = ale.asyncale.Connection(station, b'OTHER')
+        buffer = bytearray(b'first')
+        station.ale.callback['rx'](memoryview(buffer))
+        buffer[:] = b'reuse'
+
+        assert await station.connection.__anext__() == b'first'
+        await station.stop()
+
+    run(simulator, main)
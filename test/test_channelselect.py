@@ -0,0 +1,132 @@
+import math
+
+import pytest
+
+import ale
+
+
+@pytest.fixture
+def station(simulator):
+    return simulator.add_station('STATION1', {'lqa': {'channel_selection': 'thompson'}})
+
+
+def sound(station, origin, channel, confidence):
+    packet = ale.Packet(origin, ale.ALE.ADDRESS_ANY, ale.ALE.CMD_SOUND)
+    packet.channel = channel
+    packet.confidence = confidence
+    packet.timestamp = station.clock.time()
+    station.lqa.store(packet)
+
+
+def test_selector_config(simulator, station):
+    assert isinstance(station.lqa.selector, ale.ThompsonSelector)
+    assert isinstance(simulator.add_station('STATION2').lqa.selector, ale.GreedySelector)
+
+
+def test_record(simulator, station):
+    selector = station.lqa.selector
+    channel = list(station.channels)[0]
+
+    selector.record(channel, b'STATION2', True)
+    selector.record(channel, b'STATION2', True)
+    selector.record(channel, b'STATION3', False)
+
+    current_time = simulator.clock.time()
+    assert selector._evidence(channel, current_time) == (2.0, 1.0)
+    assert selector._evidence((channel, b'STATION2'), current_time) == (2.0, 0.0)
+    assert selector._evidence((channel, b'STATION3'), current_time) == (0.0, 1.0)
+
+    # evidence decays over the outcome window
+    simulator.clock.advance(current_time + ale.ThompsonSelector.OUTCOME_WINDOW)
+    selector.record(channel, b'STATION2', False)
+    successes, failures = selector._evidence((channel, b'STATION2'), simulator.clock.time())
+    assert successes == pytest.approx(2.0 * math.exp(-1))
+    assert failures == pytest.approx(1.0)
+
+
+def test_prior(simulator, station):
+    selector = station.lqa.selector
+    channels = list(station.channels)
+    current_time = simulator.clock.time()
+    modem_confidence = station.modem_confidence
+
+    # no lqa
+    assert selector._prior(channels[0], b'STATION2', current_time) == 0.5
+
+    # address confidence above the modem minimum
+    sound(station, b'STATION2', channels[0], modem_confidence + 0.4)
+    assert selector._prior(channels[0], b'STATION2', current_time) == pytest.approx(0.4)
+
+    # channel confidence when the address was not heard on the channel
+    sound(station, b'STATION3', channels[1], modem_confidence + 0.3)
+    assert selector._prior(channels[1], b'STATION2', current_time) == pytest.approx(0.3)
+
+    # clamped
+    sound(station, b'STATION2', channels[2], modem_confidence + 5.0)
+    sound(station, b'STATION2', channels[3], modem_confidence - 1.0)
+    assert selector._prior(channels[2], b'STATION2', current_time) == 0.95
+    assert selector._prior(channels[3], b'STATION2', current_time) == 0.05
+
+
+# with converged posteriors the channel that answers is selected despite a better sounding channel
+def test_select_converged(station):
+    selector = station.lqa.selector
+    channels = list(station.channels)
+    sound(station, b'STATION2', channels[0], 3.0)
+
+    for i in range(100):
+        for channel in channels:
+            selector.record(channel, b'STATION2', channel == channels[2])
+
+    assert all(selector.select(b'STATION2', []) == channels[2] for i in range(50))
+    assert all(selector.select(b'STATION2', [channels[2]]) != channels[2] for i in range(50))
+
+
+def test_select_all_excluded(station):
+    channels = list(station.channels)
+    assert station.lqa.selector.select(b'STATION2', channels) == station.lqa.best_channel(b'STATION2', exclude = channels)
+
+
+# call latency and failed calls over repeated calls, where misleading soundings claim a dead channel is the best
+def evaluate(selection, misleading, calls=20, seed=1):
+    simulator = ale.Simulator(seed = seed)
+    caller = simulator.add_station('CALLER', {'lqa': {'channel_selection': selection}})
+    simulator.add_station('CALLED')
+    channels = list(caller.channels)
+
+    for channel in channels:
+        simulator.set_link('CALLER', 'CALLED', channel, 2.5)
+    if misleading:
+        simulator.set_link('CALLER', 'CALLED', channels[0], 0.0)
+
+    for i in range(calls):
+        if misleading:
+            sound(caller, b'CALLED', channels[0], 3.0)
+
+        caller.call(b'CALLED')
+        for second in range(600):
+            simulator.run(1)
+            if caller.state_machine.state != ale.ALE.STATE_CALLING:
+                break
+
+        caller.end()
+        # vary the call start against the scanning cycle of the called station
+        simulator.run(simulator.random.uniform(60, 600))
+
+    simulator.stop()
+    mean_latency = sum(simulator.call_latencies) / max(len(simulator.call_latencies), 1)
+    return (mean_latency, simulator.failed_calls)
+
+
+# greedy and thompson channel selection over the simulator, reported with pytest -s
+def test_benchmark_selection():
+    results = {}
+    for misleading in (False, True):
+        for selection in ('greedy', 'thompson'):
+            results[(selection, misleading)] = evaluate(selection, misleading)
+            mean_latency, failed_calls = results[(selection, misleading)]
+            print('\n{} soundings, {}: mean call latency {:.1f} s, {} failed calls'.format('misleading' if misleading else 'accurate', selection, mean_latency, failed_calls), end = '')
+    print()
+
+    # thompson sampling learns to avoid the channel that does not answer
+    assert results[('thompson', True)][0] < results[('greedy', True)][0]
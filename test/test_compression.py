@@ -0,0 +1,176 @@
+import os
+import lzma
+import time
+import random
+
+import pytest
+
+import ale
+
+
+TEXT = b'CQ CQ CQ DE STATION1 STATION1 K. GM OM TNX FER CALL UR RST 599 QTH NEAR DENVER NAME HOWARD HW CPY? BK'
+
+
+def test_round_trip():
+    compressor = ale.Compressor()
+    payloads = {
+        ale.Compressor.METHOD_RAW: os.urandom(100),
+        ale.Compressor.METHOD_DEFLATE: TEXT,
+        ale.Compressor.METHOD_LZMA: bytes(i % 251 for i in range(4096))
+    }
+
+    for method, data in payloads.items():
+        compressed = compressor.compress(data)
+        assert compressed[0] == method
+        assert compressor.decompress(compressed) == data
+
+    # each method round trips through the header regardless of which is smaller
+    for data in payloads.values():
+        assert compressor.decompress(bytes([ale.Compressor.METHOD_RAW]) + data) == data
+        assert compressor.decompress(bytes([ale.Compressor.METHOD_DEFLATE]) + compressor._deflate(data)) == data
+        lzma_data = lzma.compress(data, format = lzma.FORMAT_RAW, filters = ale.Compressor.LZMA_FILTERS)
+        assert compressor.decompress(bytes([ale.Compressor.METHOD_LZMA]) + lzma_data) == data
+
+
+# incompressible data is sent raw, one byte longer
+@pytest.mark.parametrize('length', [0, 1, 50, 1000])
+def test_raw_fallback(length):
+    compressor = ale.Compressor()
+    data = os.urandom(length)
+    compressed = compressor.compress(data)
+
+    assert compressed == bytes([ale.Compressor.METHOD_RAW]) + data
+    assert compressor.ratio() == (length + 1) / length if length > 0 else compressor.ratio() == 1.0
+
+
+def test_invalid_header():
+    compressor = ale.Compressor()
+    with pytest.raises(ValueError):
+        compressor.decompress(b'')
+    with pytest.raises(ValueError):
+        compressor.decompress(b'\x07data')
+
+
+def test_train_dictionary():
+    samples = [b'<message from STATION%d to STATION1: meet on 40 meters>' % i for i in range(20)]
+    dictionary = ale.Compressor.train_dictionary(samples, size = 64)
+
+    assert 0 < len(dictionary) <= 64
+    # segments shared by every sample are in the dictionary, segments of a single sample are not
+    assert b' meters>' in dictionary
+    assert b'STATION7' not in dictionary
+
+    trained = ale.Compressor(dictionary = dictionary)
+    default = ale.Compressor()
+    data = b'<message from STATION7 to STATION1: meet on 40 meters>'
+    assert len(trained.compress(data)) < len(default.compress(data))
+    assert trained.decompress(trained.compress(data)) == data
+
+
+# frames received at the modem of the station
+def record_frames(station):
+    frames = []
+    callback = station.modem.rx_callback
+
+    def receive(data, confidence):
+        frames.append(bytes(data))
+        callback(data, confidence)
+
+    station.modem.set_rx_callback(receive)
+    return frames
+
+
+def test_negotiated(simulator, connect):
+    caller, called = connect({'packet': {'compression': True}})
+    assert caller.compression_negotiated() and called.compression_negotiated()
+
+    received = []
+    called.callback['rx'] = lambda data: received.append(bytes(data))
+    frames = record_frames(called)
+
+    caller.send(TEXT)
+    simulator.run(30)
+
+    assert received == [TEXT]
+    assert frames[-1][0] == ale.Compressor.METHOD_DEFLATE
+    assert len(frames[-1]) < len(TEXT)
+
+
+# compression is only used if both stations advertise it in the call handshake
+def test_not_negotiated_one_sided(simulator):
+    caller = simulator.add_station('CALLER', {'packet': {'compression': True}})
+    called = simulator.add_station('CALLED')
+    for channel in caller.channels:
+        simulator.set_link('CALLER', 'CALLED', channel, 2.5)
+
+    simulator.run(10)
+    caller.call(b'CALLED')
+    simulator.run(120)
+    assert called.state_machine.state == ale.ALE.STATE_CONNECTED
+    assert caller.supports(b'CALLED', ale.ALE.CAP_COMPRESSION) == False
+    assert called.supports(b'CALLER', ale.ALE.CAP_COMPRESSION)
+    assert not caller.compression_negotiated() and not called.compression_negotiated()
+
+    received = []
+    called.callback['rx'] = lambda data: received.append(bytes(data))
+    frames = record_frames(called)
+
+    caller.send(TEXT)
+    simulator.run(30)
+
+    assert received == [TEXT]
+    assert frames[-1] == TEXT
+
+
+# corrupted or unknown compressed payloads are dropped without raising
+@pytest.mark.parametrize('payload', [b'', b'\x07unknown method', b'\x01\xff\xff not deflate', b'\x02 not lzma'])
+def test_receive_corrupted(connect, payload):
+    caller, called = connect({'packet': {'compression': True}})
+    received = []
+    called.callback['rx'] = lambda data: received.append(bytes(data))
+
+    called._receive(payload, 2.0)
+
+    assert received == []
+    assert called.state_machine.state == ale.ALE.STATE_CONNECTED
+
+
+# representative connected state payloads
+def payloads():
+    rng = random.Random(1)
+    names = [b'STATION%d' % i for i in range(10)]
+    words = TEXT.split()
+
+    chat = [b' '.join(rng.choice(words) for i in range(rng.randint(5, 20))) for j in range(50)]
+    lxmf = [b'\x94\xc4\x10' + os.urandom(16) + b'\xc4\x10' + os.urandom(16) + b'\xcb' + os.urandom(8) + b'\x84\xa5title\xa0\xa7content\xda' + rng.choice(chat) + b'\xa6fields\x80' for i in range(50)]
+    report = [b'\n'.join(b'%s 40A %.1f %d' % (rng.choice(names), rng.uniform(0, 3), rng.randint(0, 10 ** 9)) for i in range(40)) for j in range(10)]
+    binary = [os.urandom(rng.randint(20, 500)) for i in range(50)]
+
+    return {'chat': chat, 'lxmf': lxmf, 'report': report, 'binary': binary}
+
+
+# compression ratio and cpu time per payload type, with the hand-written and a trained dictionary, reported with pytest -s
+def test_benchmark_compression():
+    samples = payloads()
+    # trained on the first half of each payload type, measured on the second half
+    training = [sample for data in samples.values() for sample in data[:len(data) // 2]]
+    dictionaries = {'preset': ale.Compressor.PRESET_DICTIONARY, 'trained': ale.Compressor.train_dictionary(training)}
+
+    print()
+    for name, data in samples.items():
+        data = data[len(data) // 2:]
+
+        for dictionary_name, dictionary in dictionaries.items():
+            compressor = ale.Compressor(dictionary = dictionary)
+            compressed = [compressor.compress(sample) for sample in data]
+
+            start = time.process_time()
+            for sample in compressed:
+                assert compressor.decompress(sample) in data
+            decompress_time = time.process_time() - start
+
+            print('{:8} {:8} ratio {:.2f}, compress {:.0f} us, decompress {:.0f} us per payload'.format(
+                name, dictionary_name, compressor.ratio(), compressor.cpu_time / len(data) * 1e6, decompress_time / len(data) * 1e6))
+
+            # never more than the one byte header larger
+            assert compressor.bytes_out <= compressor.bytes_in + len(data)
@@ -0,0 +1,73 @@
+import os
+import random
+
+import pytest
+
+import ale
+
+
+def test_round_trip():
+    fec = ale.FEC()
+    data = os.urandom(600)
+    decoded, corrections = fec.decode(fec.encode(data))
+
+    assert decoded == data
+    assert corrections == 0
+
+
+@pytest.mark.parametrize('errors', [1, 3, 5])
+def test_correct_byte_errors(errors):
+    rng = random.Random(errors)
+    fec = ale.FEC()
+    data = ale.Packet(b'STATION1', b'STATION2', b'CS').pack()
+    raw = bytearray(fec.encode(data))
+
+    for position in rng.sample(range(len(ale.FEC.PREAMBLE) + ale.FEC.HEADER.size, len(raw)), errors):
+        raw[position] ^= 1 << rng.randrange(8)
+
+    assert fec.decode(bytes(raw)) == (data, errors)
+
+
+def test_frame_length():
+    fec = ale.FEC()
+
+    for length in (0, 1, 245, 246, 1000):
+        raw = fec.encode(bytes(length))
+        assert fec.frame_length(raw) == len(raw)
+        assert fec.frame_length(raw[:len(ale.FEC.PREAMBLE) + 1]) == None
+
+    raw = bytearray(fec.encode(bytes(100)))
+    raw[len(ale.FEC.PREAMBLE)] ^= 0x1
+    with pytest.raises(ValueError):
+        fec.frame_length(raw)
+
+    # a corrupted header does not stop a frame from being decoded
+    assert fec.decode(bytes(raw)) == (bytes(100), 0)
+
+
+def test_exact_preamble():
+    assert ale.FEC.is_fec(b'AXF...')
+    assert not ale.FEC.is_fec(b'AXF...', exact = True)
+    assert ale.FEC.is_fec(b'ALF...', exact = True)
+
+
+# inject bit errors into fec frames received while connected, frames with the fec preamble never reach the application
+def test_bit_error_injection(connect):
+    caller, called = connect({'packet': {'fec': True}})
+    rng = random.Random(2)
+    received = []
+    called.callback['rx'] = lambda data: received.append(bytes(data))
+
+    frames = []
+    for i in range(200):
+        raw = bytearray(caller.fec.encode(ale.Packet(b'CALLER', b'CALLED', b'CA').pack()))
+        for j in range(rng.randint(1, 40)):
+            raw[rng.randrange(len(raw))] ^= 1 << rng.randrange(8)
+        frames.append(bytes(raw))
+
+    for raw in frames:
+        called._receive(raw, 2.0)
+
+    # frames with an exact preamble are decoded or dropped, anything else is connected state data passed on unchanged
+    assert all(not ale.FEC.is_fec(data, exact = True) and data in frames for data in received)
+    assert called.state_machine.state == ale.ALE.STATE_CONNECTED
@@ -0,0 +1,504 @@
+import time
+import tracemalloc
+import threading
+import itertools
+import random
+
+import pytest
+
+import ale
+from ale.lqa import LinkStats, PropagationHistogram
+
+
+@pytest.fixture
+def station(simulator):
+    return simulator.add_station('STATION1')
+
+
+def receive(station, origin, channel, confidence, timestamp=None):
+    packet = ale.Packet(origin, b'STATION1', ale.ALE.CMD_SOUND)
+    packet.channel = channel
+    packet.confidence = confidence
+    packet.timestamp = timestamp if timestamp != None else station.clock.time()
+    station.lqa.store(packet)
+    return packet
+
+
+def test_best_channel(station):
+    channels = list(station.channels)
+    receive(station, b'STATION2', channels[0], 1.0)
+    receive(station, b'STATION2', channels[1], 2.0)
+    receive(station, b'STATION3', channels[2], 2.1)
+
+    assert station.lqa.best_channel() == channels[2]
+    assert station.lqa.best_channel(b'STATION2') == channels[1]
+    assert station.lqa.best_channel(exclude = [channels[2]]) == channels[1]
+
+
+def test_expiry(simulator, station):
+    channel = list(station.channels)[0]
+    receive(station, b'STATION2', channel, 2.0)
+    assert station.lqa.link_confidence(channel, b'STATION2') == 2.0
+
+    simulator.clock.advance(simulator.clock.time() + ale.LQA.SOUND_WINDOW + 1)
+    assert station.lqa.link_confidence(channel, b'STATION2') == 0.0
+    assert station.lqa.channel_stats[channel].count(simulator.clock.time()) == 0
+
+
+def test_history_bounded(station):
+    channel = list(station.channels)[0]
+    for i in range(ale.LQA.MAX_HISTORY * 2):
+        receive(station, b'STATION2', channel, 1.0)
+
+    assert len(station.lqa.channel_stats[channel].history) == ale.LQA.MAX_HISTORY
+    assert station.lqa.channel_stats[channel].total == ale.LQA.MAX_HISTORY * 2
+
+
+# best channel cost with 1k, 100k and 1M stored packets, reported with pytest -s
+@pytest.mark.parametrize('count', [1000, 100000, 1000000])
+def test_benchmark_best_channel(simulator, station, count):
+    rng = random.Random(count)
+    channels = list(station.channels)
+
+    for i in range(count):
+        packet = ale.Packet(b'ORIGIN%d' % (i % 50), b'STATION1', ale.ALE.CMD_SOUND)
+        packet.channel = channels[i % len(channels)]
+        packet.confidence = rng.uniform(0, 3)
+        packet.timestamp = simulator.clock.time()
+        # the history store is not part of the benchmark
+        station.lqa._update(packet)
+
+        if i % 100 == 0:
+            simulator.clock.advance(simulator.clock.time() + 1)
+
+    calls = 1000
+    start = time.perf_counter()
+    for i in range(calls):
+        station.lqa.best_channel(b'ORIGIN1')
+    elapsed = (time.perf_counter() - start) / calls
+
+    print('\n{} packets: best_channel {:.1f} us'.format(count, elapsed * 1e6))
+    assert station.lqa.best_channel(b'ORIGIN1') in channels
+
+
+# packets held across the stats tables
+def held_packets(lqa):
+    return [packet for stats in (lqa.channel_stats, lqa.address_stats, lqa.remote_stats) for link_stats in list(stats.values()) for packet in link_stats.history]
+
+
+# channel selection and reports on other threads while the receive thread stores packets and evicts entries, and
+# the jobs thread expires and culls
+def test_threaded_stress(simulator, station, monkeypatch):
+    monkeypatch.setattr(ale.LQA, 'MAX_KEYS', 50)
+    channels = list(station.channels)
+    errors = []
+    stop = threading.Event()
+
+    def run(func):
+        try:
+            while not stop.is_set():
+                func()
+        except Exception as e:
+            errors.append(e)
+            raise
+
+    def read(rng):
+        address = b'ORIGIN%d' % rng.randrange(200)
+        station.lqa.best_channel(address)
+        station.lqa.address_report(address)
+        station.lqa.channel_report()
+        station.lqa.digest(100)
+
+    def cull(counter):
+        station.lqa.tick()
+        if next(counter) % 10 == 0:
+            station.lqa._cull_history()
+
+    threads = [threading.Thread(target = run, args = (lambda rng=random.Random(i): read(rng),)) for i in range(4)]
+    threads.append(threading.Thread(target = run, args = (lambda counter=itertools.count(): cull(counter),)))
+    for thread in threads:
+        thread.start()
+
+    rng = random.Random(1)
+    packets = []
+    for i in range(10000):
+        packets.append(receive(station, b'ORIGIN%d' % rng.randrange(200), rng.choice(channels), rng.uniform(0, 3)))
+        if i % 100 == 0:
+            station.lqa.merge_digest(b'ORIGIN%d' % rng.randrange(200), station.lqa.digest(100))
+        if i % 1000 == 0:
+            simulator.clock.advance(simulator.clock.time() + 600)
+
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(station.lqa.histograms) <= 50 + len(channels)
+    assert station.lqa.verify_stats()
+
+    # the channel history is the bounded history of the stored packets within the sound window
+    current_time = simulator.clock.time()
+    for channel in channels:
+        expected = [packet for packet in packets if packet.channel == channel][-ale.LQA.MAX_HISTORY:]
+        expected = [packet for packet in expected if current_time <= packet.timestamp + ale.LQA.SOUND_WINDOW]
+        assert list(station.lqa.channel_stats[channel].snapshot(current_time)) == expected
+
+    # address entries hold the newest stored packets of their channel and origin, fewer if evicted and recreated since
+    for (channel, origin), link_stats in list(station.lqa.address_stats.items()):
+        history = link_stats.snapshot(current_time)
+        expected = [packet for packet in packets if (packet.channel, packet.origin) == (channel, origin)][-ale.LQA.MAX_HISTORY:]
+        expected = [packet for packet in expected if current_time <= packet.timestamp + ale.LQA.SOUND_WINDOW]
+        assert history == tuple(expected[len(expected) - len(history):])
+
+    # the packet count matches the channel, address and remote tables
+    assert len(station.lqa.remote_stats) > 0
+    assert station.lqa.packet_count == len(held_packets(station.lqa))
+
+
+def ack(station, origin, destination, channel, confidence):
+    packet = ale.Packet(origin, destination, ale.ALE.CMD_ACK)
+    packet.channel = channel
+    packet.confidence = confidence
+    packet.timestamp = station.clock.time()
+    station.lqa.store(packet)
+
+
+def test_should_ack_sound(simulator, station):
+    channel = list(station.channels)[0]
+    max_packet_count, min_confidence = station.lqa.ack_thresholds()
+    assert station.lqa.should_ack_sound(channel, b'SOUNDER')
+
+    # weak acks are not counted
+    for i in range(max_packet_count + 1):
+        ack(station, b'OTHER%d' % i, b'SOUNDER', channel, min_confidence - 0.1)
+    assert station.lqa.should_ack_sound(channel, b'SOUNDER')
+
+    for i in range(max_packet_count + 1):
+        ack(station, b'OTHER%d' % i, b'SOUNDER', channel, min_confidence + 0.1)
+    assert not station.lqa.should_ack_sound(channel, b'SOUNDER')
+    assert station.lqa.should_ack_sound(list(station.channels)[1], b'SOUNDER')
+
+    simulator.clock.advance(simulator.clock.time() + (ale.ALE.SCAN_WINDOW * ale.LQA.SHOULD_ACK_WINDOW) + 1)
+    assert station.lqa.should_ack_sound(channel, b'SOUNDER')
+
+
+# a flood of acks from and to distinct stations is bounded by the packet budget, keeping the newest packets
+def test_packet_budget(simulator, station, monkeypatch):
+    monkeypatch.setattr(ale.LQA, 'MAX_PACKETS', 1000)
+    rng = random.Random(1)
+    channels = list(station.channels)
+    count = 20000
+
+    for i in range(count):
+        ack(station, b'ORIGIN%d' % i, b'DESTINATION%d' % i, rng.choice(channels), 2.0)
+        simulator.clock.advance(simulator.clock.time() + 1)
+
+        if i % 1000 == 0:
+            assert station.lqa.packet_count <= ale.LQA.MAX_PACKETS
+
+    packets = held_packets(station.lqa)
+    assert len(packets) == station.lqa.packet_count
+    assert station.lqa.packet_count <= ale.LQA.MAX_PACKETS
+    # packets are held by the channel and the address stats, the oldest are evicted first
+    assert min(packet.timestamp for packet in packets) >= simulator.clock.time() - (ale.LQA.MAX_PACKETS / 2)
+    assert station.lqa.verify_stats()
+
+    # the ack index is culled with the channel history, keeping the acks stored since the last eviction
+    ack_window = ale.ALE.SCAN_WINDOW * ale.LQA.SHOULD_ACK_WINDOW
+    ack_entries = sum(len(destinations) for destinations in station.lqa.ack_index.values())
+    assert ack_entries <= (ale.LQA.MAX_PACKETS * ale.LQA.EVICT_FRACTION / 2) + ack_window
+
+    # expiry keeps the count
+    simulator.clock.advance(simulator.clock.time() + ale.LQA.SOUND_WINDOW + 1)
+    station.lqa.tick()
+    assert station.lqa.packet_count == len(held_packets(station.lqa)) == 0
+    assert station.lqa.ack_index == {}
+
+
+# thresholds are set per scanlist, and the index is rebuilt when the min confidence changes
+def test_ack_thresholds_per_scanlist(station):
+    channel = list(station.channels)[0]
+    for i in range(3):
+        ack(station, b'OTHER%d' % i, b'SOUNDER', channel, 1.0)
+
+    assert station.lqa.should_ack_sound(channel, b'SOUNDER')
+
+    station.ack_thresholds = {station.scanlist: {'max_packet_count': 2, 'min_confidence': 0.5}}
+    assert station.lqa.ack_thresholds() == (2, 0.5)
+    assert not station.lqa.should_ack_sound(channel, b'SOUNDER')
+
+
+# scanning tick cost with a sounding ack pending and a full channel history, reported with pytest -s
+def test_benchmark_tick_sound_pending(simulator, station):
+    channel = station.channel
+    rng = random.Random(1)
+    for i in range(ale.LQA.MAX_HISTORY):
+        ack(station, b'OTHER%d' % (i % 20), b'SOUNDER%d' % (i % 5), channel, rng.uniform(0, 3))
+
+    scanning = station.state_machine.state
+    assert scanning == ale.ALE.STATE_SCANNING
+    sound = ale.Packet(b'SOUNDER0', b'', ale.ALE.CMD_SOUND)
+    # the ack delay does not pass during the benchmark
+    sound.timestamp = simulator.clock.time() + 60
+
+    ticks = 10000
+    start = time.perf_counter()
+    for i in range(ticks):
+        scanning.received_sound_packet = sound
+        station.state_machine.tick()
+    elapsed = (time.perf_counter() - start) / ticks
+
+    print('\nscanning tick with a sounding pending: {:.1f} us'.format(elapsed * 1e6))
+    assert station.state_machine.state == ale.ALE.STATE_SCANNING
+
+
+# with the pickle store, history since a time merges the history saved on shutdown with packets received since
+def test_packets_since_pickle(simulator, station):
+    channel = list(station.channels)[0]
+    start = simulator.clock.time()
+    receive(station, b'STATION2', channel, 1.0)
+    station.lqa.save_history()
+
+    # the saved packet has expired, so it is not loaded into memory on startup
+    simulator.clock.advance(start + ale.LQA.SOUND_WINDOW + 60)
+    station = simulator.add_station('STATION1B')
+    station.lqa.backend = ale.PickleHistoryStore(simulator.get_station('STATION1').lqa.history_path)
+    station.lqa.load_history()
+    receive(station, b'STATION3', channel, 2.0)
+
+    packets = station.lqa.packets(since = start - 1)
+    assert [(packet.origin, packet.confidence) for packet in packets] == [(b'STATION2', 1.0), (b'STATION3', 2.0)]
+    assert [packet.origin for packet in station.lqa.packets(since = start + 1)] == [b'STATION3']
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'journal'])
+def test_packets_since_store(simulator, backend):
+    station = simulator.add_station('STATION1', {'lqa': {'backend': backend}})
+    channel = list(station.channels)[0]
+    start = simulator.clock.time()
+
+    for i in range(5):
+        receive(station, b'STATION2', channel, 1.0)
+        simulator.clock.advance(simulator.clock.time() + 60)
+
+    assert len(station.lqa.packets(since = start - 1)) == 5
+    assert len(station.lqa.packets(since = start + 90)) == 3
+
+
+# back-dated second-hand observations are kept in timestamp order
+def test_back_dated_observation(simulator):
+    stats = LinkStats()
+    current_time = simulator.clock.time()
+
+    fresh = ale.Packet(b'STATION2', b'STATION3', b'')
+    fresh.timestamp = current_time
+    fresh.confidence = 1.0
+    stats.update(fresh)
+
+    old = ale.Packet(b'STATION2', b'STATION3', b'')
+    old.timestamp = current_time - (59 * 60)
+    old.confidence = 2.0
+    stats.update(old)
+
+    assert stats.max(current_time) == 2.0
+    assert stats.verify(current_time) == []
+
+    current_time += 2 * 60
+    assert stats.max(current_time) == 1.0
+    assert stats.count(current_time) == 1
+    assert stats.verify(current_time) == []
+
+
+def test_merge_back_dated_digest(simulator):
+    station = simulator.add_station('STATION1')
+    peers = [simulator.add_station('STATION2'), simulator.add_station('STATION4')]
+    channel = list(station.channels)[0]
+    station.address_table.learn(b'STATION3')
+
+    # the second peer heard the station earlier, so its observation is older than the first one merged
+    receive(peers[0], b'STATION3', channel, 1.0)
+    receive(peers[1], b'STATION3', channel, 2.0, simulator.clock.time() - (30 * 60))
+
+    for peer in peers:
+        station.lqa.merge_digest(peer.address, peer.lqa.digest(100))
+
+    current_time = simulator.clock.time()
+    for key in (channel, (channel, b'STATION3')):
+        remote = station.lqa.remote_stats[key]
+        timestamps = [packet.timestamp for packet in remote.history]
+        assert timestamps == sorted(timestamps)
+        assert remote.max(current_time) == 2.0
+        assert remote.verify(current_time) == []
+
+
+# the peaks deque is bounded by the history, which drops its oldest packet when full
+def test_peaks_bounded(simulator):
+    stats = LinkStats()
+    current_time = simulator.clock.time()
+
+    for i in range(ale.LQA.MAX_HISTORY * 2):
+        packet = ale.Packet(b'STATION2', b'STATION1', b'')
+        packet.timestamp = current_time
+        # every packet is a peak until it leaves the history
+        packet.confidence = 10000.0 - i
+        stats.update(packet)
+
+        assert len(stats.peaks) <= len(stats.history)
+
+    assert len(stats.history) == ale.LQA.MAX_HISTORY
+    assert len(stats.peaks) == ale.LQA.MAX_HISTORY
+    assert stats.max(current_time) == 10000.0 - ale.LQA.MAX_HISTORY
+    assert stats.verify(current_time) == []
+
+
+# the history store is flushed and culled from the jobs loop without further packets
+def test_flush_and_cull_from_jobs(simulator):
+    station = simulator.add_station('STATION1', {'lqa': {'backend': 'sqlite'}})
+    channel = list(station.channels)[0]
+    receive(station, b'STATION2', channel, 1.0)
+    assert len(station.lqa.backend.pending) == 1
+
+    simulator.run(ale.LQA.FLUSH_INTERVAL + 1)
+    assert len(station.lqa.backend.pending) == 0
+    assert not station.lqa.flush_pending
+
+    # expired stats are dropped and the history store is culled without receiving
+    cull_timestamp = station.lqa.next_history_cull_timestamp
+    simulator.run(ale.LQA.SOUND_WINDOW + 60)
+    assert station.lqa.next_history_cull_timestamp > cull_timestamp
+    assert station.lqa.link_confidence(channel, b'STATION2') == 0.0
+
+
+# memory use under a steady packet stream over simulated hours, reported with pytest -s
+def test_benchmark_memory_steady_stream(simulator, station):
+    rng = random.Random(1)
+    channels = list(station.channels)
+    hours = 6
+    # packets per simulated minute
+    rate = 60
+    samples = []
+
+    tracemalloc.start()
+    try:
+        for minute in range(hours * 60):
+            for i in range(rate):
+                receive(station, b'ORIGIN%d' % rng.randrange(100), rng.choice(channels), rng.uniform(0, 3))
+            simulator.run(60)
+
+            if minute % 60 == 59:
+                current, peak = tracemalloc.get_traced_memory()
+                history = sum(len(stats.history) for stats in station.lqa.channel_stats.values())
+                peaks = sum(len(stats.peaks) for stats in station.lqa.channel_stats.values())
+                samples.append((current, history, peaks, len(station.lqa.expiry_heap)))
+    finally:
+        tracemalloc.stop()
+
+    print()
+    for hour, (current, history, peaks, heap) in enumerate(samples):
+        print('hour {}: {:.0f} kB traced, {} channel history, {} channel peaks, {} heap entries'.format(hour + 1, current / 1024, history, peaks, heap))
+
+    # after the first sound window the working set stops growing
+    assert samples[-1][0] < samples[1][0] * 1.5
+    assert samples[-1][2] <= samples[-1][1]
+    assert samples[-1][3] <= len(station.lqa.channel_stats) + len(station.lqa.address_stats) + len(station.lqa.remote_stats)
+    assert station.lqa.verify_stats()
+
+
+# monday 2024-01-01 00:00 UTC
+MONDAY = 1704067200
+
+
+@pytest.fixture
+def monday_simulator():
+    sim = ale.Simulator(seed = 1, start = MONDAY)
+    yield sim
+    sim.stop()
+
+
+def histogram_packet(channel, confidence, timestamp):
+    packet = ale.Packet(b'STATION2', b'STATION1', ale.ALE.CMD_SOUND)
+    packet.channel = channel
+    packet.confidence = confidence
+    packet.timestamp = timestamp
+    return packet
+
+
+def test_histogram_bucket():
+    assert PropagationHistogram.bucket(MONDAY) == 0
+    assert PropagationHistogram.bucket(MONDAY + (25 * 60 * 60) + 59) == 25
+    assert PropagationHistogram.bucket(MONDAY + (7 * 24 * 60 * 60) - 1) == PropagationHistogram.BUCKETS - 1
+
+
+# sparse hour of week buckets fall back to the mean for the hour of day across the week
+def test_histogram_fallback():
+    histogram = PropagationHistogram()
+    hour = 60 * 60
+    day = 24 * hour
+
+    # monday 02:00 and tuesday 02:00, too few samples in either bucket
+    histogram.update(histogram_packet('40A', 1.0, MONDAY + (2 * hour)))
+    histogram.update(histogram_packet('40A', 2.0, MONDAY + day + (2 * hour)))
+    assert histogram.mean(MONDAY + (2 * hour)) == 0.0
+
+    histogram.update(histogram_packet('40A', 3.0, MONDAY + (2 * day) + (2 * hour)))
+    assert histogram.mean(MONDAY + (2 * hour)) == pytest.approx(2.0)
+    # other hours are still empty
+    assert histogram.mean(MONDAY + (3 * hour)) == 0.0
+
+    # a bucket with enough samples uses its own mean
+    for confidence in (0.5, 0.5, 0.5):
+        histogram.update(histogram_packet('40A', confidence, MONDAY + (2 * hour)))
+    assert histogram.mean(MONDAY + (2 * hour)) == pytest.approx(2.5 / 4)
+    assert histogram.mean(MONDAY + day + (2 * hour)) == pytest.approx(7.5 / 6)
+
+
+# without recent packets the histogram mean is used, scaled by PRIOR_WEIGHT
+@pytest.mark.parametrize('count, expected', [(0, 0.0), (2, 0.0), (3, 2.0 * ale.LQA.PRIOR_WEIGHT), (10, 2.0 * ale.LQA.PRIOR_WEIGHT)])
+def test_blended_confidence_prior(monday_simulator, count, expected):
+    station = monday_simulator.add_station('STATION1')
+    channel = list(station.channels)[0]
+    week = 7 * 24 * 60 * 60
+
+    # a week ago at the same time, long expired
+    for i in range(count):
+        station.lqa.store(histogram_packet(channel, 2.0, MONDAY - week + i))
+
+    current_time = monday_simulator.clock.time()
+    assert station.lqa.link_confidence(channel, b'STATION2') == 0.0
+    assert station.lqa._blended_confidence(station.lqa.channel_stats, channel, current_time) == pytest.approx(expected)
+    assert station.lqa._blended_confidence(station.lqa.address_stats, (channel, b'STATION2'), current_time) == pytest.approx(expected)
+
+    # recent packets take precedence
+    receive(station, b'STATION2', channel, 1.0)
+    assert station.lqa._blended_confidence(station.lqa.channel_stats, channel, monday_simulator.clock.time()) == 1.0
+
+
+# last week's propagation by hour selects the channel, and histograms persist across save and load
+def test_best_channel_by_hour_of_week(monday_simulator):
+    station = monday_simulator.add_station('STATION1')
+    channels = list(station.channels)
+    hour = 60 * 60
+    last_week = MONDAY - (7 * 24 * hour)
+
+    # the first channel is best at night, the second in the afternoon
+    for i in range(5):
+        station.lqa.store(histogram_packet(channels[0], 2.5, last_week + (2 * hour) + i))
+        station.lqa.store(histogram_packet(channels[1], 1.0, last_week + (2 * hour) + i))
+        station.lqa.store(histogram_packet(channels[0], 1.0, last_week + (14 * hour) + i))
+        station.lqa.store(histogram_packet(channels[1], 2.5, last_week + (14 * hour) + i))
+
+    station.lqa.save_histograms()
+    loaded = monday_simulator.add_station('STATION3')
+    loaded.lqa.histogram_path = station.lqa.histogram_path
+    loaded.lqa.load_histograms()
+    assert {key: histogram.to_tuple() for key, histogram in loaded.lqa.histograms.items()} == {key: histogram.to_tuple() for key, histogram in station.lqa.histograms.items()}
+
+    monday_simulator.clock.advance(MONDAY + (2 * hour) + 1800)
+    assert station.lqa.best_channel() == channels[0]
+    assert station.lqa.best_channel(b'STATION2') == channels[0]
+    assert loaded.lqa.best_channel(b'STATION2') == channels[0]
+
+    monday_simulator.clock.advance(MONDAY + (14 * hour) + 1800)
+    assert station.lqa.best_channel() == channels[1]
+    assert station.lqa.best_channel(b'STATION2') == channels[1]
+    assert loaded.lqa.best_channel(b'STATION2') == channels[1]
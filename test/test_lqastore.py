@@ -0,0 +1,125 @@
+import time
+import zlib
+
+import pytest
+
+import ale
+
+
+def make_packet(timestamp, origin=b'STATION2', channel='20A', confidence=1.5):
+    packet = ale.Packet(origin, b'STATION1', ale.ALE.CMD_SOUND)
+    packet.timestamp = timestamp
+    packet.channel = channel
+    packet.confidence = confidence
+    return packet
+
+
+@pytest.fixture
+def sqlite_store(tmp_path):
+    clock = ale.VirtualClock(1000000)
+    store = ale.SQLiteHistoryStore(str(tmp_path / 'lqa_history.db'), clock)
+    yield store
+    store.close()
+
+
+def test_sqlite_load(sqlite_store):
+    for i in range(10):
+        sqlite_store.append(make_packet(1000000 + i))
+
+    history = sqlite_store.load(1000004)
+    assert [entry['timestamp'] for entry in history] == [1000005 + i for i in range(5)]
+    assert history[0]['origin'] == 'STATION2'
+
+
+# a corrupted row is skipped, the rest of the history is still loaded
+def test_sqlite_load_skips_bad_rows(sqlite_store):
+    sqlite_store.append(make_packet(1000000))
+    sqlite_store.append(make_packet(1000001, origin = b'\xff\xfe'))
+    sqlite_store.append(make_packet(1000002))
+
+    history = sqlite_store.load(0)
+    assert [entry['timestamp'] for entry in history] == [1000000, 1000002]
+
+
+# retention is measured on the injected clock, not the system clock
+def test_sqlite_cull_uses_clock(sqlite_store):
+    retention = ale.SQLiteHistoryStore.RETENTION
+    sqlite_store.append(make_packet(1000000 - retention - 10))
+    sqlite_store.append(make_packet(1000000 - 10))
+
+    sqlite_store.cull(1000000)
+    assert [entry['timestamp'] for entry in sqlite_store.load(0)] == [1000000 - 10]
+
+
+def test_station_loads_history_with_bad_rows(simulator):
+    station = simulator.add_station('STATION1', {'lqa': {'backend': 'sqlite'}})
+    channel = list(station.channels)[0]
+    station.lqa.backend.append(make_packet(simulator.clock.time() - 60, channel = channel))
+    station.lqa.backend.append(make_packet(simulator.clock.time() - 30, origin = b'\xff', channel = channel))
+    station.lqa.backend.flush()
+
+    lqa = ale.LQA(station)
+    assert lqa.link_confidence(channel, b'STATION2') == 1.5
+    assert len(lqa.packets()) == 1
+
+
+@pytest.fixture
+def journal_store(tmp_path):
+    store = ale.JournalHistoryStore(str(tmp_path / 'lqa_journal'))
+    yield store
+    store.close()
+
+
+def test_journal_load(journal_store, tmp_path):
+    for i in range(10):
+        journal_store.append(make_packet(1000000 + i))
+
+    journal_store.close()
+    store = ale.JournalHistoryStore(str(tmp_path / 'lqa_journal'))
+    history = store.load(1000004)
+    store.close()
+
+    assert [entry['timestamp'] for entry in history] == [1000005 + i for i in range(5)]
+    assert history[0]['origin'] == 'STATION2'
+
+
+# a packet with a corrupted origin address does not raise on the receive path
+def test_journal_append_bad_origin(journal_store):
+    journal_store.append(make_packet(1000000))
+    journal_store.append(make_packet(1000001, origin = b'\xff\xfe'))
+    journal_store.append(make_packet(1000002))
+
+    assert [entry['timestamp'] for entry in journal_store.load(0)] == [1000000, 1000002]
+
+
+def test_journal_truncated_record(journal_store, tmp_path):
+    for i in range(3):
+        journal_store.append(make_packet(1000000 + i))
+    journal_store.close()
+
+    with open(str(tmp_path / 'lqa_journal'), 'ab') as fd:
+        fd.write(b'\x00' * 5)
+
+    store = ale.JournalHistoryStore(str(tmp_path / 'lqa_journal'))
+    assert len(store.load(0)) == 3
+    store.close()
+
+
+# cold start loading the sound window from a journal of 1M records, reported with pytest -s
+def test_benchmark_journal_cold_start(journal_store, tmp_path):
+    journal_store.append(make_packet(0))
+    journal_store.close()
+    origin_hash = zlib.crc32(b'STATION2')
+    count = 1000000
+
+    with open(str(tmp_path / 'lqa_journal'), 'wb') as fd:
+        fd.write(b''.join(ale.JournalHistoryStore.RECORD.pack(i, 0, origin_hash, 1.5, b'CS') for i in range(count)))
+
+    start = time.perf_counter()
+    store = ale.JournalHistoryStore(str(tmp_path / 'lqa_journal'))
+    history = store.load(count - ale.LQA.SOUND_WINDOW)
+    elapsed = time.perf_counter() - start
+    store.close()
+
+    print('\ncold start with {} records: {:.1f} ms'.format(count, elapsed * 1000))
+    assert len(history) == ale.LQA.SOUND_WINDOW - 1
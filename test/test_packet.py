@@ -0,0 +1,133 @@
+import os
+import time
+import random
+
+import pytest
+
+import ale
+
+
+def make_packet(command=b'CS', origin=b'STATION1', destination=b'STATION2', data=b''):
+    return ale.Packet(origin, destination, command, data)
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_pack_unpack(binary):
+    packet = make_packet(b'CA', data = ale.Packet.pack_options({ale.Packet.OPTION_CAPABILITIES: b'ZB'}))
+    raw = packet.pack(binary)
+
+    assert ale.Packet.is_packet(raw)
+
+    unpacked = ale.Packet()
+    unpacked.unpack(raw)
+    assert unpacked.binary == binary
+    assert (unpacked.command, unpacked.origin, unpacked.destination, unpacked.data) == (b'CA', b'STATION1', b'STATION2', packet.data)
+
+
+def test_binary_preamble_requires_version():
+    rng = random.Random(1)
+    payloads = [bytes([0xae]) + os.urandom(rng.randint(0, 64)) for i in range(1000)]
+    payloads = [payload for payload in payloads if payload[1:2] != bytes([ale.Packet.BINARY_VERSION])]
+
+    # data starting with the preamble byte alone is not a packet
+    for payload in payloads:
+        assert not ale.Packet.is_packet(payload)
+
+
+def test_unpack_unknown_preamble():
+    with pytest.raises(ValueError):
+        ale.Packet().unpack(b'\xae\x02\x01\x01\x01AB')
+
+
+def test_aggregate_round_trip():
+    packed_packets = [make_packet(command).pack(binary) for command in ale.Packet.COMMAND_CODES for binary in (False, True)]
+    raw = ale.Packet.aggregate(packed_packets)
+
+    assert ale.Packet.is_aggregate(raw)
+    assert [bytes(packed_packet) for packed_packet in ale.Packet.disaggregate(raw)] == packed_packets
+
+
+# encode/decode benchmark, reported with pytest -s
+@pytest.mark.parametrize('binary', [False, True])
+def test_benchmark_encode_decode(binary):
+    count = 20000
+    packet = make_packet(b'CS', data = ale.Packet.pack_options({ale.Packet.OPTION_LQA: bytes(20)}))
+
+    start = time.perf_counter()
+    for i in range(count):
+        raw = packet.pack(binary)
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(count):
+        unpacked = ale.Packet()
+        unpacked.unpack(raw)
+        unpacked.origin
+    decode_time = time.perf_counter() - start
+
+    print('\n{} encode {:.0f}/s, decode {:.0f}/s'.format('binary' if binary else 'ascii', count / encode_time, count / decode_time))
+    assert unpacked.origin == b'STATION1'
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_materialize_releases_buffer(binary):
+    raw = make_packet(data = b'#' * 16).pack(binary)
+
+    packet = ale.Packet()
+    packet.unpack(raw)
+    packet.origin
+    assert packet._view is not None
+
+    packet.materialize()
+    assert packet._view is None
+    assert (packet.command, packet.origin, packet.destination, packet.data) == (b'CS', b'STATION1', b'STATION2', b'#' * 16)
+
+    # accessing every field releases the buffer as well
+    packet = ale.Packet()
+    packet.unpack(raw)
+    packet.command, packet.origin, packet.destination, packet.data
+    assert packet._view is None
+
+
+# copying unpack of text packets before lazy unpacking, the baseline of the benchmark below
+def eager_unpack(raw):
+    raw = raw[len(ale.Packet.PREAMBLE):]
+    len_separator = len(ale.Packet.SEPARATOR)
+    address_separator = raw.find(ale.Packet.SEPARATOR)
+    data_separator = raw.find(ale.Packet.SEPARATOR, address_separator + len_separator)
+
+    return ale.Packet(raw[2:address_separator], raw[address_separator + len_separator:data_separator], raw[:2], raw[data_separator + len_separator:])
+
+
+# lazy unpack reading only the header fields, compared to eager decoding and to materializing every field, reported
+# with pytest -s
+@pytest.mark.parametrize('size', [40, 4096])
+def test_benchmark_lazy_unpack(size):
+    count = 20000
+    header = len(make_packet().pack())
+    raw = make_packet(data = b'#' * (size - header)).pack()
+    assert len(raw) == size
+    assert (eager_unpack(raw).command, eager_unpack(raw).data) == (b'CS', b'#' * (size - header))
+
+    start = time.perf_counter()
+    for i in range(count):
+        packet = eager_unpack(raw)
+        packet.command, packet.destination
+    eager_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(count):
+        packet = ale.Packet()
+        packet.unpack(raw)
+        packet.command, packet.destination
+    lazy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(count):
+        packet = ale.Packet()
+        packet.unpack(raw)
+        packet.materialize()
+    materialize_time = time.perf_counter() - start
+
+    print('\n{} byte frames: eager {:.0f}/s, lazy {:.0f}/s, materialized {:.0f}/s'.format(size, count / eager_time, count / lazy_time, count / materialize_time))
+    assert packet._view is None
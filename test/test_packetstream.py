@@ -0,0 +1,102 @@
+import os
+import time
+import random
+
+import pytest
+
+import ale
+
+
+def transmissions(rng):
+    fec = ale.FEC()
+    digest = ale.Packet.pack_options({ale.Packet.OPTION_LQA: b'ALEALMALF' + ale.Packet.BINARY_START + b'\x01' + os.urandom(40)})
+    packets = [
+        ale.Packet(b'STATION1', b'STATION2', b'CS', b'hello ALE world'),
+        ale.Packet(b'STATION1', b'STATION2', b'CA', ale.Packet.pack_options({ale.Packet.OPTION_CAPABILITIES: b'ZT'}) + b'#' * 20),
+        ale.Packet(b'STATION1', b'STATION2', b'CS', digest + b'#' * 10),
+        ale.Packet(b'STATION1', b'STATION2', b'CC', digest)
+    ]
+
+    for i in range(200):
+        sent = [rng.choice(packets) for j in range(rng.randint(1, 3))]
+        binary = rng.random() < 0.5
+        raw = sent[0].pack(binary) if len(sent) == 1 else ale.Packet.aggregate([packet.pack(binary) for packet in sent])
+        if rng.random() < 0.5:
+            raw = fec.encode(raw)
+
+        yield (sent, raw)
+
+
+def feed_chunks(stream, raw, rng, max_chunk):
+    packets = []
+    offset = 0
+    while offset < len(raw):
+        length = rng.randint(1, max_chunk)
+        packets.extend(stream.feed(raw[offset:offset + length]))
+        offset += length
+
+    return packets
+
+
+# preambles inside packet data, option values, aggregated packets and fec parity do not split frames
+@pytest.mark.parametrize('max_chunk', [1, 7, 64, 100000])
+def test_chunked_stream(max_chunk):
+    rng = random.Random(max_chunk)
+    stream = ale.PacketStream()
+    sent = []
+    raw = b''
+
+    for packets, transmission in transmissions(rng):
+        sent.extend(packets)
+        raw += transmission
+
+    received = feed_chunks(stream, raw, rng, max_chunk) + stream.flush()
+    assert [(packet.command, packet.origin, packet.data) for packet in received] == [(packet.command, packet.origin, packet.data) for packet in sent]
+
+
+# noise between transmissions is dropped without losing the transmissions
+def test_noise_between_frames():
+    rng = random.Random(1)
+    stream = ale.PacketStream()
+    sent = []
+    raw = b''
+
+    for packets, transmission in transmissions(rng):
+        sent.extend(packets)
+        noise = bytes(rng.choice(b'ALEMF#:\xae\x01xyz') for i in range(rng.randint(0, 20))).replace(b'#', b'')
+        # noise must not continue the padding of the previous frame, or start a frame
+        raw += transmission + b'\x00' + noise.replace(b'ALE', b'').replace(b'ALM', b'').replace(b'ALF', b'').replace(ale.Packet.BINARY_START, b'')
+
+    received = feed_chunks(stream, raw, rng, 50) + stream.flush()
+    assert len(received) == len(sent)
+    assert stream.dropped_bytes > 0
+
+
+def test_fuzz():
+    rng = random.Random(2)
+    stream = ale.PacketStream(max_buffer = 4096)
+    fragments = [b'ALE', b'ALECS', b'ALM', b'ALM\x00\x02', b'ALF', ale.Packet.BINARY_START, b':', b'#', b'L\x05']
+
+    for i in range(2000):
+        chunk = b''.join(rng.choice(fragments) if rng.random() < 0.3 else os.urandom(rng.randint(1, 8)) for j in range(rng.randint(1, 10)))
+        for packet in stream.feed(chunk):
+            assert ale.Packet.is_packet(packet.pack())
+
+        assert len(stream.buffer) <= 4096
+
+    stream.flush()
+    assert len(stream.buffer) == 0
+
+
+# stream parser throughput, reported with pytest -s
+def test_benchmark_throughput():
+    rng = random.Random(3)
+    raw = b''.join(transmission for packets, transmission in transmissions(rng))
+    stream = ale.PacketStream()
+
+    start = time.perf_counter()
+    received = feed_chunks(stream, raw, rng, 64) + stream.flush()
+    elapsed = time.perf_counter() - start
+
+    print('\n{:.0f} bytes/s, {:.0f} packets/s'.format(len(raw) / elapsed, len(received) / elapsed))
+    assert len(received) > 0
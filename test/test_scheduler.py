@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import threading
+
+import pytest
+
+import ale
+
+
+def test_wait_until_deadline():
+    scheduler = ale.Scheduler()
+    start = time.monotonic()
+    scheduler.wake_at(scheduler.clock.time() + 0.05)
+    scheduler.wait()
+    elapsed = time.monotonic() - start
+
+    assert 0.04 <= elapsed < 0.5
+    assert scheduler.wake_count == 1
+
+
+def test_wait_max_sleep(monkeypatch):
+    monkeypatch.setattr(ale.Scheduler, 'MAX_SLEEP', 0.05)
+    scheduler = ale.Scheduler()
+    start = time.monotonic()
+    scheduler.wait()
+
+    assert 0.04 <= time.monotonic() - start < 0.5
+
+
+# a wake from another thread (e.g. packet receive) returns before the deadline
+def test_wake_from_thread():
+    scheduler = ale.Scheduler()
+    scheduler.wake_at(scheduler.clock.time() + 10)
+    timer = threading.Timer(0.05, scheduler.wake)
+    timer.start()
+
+    start = time.monotonic()
+    scheduler.wait()
+    timer.join()
+
+    assert time.monotonic() - start < 0.5
+    assert not scheduler.pending
+
+
+# an earlier deadline registered while waiting shortens the wait
+def test_earlier_deadline_from_thread():
+    scheduler = ale.Scheduler()
+    scheduler.wake_at(scheduler.clock.time() + 10)
+    timer = threading.Timer(0.05, lambda: scheduler.wake_at(scheduler.clock.time()))
+    timer.start()
+
+    start = time.monotonic()
+    scheduler.wait()
+    timer.join()
+
+    assert time.monotonic() - start < 0.5
+
+
+def test_virtual_wait():
+    clock = ale.VirtualClock(1000.0)
+    scheduler = ale.VirtualScheduler(clock)
+
+    scheduler.wake_at(1000.5)
+    scheduler.wake_at(1000.25)
+    scheduler.wait()
+    assert clock.time() == pytest.approx(1000.25 + ale.VirtualScheduler.RESOLUTION)
+    assert scheduler.next_deadline() == 1000.5
+
+    # a pending wake does not advance the clock
+    scheduler.wake()
+    scheduler.wait()
+    assert clock.time() == pytest.approx(1000.25 + ale.VirtualScheduler.RESOLUTION)
+
+    # without deadlines the clock advances by MAX_SLEEP
+    scheduler.wait()
+    scheduler.wait()
+    assert clock.time() == pytest.approx(1000.5 + ale.Scheduler.MAX_SLEEP + 2 * ale.VirtualScheduler.RESOLUTION)
+    assert scheduler.next_deadline() == None
+
+
+# jobs loop wakeups of an idle scanning station over a simulated hour, reported with pytest -s
+def test_idle_wakeups(simulator):
+    station = simulator.add_station('STATION1')
+    simulator.run(60)
+    wake_count = station.scheduler.wake_count
+
+    simulator.run(60 * 60)
+    wakeups = station.scheduler.wake_count - wake_count
+
+    print('\nidle station: {} wakeups per simulated hour'.format(wakeups))
+    # the jobs loop sleeps at most MAX_SLEEP, a 1 ms polling loop wakes 3.6M times an hour
+    assert wakeups <= (60 * 60 / ale.Scheduler.MAX_SLEEP) * 1.1
+
+
+class IdleModem:
+
+    def __init__(self):
+        self.confidence = 1.5
+        self.carrier_sense = False
+        self._tx_buffer = []
+
+    def send(self, data):
+        pass
+
+    def set_rx_callback(self, func):
+        pass
+
+    def stop(self):
+        pass
+
+
+class IdleRadio:
+
+    def set_vfo_a(self, freq):
+        pass
+
+    def set_sideband(self, sideband):
+        pass
+
+
+# process CPU time of an idle station jobs thread on the wall clock, reported with pytest -s
+def test_benchmark_idle_cpu(tmp_path):
+    config_path = os.path.join(tmp_path, 'config')
+    with open(config_path, 'w') as fd:
+        json.dump({'address': 'STATION1', 'scanlist': 'General'}, fd)
+
+    station = ale.ALE(config_path, modem = IdleModem(), radio = IdleRadio(), config_dir = str(tmp_path))
+    try:
+        # settle after startup
+        time.sleep(0.5)
+        wake_count = station.scheduler.wake_count
+        cpu_start = time.process_time()
+        start = time.monotonic()
+        time.sleep(3)
+        cpu = time.process_time() - cpu_start
+        elapsed = time.monotonic() - start
+        wakeups = station.scheduler.wake_count - wake_count
+    finally:
+        station.stop()
+
+    print('\nidle station: {:.2f}% cpu, {:.1f} wakeups per second'.format(100 * cpu / elapsed, wakeups / elapsed))
+    assert wakeups / elapsed < 100
+    assert cpu / elapsed < 0.1
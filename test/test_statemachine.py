@@ -0,0 +1,215 @@
+import time
+import random
+import itertools
+import threading
+
+import pytest
+
+import ale
+
+
+STATES = [ale.ALE.STATE_SCANNING, ale.ALE.STATE_CALLING, ale.ALE.STATE_CONNECTING, ale.ALE.STATE_CONNECTED, ale.ALE.STATE_SOUNDING]
+COMMANDS = [ale.ALE.CMD_SOUND, ale.ALE.CMD_CALL, ale.ALE.CMD_ACK, ale.ALE.CMD_END]
+DESTINATIONS = ['station', 'any', 'other']
+ORIGINS = ['peer', 'stranger']
+
+
+@pytest.fixture
+def station(simulator):
+    station = simulator.add_station('STATION1')
+    station.events = []
+    station.state_machine.listeners.append(station.events.append)
+    return station
+
+
+def packet(station, command, destination, origin):
+    addresses = {'station': station.address, 'any': ale.ALE.ADDRESS_ANY, 'other': b'OTHER', 'peer': b'PEER', 'stranger': b'STRANGER'}
+    packet = ale.Packet(addresses[origin], addresses[destination], command)
+    packet.channel = station.channel
+    packet.confidence = 2.0
+    packet.timestamp = station.clock.time()
+    return packet
+
+
+# put the state machine in the given state through its own transitions, with PEER as the call address
+def enter(station, ale_state):
+    machine = station.state_machine
+    machine.change_state(ale.ALE.STATE_SCANNING)
+
+    if ale_state == ale.ALE.STATE_CALLING:
+        machine.call(b'PEER')
+    elif ale_state == ale.ALE.STATE_CONNECTING:
+        machine.receive_packet(packet(station, ale.ALE.CMD_CALL, 'station', 'peer'))
+    elif ale_state == ale.ALE.STATE_CONNECTED:
+        machine.call(b'PEER')
+        machine.receive_packet(packet(station, ale.ALE.CMD_ACK, 'station', 'peer'))
+    elif ale_state == ale.ALE.STATE_SOUNDING:
+        machine.change_state(ale.ALE.STATE_SOUNDING)
+
+    assert machine.state == ale_state
+    station.events.clear()
+
+
+# expected state after receiving a packet, independent of the transition table
+def expected_state(ale_state, command, destination, origin):
+    to_us = destination in ('station', 'any')
+    from_call_address = destination == 'station' and origin == 'peer'
+
+    if ale_state in (ale.ALE.STATE_SCANNING, ale.ALE.STATE_SOUNDING) and command == ale.ALE.CMD_CALL and to_us:
+        return ale.ALE.STATE_CONNECTING
+
+    if ale_state in (ale.ALE.STATE_CALLING, ale.ALE.STATE_CONNECTING, ale.ALE.STATE_CONNECTED) and from_call_address:
+        if command == ale.ALE.CMD_END:
+            return ale.ALE.STATE_SCANNING
+        if command == ale.ALE.CMD_ACK and ale_state != ale.ALE.STATE_CONNECTED:
+            return ale.ALE.STATE_CONNECTED
+        if command == ale.ALE.CMD_CALL and ale_state == ale.ALE.STATE_CALLING:
+            return ale.ALE.STATE_CONNECTING
+
+    return ale_state
+
+
+# every state, command, destination and origin combination
+@pytest.mark.parametrize('ale_state, command, destination, origin', list(itertools.product(STATES, COMMANDS, DESTINATIONS, ORIGINS)))
+def test_transition_table(station, ale_state, command, destination, origin):
+    enter(station, ale_state)
+    received = packet(station, command, destination, origin)
+    station.state_machine.receive_packet(received)
+
+    next_state = expected_state(ale_state, command, destination, origin)
+    assert station.state_machine.state == next_state
+
+    if next_state == ale_state:
+        assert station.events == []
+    else:
+        event = station.events[-1]
+        assert (event.last_state, event.state, event.command) == (ale_state, next_state, command)
+        if next_state != ale.ALE.STATE_SCANNING:
+            assert event.address == received.origin
+
+
+# the calling state event carries the address being called, not the previous call address
+def test_call_event_address(station):
+    enter(station, ale.ALE.STATE_CONNECTED)
+    station.state_machine.change_state(ale.ALE.STATE_SCANNING)
+    station.events.clear()
+
+    station.state_machine.call('STATION2')
+
+    assert station.events[-1].state == ale.ALE.STATE_CALLING
+    assert station.events[-1].address == b'STATION2'
+    assert station.state_machine.state.call_address == b'STATION2'
+
+
+# receive_packet dispatch rate, reported with pytest -s
+@pytest.mark.parametrize('command, destination', [(ale.ALE.CMD_SOUND, 'any'), (ale.ALE.CMD_ACK, 'other'), (ale.ALE.CMD_END, 'station')])
+def test_benchmark_receive_packet(station, command, destination):
+    received = packet(station, command, destination, 'stranger')
+    count = 100000
+
+    start = time.perf_counter()
+    for i in range(count):
+        station.state_machine.receive_packet(received)
+    elapsed = time.perf_counter() - start
+
+    print('\n{} to {}: {:.0f} packets/s'.format(command.decode('utf-8'), destination, count / elapsed))
+    assert station.state_machine.state == ale.ALE.STATE_SCANNING
+
+
+# packets received on modem threads and user calls while the jobs loop ticks at a high rate, reported with pytest -s
+def test_threaded_stress(station):
+    # transmissions are not part of the test
+    station.modem.send = lambda data: None
+    clock = station.clock
+    stop = threading.Event()
+    errors = []
+    counts = {'receive': 0, 'tick': 0, 'user': 0}
+
+    def run(func, name):
+        try:
+            while not stop.is_set():
+                func()
+                counts[name] += 1
+        except Exception as e:
+            errors.append(e)
+            raise
+
+    def receive(rng):
+        command = rng.choice(COMMANDS)
+        raw = ale.Packet(rng.choice([b'PEER', b'STRANGER']), rng.choice([station.address, ale.ALE.ADDRESS_ANY]), command).pack()
+        station._receive(raw, 2.0)
+
+    def tick():
+        clock.advance(clock.time() + 0.05)
+        station._run_jobs()
+
+    def user(rng):
+        if rng.random() < 0.5:
+            station.call(b'PEER')
+        else:
+            station.end()
+        time.sleep(0.001)
+
+    threads = [
+        threading.Thread(target = run, args = (lambda rng=random.Random(1): receive(rng), 'receive')),
+        threading.Thread(target = run, args = (lambda rng=random.Random(2): receive(rng), 'receive')),
+        threading.Thread(target = run, args = (tick, 'tick')),
+        threading.Thread(target = run, args = (lambda rng=random.Random(3): user(rng), 'user'))
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    time.sleep(2)
+    stop.set()
+    for thread in threads:
+        thread.join(10)
+
+    print('\n{} state events, {}'.format(len(station.events), counts))
+    assert errors == []
+    assert not any(thread.is_alive() for thread in threads)
+    assert len(station.events) > 0
+
+    # each transition leaves the state entered by the previous one
+    for event, next_event in zip(station.events, station.events[1:]):
+        assert next_event.last_state == event.state
+
+    machine = station.state_machine
+    assert machine.state == station.events[-1].state
+    assert machine.state.active
+    for ale_state, state in machine.states.items():
+        # the scanning state stays active when left, see StateScanning.leave_state
+        if state is not machine.state and ale_state != ale.ALE.STATE_SCANNING:
+            assert not state.active
+
+
+# user callbacks are called after the state machine lock is released, so a callback can end the call from another
+# thread and wait for it
+@pytest.mark.parametrize('callback', ['connected', 'call'])
+def test_callback_end_from_thread(simulator, callback):
+    caller = simulator.add_station('CALLER')
+    called = simulator.add_station('CALLED')
+    for channel in caller.channels:
+        simulator.set_link('CALLER', 'CALLED', channel, 2.5)
+
+    station = caller if callback == 'connected' else called
+    ended = []
+
+    def end(address):
+        thread = threading.Thread(target = station.end)
+        thread.start()
+        thread.join(5)
+        ended.append(not thread.is_alive())
+
+    station.callback[callback] = end
+    disconnected = []
+    station.callback['disconnected'] = lambda address, duration: disconnected.append(address)
+
+    simulator.run(10)
+    caller.call(b'CALLED')
+    simulator.run(120)
+
+    assert ended == [True]
+    assert disconnected == [b'CALLED' if station is caller else b'CALLER']
+    assert station.state_machine.state == ale.ALE.STATE_SCANNING
+    assert station.state_machine.callbacks == []
@@ -0,0 +1,74 @@
+import os
+import queue
+import random
+import threading
+
+import pytest
+
+
+
+def lossy_loopback(sender, receiver, rng, loss):
+    frames = queue.Queue()
+
+    # fragments and acks are lost at random, the rest are received on the receiving station's thread
+    def send_data(data, keep_alive=False):
+        if rng.random() >= loss:
+            frames.put(bytes(data))
+
+    sender._send_data = send_data
+
+    def receive():
+        while True:
+            raw = frames.get()
+            if raw == None:
+                return None
+            receiver.transport.receive(raw)
+            frames.task_done()
+
+    thread = threading.Thread(target = receive, daemon = True)
+    thread.start()
+    return (frames, thread)
+
+
+# fragments are received on a modem thread while the jobs thread ticks the transport, throughput in simulated
+# time is reported with pytest -s
+@pytest.mark.parametrize('loss', [0.0, 0.2, 0.5])
+def test_lossy_loopback(simulator, connect, loss):
+    caller, called = connect({'packet': {'transport': True}})
+    assert caller.transport_negotiated() and called.transport_negotiated()
+
+    rng = random.Random(loss)
+    received = []
+    called.callback['rx'] = lambda data: received.append(bytes(data))
+    loopbacks = [lossy_loopback(caller, called, rng, loss), lossy_loopback(called, caller, rng, loss)]
+
+    messages = [os.urandom(rng.randint(0, 1000)) for i in range(30)]
+    start = simulator.clock.time()
+    for message in messages:
+        caller.send(message)
+
+    for i in range(100000):
+        if received == messages or caller.transport.failed:
+            break
+
+        for station in (caller, called):
+            station.transport.tick()
+            station.transport.next_deadline()
+
+        # frames sent in this step are received before simulated time moves on, so the elapsed time does not
+        # depend on thread scheduling
+        for frames, thread in loopbacks:
+            frames.join()
+
+        simulator.clock.advance(simulator.clock.time() + 0.05)
+
+    elapsed = simulator.clock.time() - start
+
+    for frames, thread in loopbacks:
+        frames.put(None)
+        thread.join()
+
+    assert received == messages
+    total = sum(len(message) for message in messages)
+    print('\n{:.0%} loss: {} bytes in {:.1f} s, {:.1f} bytes/s, {} retransmissions'.format(loss, total, elapsed, total / elapsed, caller.transport.retransmit_count))
+    assert not caller.transport.failed